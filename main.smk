@@ -102,6 +102,9 @@ elif mode == "generate_vis":
     n_largest_cell_types = get_config_var(config, "n_largest_cell_types", "5")
     scale_factor = get_config_var(config, "scale_factor")
     deconv_methods = get_config_var(config, "deconv_methods")
+    # vis_cache=<dir>: per-method intermediates cached across runs (sp_visualizer.py --cache_dir)
+    vis_cache = get_config_var(config, "vis_cache", "none")
+    vis_cache_arg = f"--cache_dir {vis_cache}" if vis_cache not in ("", "none", "None") else ""
 
     print(raw_norm_weights_filepaths_without_split)
     rule gen_html:
@@ -115,7 +118,28 @@ elif mode == "generate_vis":
         shell:
             """
             start_time=$(date +%s)
-            python3 subworkflows/visualization/sp_visualizer.py {sp_input} {raw_norm_weights_filepaths_without_split} {st_coords_filepath} {data_clustered} {image_path} {n_largest_cell_types} {scale_factor} {generated_file} {deconv_methods}
+            python3 subworkflows/visualization/sp_visualizer.py {sp_input} {raw_norm_weights_filepaths_without_split} {st_coords_filepath} {data_clustered} {image_path} {n_largest_cell_types} {scale_factor} {generated_file} {deconv_methods} {vis_cache_arg}
+            end_time=$(date +%s)
+            elapsed_time=$((end_time - start_time))
+            echo "html_generation took $elapsed_time seconds"
+            """
+elif mode == "generate_vis_batch":
+    vis_manifest = get_config_var(config, "vis_manifest")
+    output_dir = get_config_var(config, "output", ".")
+    vis_workers = get_config_var(config, "vis_workers", "4")
+    vis_cache = get_config_var(config, "vis_cache", "none")
+    vis_cache_arg = f"--cache_dir {vis_cache}" if vis_cache not in ("", "none", "None") else ""
+
+    rule gen_html_batch:
+        input:
+            vis_manifest = vis_manifest
+        output:
+            index_file = f"{output_dir}/index.html"
+        threads: int(vis_workers)
+        shell:
+            """
+            start_time=$(date +%s)
+            python3 subworkflows/visualization/sp_visualizer_batch.py {vis_manifest} {output_dir} --workers {threads} {vis_cache_arg}
             end_time=$(date +%s)
             elapsed_time=$((end_time - start_time))
             echo "html_generation took $elapsed_time seconds"
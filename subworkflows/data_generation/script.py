@@ -1,4 +1,11 @@
+import os
+import queue
 import shutil
+import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 synthspot_types_map = {
     'aud': "artificial_uniform_distinct", 
     'add': "artificial_diverse_distinct",
@@ -41,6 +48,18 @@ gen_arguments = lire_config_et_former_options("subworkflows/data_generation/conf
 synthspot_types_fullnames = list(synthspot_types_map.values())
 synthspot_types_flat = synthspot_types_flat = [item for sublist in synthspot_types_map.items() for item in sublist] #All key and values in a list
 
+def convert_between_rds_and_h5ad(input_path):
+    """h5ad reference -> rds through the shared conversion cache of the deconvolution methods
+    (conversion_cache.py): converted once per content, not at every generation run."""
+    sys.path.insert(0, "subworkflows/deconvolution")
+    import conversion_cache
+
+    options = gen_arguments.split()
+    annot = config.get("clust_var", dict(zip(options[::2], options[1::2])).get("--clust_var", "celltype"))
+    return conversion_cache.convert(input_path, annot,
+                                    config.get("conversion_cache", conversion_cache.DEFAULT_CACHE_DIR),
+                                    config.get("conversion_cache_size", conversion_cache.DEFAULT_MAX_SIZE))
+
 def create_file_if_not_exists(file_path):
     directory = os.path.dirname(file_path)
     if directory and not os.path.exists(directory):
@@ -49,20 +68,162 @@ def create_file_if_not_exists(file_path):
         with open(file_path, 'w') as f:
             pass  # Write nothing, just create the empty file
 
-def generate_synthetic_data(sc_input, dataset_type, rep, outdir, annot, args=None ):
-    output_file = f"{os.path.basename(sc_input).split('.')[0]}_{dataset_type}_rep{rep}.rds"
-    create_file_if_not_exists(output_file)
-    args_str = args if args else ''
+def parse_memory(value):
+    """'8G', '500M', '2048K' or a plain number of bytes -> bytes (None when empty)."""
+    if value in (None, '', 'None', 'none'):
+        return None
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def effective_workers(workers, mem_per_job, n_jobs):
+    """Requested workers (default: number of CPUs), capped so that workers x mem_per_job fits in RAM."""
+    workers = int(workers) if workers else (os.cpu_count() or 1)
+    memory = total_memory()
+    if mem_per_job and memory:
+        workers = min(workers, max(1, memory // mem_per_job))
+    return max(1, min(workers, n_jobs))
+
+def rscript_command(sc_input, annot, job_options):
     region_var = config["region_var"] if "region_var" in config.keys()  else 'NULL' # brain_subregion
-    shell_command = (
+    return (
         f"Rscript subworkflows/data_generation/generate_synthetic_data.R "
-        f"--sc_input {sc_input} --dataset_type {dataset_type} --rep {rep}  --clust_var {annot} --region_var {region_var} {gen_arguments}"
+        f"--sc_input {sc_input} {job_options}  --clust_var {annot} --region_var {region_var} {gen_arguments}"
     )
+
+def limit_memory(shell_command, mem_per_job):
+    """shell_command with the address space of the R process capped (ulimit -v, in the shell: the jobs
+    are started from threads, where a preexec_fn is unsafe): a job above its budget fails alone
+    instead of pushing the whole grid into swap / the OOM killer."""
+    if not mem_per_job:
+        return shell_command
+    return f"ulimit -v {mem_per_job // 1024} && exec {shell_command}"
+
+def job_seed(base_seed, dataset_type, rep):
+    """Seed of one (dataset_type, rep) job: depends only on the job, not on which worker runs it
+    or in which order, so a session run is reproducible whatever the scheduling."""
+    return (int(base_seed) * 1000003 + zlib.crc32(f"{dataset_type}_rep{rep}".encode())) % 2 ** 31
+
+def generate_synthetic_data(sc_input, dataset_type, rep, outdir, annot, args=None, base_seed=0, mem_per_job=None,
+                            log_dir=None):
+    """Run one Rscript job and return its record: exit status, wall time and peak RSS of the R process.
+    The job writes its own file name in the working directory, moved to outdir only on success.
+    It is seeded with job_seed(), as the same job of the session engine."""
+    output_file = f"{os.path.basename(sc_input).split('.')[0]}_{dataset_type}_rep{rep}.rds"
+    seed = job_seed(base_seed, dataset_type, rep)
+    shell_command = rscript_command(sc_input, annot, f"--dataset_type {dataset_type} --rep {rep} --seed {seed}")
     print(shell_command)
-    os.system(shell_command)
-    # Copy the output file to the output directory
+
+    log_dir = log_dir or outdir
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, f"{os.path.splitext(output_file)[0]}.log")
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(limit_memory(shell_command, mem_per_job), shell=True, stdout=log,
+                                stderr=subprocess.STDOUT)
+        # wait4 instead of proc.wait(): same exit status, plus the rusage of the finished job alone
+        # (RUSAGE_CHILDREN would mix the concurrent jobs together).
+        _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.perf_counter() - start
+
     output_path = os.path.join(outdir, output_file)
-    shutil.move(output_file, output_path)
+    if proc.returncode == 0 and os.path.exists(output_file):
+        shutil.move(output_file, output_path)
+    elif os.path.exists(output_file):
+        os.remove(output_file)  # never leave a partial file that a rerun would take as done
+    return {'dataset_type': dataset_type, 'rep': rep, 'output': output_path, 'returncode': proc.returncode,
+            'ok': proc.returncode == 0 and os.path.exists(output_path),
+            'wall_time': wall_time, 'peak_rss': usage.ru_maxrss * 1024, 'log': log_path}
+
+def run_generation_session(sc_input, jobs, outdir, annot, mem_per_job=None, log_dir=None, worker=0):
+    """One long-lived R worker (generate_synthetic_data.R --session TRUE): the reference is read once,
+    then (dataset_type, rep, seed) jobs are taken from the shared queue until it is empty.
+    The peak RSS of a job record is the one of its worker over the whole session."""
+    basename = os.path.basename(sc_input).split('.')[0]
+    shell_command = rscript_command(sc_input, annot, "--session TRUE")
+    print(f"[worker {worker}] {shell_command}")
+    log_dir = log_dir or outdir
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, f"session_worker{worker}.log")
+    records = []
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(limit_memory(shell_command, mem_per_job), shell=True, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=log, text=True, bufsize=1)
+
+        def reply():
+            # Next protocol line of the worker; anything else it prints goes to the log.
+            for line in proc.stdout:
+                if line.startswith('@@'):
+                    return line.rstrip('\n')
+                log.write(line)
+            return None
+
+        alive = reply() == '@@READY'
+        while alive:
+            try:
+                dataset_type, rep, seed = jobs.get_nowait()
+            except queue.Empty:
+                break
+            output_file = f"{basename}_{dataset_type}_rep{rep}.rds"
+            output_path = os.path.join(outdir, output_file)
+            start = time.perf_counter()
+            proc.stdin.write(f"{dataset_type}\t{rep}\t{seed}\n")
+            proc.stdin.flush()
+            answer = reply()
+            alive = answer is not None
+            ok = alive and answer.startswith('@@DONE') and os.path.exists(output_file)
+            if ok:
+                shutil.move(output_file, output_path)
+            else:
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                log.write(f"{dataset_type} rep{rep}: {answer or 'worker exited'}\n")
+            records.append({'dataset_type': dataset_type, 'rep': rep, 'output': output_path,
+                            'returncode': 0 if ok else 1, 'ok': ok,
+                            'wall_time': time.perf_counter() - start, 'log': log_path})
+        proc.stdin.close()
+        for line in proc.stdout:
+            log.write(line)
+        _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    for r in records:
+        r['peak_rss'] = usage.ru_maxrss * 1024
+        if not r['ok'] and not alive:
+            r['returncode'] = proc.returncode or 1
+    return records
+
+def generate_in_sessions(sc_input, jobs, outdir, annot, workers, base_seed=0, mem_per_job=None, log_dir=None):
+    """Session engine: `workers` R processes load the reference once each and share the job queue."""
+    pending = queue.Queue()
+    for dataset_type, rep in jobs:
+        pending.put((dataset_type, rep, job_seed(base_seed, dataset_type, rep)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_generation_session, sc_input, pending, outdir, annot,
+                               mem_per_job=mem_per_job, log_dir=log_dir, worker=w) for w in range(workers)]
+        records = [r for f in futures for r in f.result()]
+    # Jobs left over when every worker died (e.g. the reference could not be loaded).
+    while not pending.empty():
+        dataset_type, rep, _ = pending.get()
+        records.append({'dataset_type': dataset_type, 'rep': rep, 'returncode': 1, 'ok': False, 'wall_time': 0.0,
+                        'peak_rss': 0, 'output': os.path.join(outdir, f"{os.path.basename(sc_input).split('.')[0]}_{dataset_type}_rep{rep}.rds"),
+                        'log': os.path.join(log_dir or outdir, "session_worker0.log")})
+    order = {job: i for i, job in enumerate(jobs)}
+    return sorted(records, key=lambda r: order[(r['dataset_type'], r['rep'])])
+
+def print_job_summary(records):
+    print(f"\n{'dataset_type':<50} {'rep':>4} {'status':>8} {'wall (s)':>10} {'peak RSS (MB)':>14}")
+    for r in records:
+        status = 'ok' if r['ok'] else f"exit {r['returncode']}"
+        print(f"{r['dataset_type']:<50} {r['rep']:>4} {status:>8} {r['wall_time']:>10.1f} {r['peak_rss'] / 1024 ** 2:>14.0f}")
 
 def list_to_dict(flat_list):
     flat_list[0] = flat_list[0].replace("{", "")
@@ -80,8 +241,6 @@ def list_to_dict(flat_list):
 
 if __name__ == "__main__":
     import ast
-    import os
-    import sys  
     # Get all command-line arguments
     args = sys.argv
     config  = list_to_dict(args[1:])
@@ -94,6 +253,15 @@ if __name__ == "__main__":
     sc_input_type = 'h5ad' if sc_input.endswith(('h5', 'h5ad')) else 'rds'
     print(f"The synthetic data is of {sc_input_type} format.")
 
+    engine = config.get("engine", "rscript")
+    if engine == "python":
+        # The sampler writes one directory per dataset: neither the .rds outputs of the rule nor
+        # what run_dataset reads. It runs on its own, outside the pipeline.
+        sys.exit("engine: python is not available in the pipeline (its datasets are directories, not the .rds "
+                 "files of the rule). Run subworkflows/data_generation/synthspot_sampler.py directly instead.")
+    if engine not in ("rscript", "session"):
+        sys.exit(f"Unknown engine {engine}, expected rscript or session")
+
     sc_input_conv = sc_input
     if sc_input_type == 'h5ad':
         sc_input_conv = convert_between_rds_and_h5ad(sc_input_conv)
@@ -102,17 +270,42 @@ if __name__ == "__main__":
     synthspot_type_input = list(dict.fromkeys(synthspot_type_input))
 
     # synthspot_args_input = params.args
-    synthspot_args_input =  ' '.join([f"--{k} {v}" for k, v in config.items() if k not in ["dataset_type", "reps", "sc_input"]])
+    synthspot_args_input =  ' '.join([f"--{k} {v}" for k, v in config.items() if k not in ["dataset_type", "reps", "sc_input", "workers", "mem_per_job", "engine", "seed", "conversion_cache", "conversion_cache_size"]])
 
     print(f"Single-cell reference: {sc_input}")
     print(f"Dataset types to be generated: {', '.join(synthspot_type_input)}")
     print(f"Number of replicates per dataset type: {reps}")
     print(f"Arguments: {synthspot_args_input}")
 
-    import subprocess
+    jobs = []
     for dataset_type in synthspot_type_input:
         for rep in range(1, int(reps) + 1):
             output_file = f"{os.path.splitext(os.path.basename(sc_input))[0]}_{dataset_type}_rep{rep}.rds"
             output_path = os.path.join(out_dir, output_file)
             if not os.path.exists(output_path):
-                generate_synthetic_data(sc_input_conv, dataset_type, rep, out_dir, synthspot_args_input)
+                jobs.append((dataset_type, rep))
+    if not jobs:
+        print("All synthetic datasets already exist.")
+        sys.exit(0)
+
+    mem_per_job = parse_memory(config.get("mem_per_job"))
+    workers = effective_workers(config.get("workers"), mem_per_job, len(jobs))
+    print(f"Generating {len(jobs)} datasets with {workers} {engine} workers"
+          + (f", {config['mem_per_job']} per job" if mem_per_job else "") + " ...")
+
+    os.makedirs(out_dir, exist_ok=True)
+    log_dir = os.path.join(out_dir, "logs")
+    if engine == "session":
+        records = generate_in_sessions(sc_input_conv, jobs, out_dir, synthspot_args_input, workers,
+                                       base_seed=config.get("seed", 0), mem_per_job=mem_per_job, log_dir=log_dir)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(generate_synthetic_data, sc_input_conv, dataset_type, rep, out_dir, synthspot_args_input,
+                                   base_seed=config.get("seed", 0), mem_per_job=mem_per_job, log_dir=log_dir)
+                       for dataset_type, rep in jobs]
+            records = [f.result() for f in futures]
+
+    print_job_summary(records)
+    failed = [r for r in records if not r['ok']]
+    if failed:
+        sys.exit(f"{len(failed)}/{len(records)} job(s) failed, see: " + ', '.join(dict.fromkeys(str(r['log']) for r in failed)))
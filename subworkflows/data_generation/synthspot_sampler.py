@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+
+Vectorized synthspot-style sampler: draws synthetic Visium spots from a single-cell reference
+with NumPy / SciPy, for scalability studies with millions of spots where the per-replicate
+generate_synthetic_data.R path is too slow.
+
+    python3 subworkflows/data_generation/synthspot_sampler.py --sc_input reference.h5ad \
+        --dataset_type artificial_uniform_distinct,artificial_dominant_celltype_diverse --reps 3 \
+        --output synthetic_data_np --n_spots_min 100000 --n_spots_max 200000 --seed 0
+
+Like synthspot, each dataset is made of regions with a prior cell type frequency vector (set by the
+dataset type); every spot gets n_cells_min..n_cells_max cells drawn from the prior of its region,
+the counts of these cells are summed and then downsampled to a N(visium_mean, visium_sd) depth.
+Spots are generated and written in chunks of --chunk_size spots, so memory does not grow with the
+number of spots. A dataset is a directory <reference>_<dataset_type>_rep<rep>/ with:
+
+    counts/part-00000.npz ...           spots x genes CSR counts, one file per chunk
+    genes.txt                           gene names (columns of the counts)
+    spot_composition.tsv                cells of each cell type per spot, with the spot name and region
+    relative_spot_composition.tsv       same, as proportions
+    gold_standard_priorregion.tsv       prior cell type frequencies of each region
+    dataset_properties.json             dataset type, seed, parameters, dominant / rare / missing cell types
+
+The same (seed, dataset_type, rep, chunk_size) gives the same dataset.
+"""
+import argparse as arp
+import json
+import os
+import shutil
+import sys
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+DATASET_TYPES = (
+    "artificial_uniform_distinct", "artificial_diverse_distinct",
+    "artificial_uniform_overlap", "artificial_diverse_overlap",
+    "artificial_dominant_celltype_diverse", "artificial_partially_dominant_celltype_diverse",
+    "artificial_dominant_rare_celltype_diverse", "artificial_regional_rare_celltype_diverse",
+    "prior_from_data", "real", "real_missing_celltypes_visium", "artificial_missing_celltypes_visium",
+    "artificial_diverse_distinct_missing_celltype_sc", "artificial_diverse_overlap_missing_celltype_sc",
+)
+REAL_TYPES = ("real", "real_missing_celltypes_visium")
+
+# Same defaults as generate_synthetic_data.R, plus the number of cells per spot of synthspot.
+DEFAULTS = {'n_regions': 5, 'n_spots_min': 50, 'n_spots_max': 500, 'n_spots': 250,
+            'visium_mean': 20000, 'visium_sd': 7000, 'n_cells_min': 2, 'n_cells_max': 10}
+DOMINANT_SHARE = (0.5, 0.8)
+RARE_SHARE = (0.01, 0.05)
+CHUNK_SIZE = 10000
+
+# counts: cells x genes CSR; cell_types / cell_regions: integer codes per cell into celltypes / regions
+Reference = namedtuple('Reference', 'counts genes celltypes cell_types regions cell_regions')
+
+
+def load_reference(sc_input, clust_var='celltype', region_var=None):
+    """Raw counts and annotations of an h5ad (counts in .X) or Seurat .rds reference."""
+    if sc_input.lower().endswith('.rds'):
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deconvolution'))
+        from rds_reader import read_counts
+
+        counts, obs, genes = read_counts(sc_input)
+    else:
+        import anndata
+
+        adata = anndata.read_h5ad(sc_input)
+        counts, obs, genes = adata.X, adata.obs, list(adata.var_names)
+    annotated = obs[clust_var].notna().to_numpy()  # cells without a cell type cannot be drawn
+    counts, obs = sp.csr_matrix(counts, dtype=np.float32)[annotated], obs[annotated]
+    cell_types = pd.Categorical(obs[clust_var].astype(str))
+    if region_var and region_var in obs.columns:
+        cell_regions = pd.Categorical(obs[region_var].astype(object).fillna('NA').astype(str))
+        regions, region_codes = list(cell_regions.categories), cell_regions.codes.astype(np.int64)
+    else:
+        regions, region_codes = [], None
+    return Reference(counts, list(genes), list(cell_types.categories),
+                     cell_types.codes.astype(np.int64), regions, region_codes)
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       REGION PRIORS                                     !>
+# <! ------------------------------------------------------------------------!>
+
+def _presence(kind, n_regions, n_types, rng):
+    """Cell types present in each region: each type in one region (distinct), random subsets (overlap) or all."""
+    present = np.zeros((n_regions, n_types), dtype=bool)
+    if kind == 'distinct':
+        for r, types in enumerate(np.array_split(rng.permutation(n_types), n_regions)):
+            present[r, types if len(types) else rng.integers(n_types)] = True
+    elif kind == 'overlap':
+        for r in range(n_regions):
+            k = rng.integers(min(2, n_types), n_types + 1)
+            present[r, rng.choice(n_types, k, replace=False)] = True
+    else:
+        present[:] = True
+    return present
+
+
+def _set_share(priors, regions, celltype, share):
+    """Give celltype the fraction `share` of the cells of each region in `regions`, rescaling the others."""
+    rows = priors[regions]
+    rows[:, celltype] = 0
+    rows *= ((1 - share) / rows.sum(axis=1))[:, None]
+    rows[:, celltype] = share
+    priors[regions] = rows
+
+
+def _drop_celltypes(priors, celltypes, available=None):
+    """Remove celltypes from the priors. A region left without cell types gets a uniform prior over the
+    other types present in it (available: regions x cell types with reference cells), or, when it has
+    none, over all the remaining types (their cells are then drawn from the whole reference)."""
+    priors[:, celltypes] = 0
+    empty = priors.sum(axis=1) == 0
+    keep = np.ones(priors.shape, dtype=bool)
+    keep[:, celltypes] = False
+    if available is not None:
+        local = keep & available
+        keep = np.where(local.any(axis=1, keepdims=True), local, keep)
+    priors[empty] = keep[empty]
+
+
+def region_priors(dataset_type, n_types, n_regions, rng, reference_priors=None):
+    """Prior cell type frequencies (regions x cell types, rows summing to 1) of a dataset type, and the
+    cell types it singles out (indices into the cell types)."""
+    info = {}
+    if dataset_type == 'prior_from_data' or dataset_type in REAL_TYPES:
+        priors = np.array(reference_priors, dtype=np.float64)
+        if dataset_type == 'real_missing_celltypes_visium':
+            info['missing_celltypes_visium'] = rng.choice(n_types, max(1, n_types // 4), replace=False)
+            _drop_celltypes(priors, info['missing_celltypes_visium'], np.asarray(reference_priors) > 0)
+        return priors / priors.sum(axis=1, keepdims=True), info
+
+    kind = 'distinct' if 'distinct' in dataset_type else 'overlap' if 'overlap' in dataset_type else 'all'
+    if dataset_type == 'artificial_missing_celltypes_visium':
+        kind = 'overlap'
+    present = _presence(kind, n_regions, n_types, rng)
+    if 'uniform' in dataset_type:
+        priors = present.astype(np.float64)
+    else:
+        priors = rng.uniform(0.01, 1, size=present.shape) * present
+
+    if 'dominant' in dataset_type or 'rare' in dataset_type:
+        picked = rng.choice(n_types, 2 if n_types > 1 else 1, replace=False)
+        all_regions = np.arange(n_regions)
+        if 'dominant' in dataset_type:
+            info['dominant_celltype'] = picked[:1]
+            regions = all_regions
+            if 'partially' in dataset_type and n_regions > 1:
+                regions = rng.choice(n_regions, rng.integers(1, n_regions), replace=False)
+            _set_share(priors, regions, picked[0], rng.uniform(*DOMINANT_SHARE, size=len(regions)))
+        if 'rare' in dataset_type and n_types > 1:
+            info['rare_celltype'] = picked[1:]
+            regions = all_regions if 'dominant' in dataset_type else rng.choice(n_regions, 1)
+            if 'regional' in dataset_type:
+                priors[:, picked[1]] = 0
+            _set_share(priors, regions, picked[1], rng.uniform(*RARE_SHARE, size=len(regions)))
+    if dataset_type == 'artificial_missing_celltypes_visium':
+        info['missing_celltypes_visium'] = rng.choice(n_types, max(1, n_types // 4), replace=False)
+        _drop_celltypes(priors, info['missing_celltypes_visium'])
+    if dataset_type.endswith('_missing_celltype_sc'):
+        # Present in the spots, to be removed from the reference given to the methods.
+        info['missing_celltypes_sc'] = rng.choice(np.flatnonzero(priors.sum(axis=0) > 0), 1)
+    return priors / priors.sum(axis=1, keepdims=True), info
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       SPOT SAMPLING                                     !>
+# <! ------------------------------------------------------------------------!>
+
+def cell_pools(reference, per_region):
+    """Reference cells grouped by cell type (or by region x cell type, followed by one group per cell type
+    over all the regions): order, start and size of each group."""
+    n_types = len(reference.celltypes)
+    groups = reference.cell_types
+    if per_region:
+        groups = np.concatenate([reference.cell_regions * n_types + groups, len(reference.regions) * n_types + groups])
+    n_groups = (len(reference.regions) + 1 if per_region else 1) * n_types
+    sizes = np.bincount(groups, minlength=n_groups)
+    return np.argsort(groups, kind='stable') % len(reference.cell_types), np.cumsum(sizes) - sizes, sizes
+
+
+def sample_spots(reference, priors, spot_regions, pools, rng, per_region=False, visium_mean=20000, visium_sd=7000,
+                 n_cells_min=2, n_cells_max=10):
+    """Counts (spots x genes CSR) and cell type composition (spots x cell types) of one chunk of spots."""
+    n_spots, n_types = len(spot_regions), priors.shape[1]
+    order, starts, sizes = pools
+    # Batched multinomial: the cells of every spot of the chunk in one call.
+    n_cells = rng.integers(n_cells_min, n_cells_max + 1, size=n_spots)
+    composition = rng.multinomial(n_cells, priors[spot_regions])
+    spot_idx, type_idx = np.nonzero(composition)
+    repeats = composition[spot_idx, type_idx]
+    rows, types = np.repeat(spot_idx, repeats), np.repeat(type_idx, repeats)
+    groups = types
+    if per_region:
+        # A type without cells in the region of the spot (see _drop_celltypes) comes from the whole reference
+        groups = spot_regions[rows] * n_types + types
+        groups = np.where(sizes[groups] > 0, groups, len(sizes) - n_types + types)
+    assert (sizes[groups] > 0).all(), "cell types sampled without any reference cell"
+    cells = order[starts[groups] + (rng.random(len(groups)) * sizes[groups]).astype(np.int64)]
+    # spots x cells assignment matrix (duplicates add up) times the cells x genes counts.
+    assignment = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cells)),
+                               shape=(n_spots, reference.counts.shape[0]))
+    counts = (assignment @ reference.counts).tocsr()
+    counts.data = np.rint(counts.data)
+
+    # Downsampling to the Visium depth: binomial thinning of every count with p = target / total.
+    target = np.maximum(rng.normal(visium_mean, visium_sd, size=n_spots), 1)
+    totals = np.asarray(counts.sum(axis=1)).ravel()
+    keep = np.minimum(1, target / np.maximum(totals, 1))
+    counts.data = rng.binomial(counts.data.astype(np.int64), np.repeat(keep, np.diff(counts.indptr)))
+    counts = sp.csr_matrix(counts, dtype=np.int32)
+    counts.eliminate_zeros()
+    return counts, composition
+
+
+def dataset_rng(seed, dataset_type, rep):
+    return np.random.default_rng([int(seed), zlib.crc32(dataset_type.encode()), int(rep)])
+
+
+def dataset_name(sc_input, dataset_type, rep):
+    return f"{os.path.basename(sc_input).split('.')[0]}_{dataset_type}_rep{rep}"
+
+
+def generate_dataset(reference, dataset_type, rep, output_dir, sc_input='reference', seed=0, chunk_size=CHUNK_SIZE,
+                     compress=False, **params):
+    """Sample one dataset and stream it to <output_dir>/<reference>_<dataset_type>_rep<rep>/ chunk by chunk;
+    returns its directory. The dataset is written under a temporary name and renamed when complete."""
+    if dataset_type not in DATASET_TYPES:
+        raise ValueError(f"Unknown dataset type {dataset_type}, expected one of {', '.join(DATASET_TYPES)}")
+    params = {k: type(v)(float(params[k])) if params.get(k) is not None else v for k, v in DEFAULTS.items()}
+    rng = dataset_rng(seed, dataset_type, rep)
+    n_types = len(reference.celltypes)
+    per_region = dataset_type in REAL_TYPES
+    if per_region and reference.cell_regions is None:
+        raise ValueError(f"Dataset type {dataset_type} needs the region_var column in the reference")
+
+    if per_region:
+        reference_priors = np.zeros((len(reference.regions), n_types))
+        np.add.at(reference_priors, (reference.cell_regions, reference.cell_types), 1)
+        region_names = list(reference.regions)
+    elif dataset_type == 'prior_from_data':
+        reference_priors = np.bincount(reference.cell_types, minlength=n_types)[None, :]
+        region_names = ['priorregion1']
+    else:
+        reference_priors = None
+        region_names = [f"priorregion{r + 1}" for r in range(params['n_regions'])]
+    priors, info = region_priors(dataset_type, n_types, len(region_names), rng, reference_priors)
+
+    if dataset_type == 'prior_from_data':
+        spots_per_region = np.array([params['n_spots']])
+    else:
+        spots_per_region = rng.integers(params['n_spots_min'], params['n_spots_max'] + 1, size=len(region_names))
+    spot_regions = np.repeat(np.arange(len(region_names)), spots_per_region)
+    pools = cell_pools(reference, per_region)
+
+    final_dir = os.path.join(output_dir, dataset_name(sc_input, dataset_type, rep))
+    tmp_dir = final_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_dir, 'counts'))
+    with open(os.path.join(tmp_dir, 'genes.txt'), 'w') as f:
+        f.write('\n'.join(reference.genes) + '\n')
+    pd.DataFrame(priors, index=region_names, columns=reference.celltypes).to_csv(
+        os.path.join(tmp_dir, 'gold_standard_priorregion.tsv'), sep='\t')
+
+    for part, start in enumerate(range(0, len(spot_regions), chunk_size)):
+        regions = spot_regions[start:start + chunk_size]
+        counts, composition = sample_spots(
+            reference, priors, regions, pools, rng, per_region=per_region,
+            visium_mean=params['visium_mean'], visium_sd=params['visium_sd'],
+            n_cells_min=params['n_cells_min'], n_cells_max=params['n_cells_max'])
+        sp.save_npz(os.path.join(tmp_dir, 'counts', f"part-{part:05d}.npz"), counts, compressed=compress)
+        meta = pd.DataFrame({'name': [f"spot_{i + 1}" for i in range(start, start + len(regions))],
+                             'region': np.asarray(region_names, dtype=object)[regions]})
+        for filename, values in (('spot_composition.tsv', composition),
+                                 ('relative_spot_composition.tsv', composition / composition.sum(axis=1, keepdims=True))):
+            frame = pd.concat([pd.DataFrame(values, columns=reference.celltypes), meta], axis=1)
+            frame.to_csv(os.path.join(tmp_dir, filename), sep='\t', index=False, mode='a', header=part == 0)
+
+    properties = {'dataset_type': dataset_type, 'rep': int(rep), 'seed': int(seed), 'chunk_size': int(chunk_size),
+                  **params, 'n_spots': int(len(spot_regions)), 'n_genes': len(reference.genes), 'regions': region_names,
+                  **{k: [reference.celltypes[i] for i in v] for k, v in info.items()}}
+    with open(os.path.join(tmp_dir, 'dataset_properties.json'), 'w') as f:
+        json.dump(properties, f, indent=1)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.rename(tmp_dir, final_dir)
+    return final_dir
+
+
+def read_dataset(path):
+    """Counts (spots x genes CSR), gene names, relative composition and properties of a sampled dataset."""
+    parts = sorted(os.listdir(os.path.join(path, 'counts')))
+    counts = sp.vstack([sp.load_npz(os.path.join(path, 'counts', p)) for p in parts], format='csr')
+    with open(os.path.join(path, 'genes.txt')) as f:
+        genes = f.read().split()
+    with open(os.path.join(path, 'dataset_properties.json')) as f:
+        properties = json.load(f)
+    composition = pd.read_csv(os.path.join(path, 'relative_spot_composition.tsv'), sep='\t')
+    return counts, genes, composition, properties
+
+
+if __name__ == "__main__":
+    prs = arp.ArgumentParser()
+    prs.add_argument('--sc_input', required=True, help='single-cell reference (h5ad with raw counts in .X, or Seurat rds)')
+    prs.add_argument('--dataset_type', required=True, help='comma separated dataset types')
+    prs.add_argument('--reps', type=int, default=1, help='replicates per dataset type')
+    prs.add_argument('--output', default='.', help='output directory')
+    prs.add_argument('--clust_var', default='celltype', help='cell type column of the reference')
+    prs.add_argument('--region_var', default=None, help='region column of the reference (real dataset types)')
+    prs.add_argument('--seed', type=int, default=0)
+    prs.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='spots generated and written at a time')
+    prs.add_argument('--compress', action='store_true', help='zlib-compress the count chunks (smaller, several times slower)')
+    for key, value in DEFAULTS.items():
+        prs.add_argument(f'--{key}', type=type(value), default=value)
+    args = prs.parse_args()
+
+    reference = load_reference(args.sc_input, args.clust_var, args.region_var)
+    params = {k: getattr(args, k) for k in DEFAULTS}
+    for dataset_type in args.dataset_type.split(','):
+        for rep in range(1, args.reps + 1):
+            start = time.perf_counter()
+            path = generate_dataset(reference, dataset_type, rep, args.output, seed=args.seed,
+                                    sc_input=args.sc_input, chunk_size=args.chunk_size, compress=args.compress, **params)
+            print(f"{path} ({time.perf_counter() - start:.1f} s)")
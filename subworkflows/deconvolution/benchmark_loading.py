@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+
+Peak memory of loading an input the way the method scripts used to (read fully, then .copy() at
+each subsetting step and a .raw copy, as cell2location/fit_model.py did) versus through
+lazy_input.py (opened backed, subset decided on var, materialized once). Each pattern runs in its
+own process; the peak RSS is the ru_maxrss of that process.
+
+    python3 subworkflows/deconvolution/benchmark_loading.py reference.h5ad --keep 0.5
+"""
+import argparse as arp
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy(path, keep):
+    from rds_reader import read_input
+
+    adata = read_input(path)
+    adata.var['mt'] = [g.lower().startswith('mt-') for g in adata.var_names]
+    adata = adata[:, ~adata.var['mt'].values].copy()
+    adata_vis = adata.copy()
+    adata_vis.raw = adata_vis
+    genes = adata_vis.var_names[:int(adata_vis.n_vars * keep)]
+    return adata_vis[:, genes].copy()
+
+
+def lazy(path, keep):
+    from lazy_input import open_input, materialize
+
+    adata = open_input(path)
+    genes = adata.var_names[~adata.var_names.str.lower().str.startswith('mt-')]
+    return materialize(adata, genes=genes[:int(len(genes) * keep)])
+
+
+def measure(pattern, path, keep):
+    """(seconds, peak RSS in MB) of one pattern, run in a child process."""
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), path, '--keep', str(keep),
+                             '--run', pattern])
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise SystemExit(f"{pattern} loading failed")
+    return time.perf_counter() - start, rusage.ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    prs = arp.ArgumentParser()
+    prs.add_argument('input', type=str, help='.h5ad or .rds input (e.g. the largest reference)')
+    prs.add_argument('--keep', type=float, default=0.5, help='fraction of the genes kept by the final subset')
+    prs.add_argument('--run', choices=['legacy', 'lazy'], default=None, help=arp.SUPPRESS)
+    args = prs.parse_args()
+
+    if args.run:
+        adata = {'legacy': legacy, 'lazy': lazy}[args.run](args.input, args.keep)
+        print(f"{args.run}: {adata.n_obs} x {adata.n_vars}", flush=True)
+    else:
+        results = {pattern: measure(pattern, args.input, args.keep) for pattern in ('legacy', 'lazy')}
+        for pattern, (seconds, rss) in results.items():
+            print(f"{pattern:>7}: {seconds:7.1f} s  peak RSS {rss:9.0f} MB")
+        print(f"peak RSS ratio legacy / lazy: {results['legacy'][1] / results['lazy'][1]:.2f}")
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark of the marker gene computation of markers.py against sc.tl.rank_genes_groups, on
+synthetic log-normalized references (sparse negative binomial counts, a few up-regulated genes
+per cell type). Reports the time of each backend and the overlap of their top markers.
+
+    python3 subworkflows/deconvolution/benchmark_markers.py --cells 10000,100000 --genes 5000
+    python3 subworkflows/deconvolution/benchmark_markers.py --cells 1000000 --max_cells 2000 --no_scanpy
+"""
+import argparse as arp
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+import markers
+
+
+def synthetic_reference(n_cells, n_genes=5000, n_types=20, n_markers=100, seed=0):
+    """Log-normalized CSR reference and its cell-type labels."""
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, n_types, n_cells)
+    base = rng.gamma(0.3, 1.0, n_genes)
+    up = np.ones((n_types, n_genes))
+    for t in range(n_types):
+        up[t, rng.choice(n_genes, n_markers, replace=False)] = rng.uniform(3, 10, n_markers)
+    rows = []
+    for start in range(0, n_cells, 20000):
+        mu = base * up[labels[start:start + 20000]]
+        counts = rng.negative_binomial(2, 2 / (2 + mu)).astype(np.float32)
+        rows.append(sp.csr_matrix(counts))
+    X = sp.vstack(rows, format='csr')
+    totals = np.asarray(X.sum(axis=1)).ravel()
+    X = sp.diags(np.divide(1e4, totals, out=np.zeros_like(totals), where=totals > 0).astype(np.float32)) @ X
+    X.data = np.log1p(X.data)
+    return X, np.array([f"type{t}" for t in labels])
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def overlap(a, b):
+    """Mean fraction of shared genes between the top markers of the same group."""
+    return np.mean([len(set(a[c]) & set(b[c])) / len(a[c]) for c in a.columns])
+
+
+if __name__ == "__main__":
+    prs = arp.ArgumentParser()
+    prs.add_argument('--cells', type=str, default='10000,100000', help='comma-separated numbers of cells')
+    prs.add_argument('--genes', type=int, default=5000)
+    prs.add_argument('--types', type=int, default=20)
+    prs.add_argument('--n_genes', type=int, default=100, help='markers per cell type')
+    prs.add_argument('--max_cells', type=int, default=None, help='cells per type of the subsampled fast run')
+    prs.add_argument('--no_scanpy', action='store_true', help='only time the fast backend')
+    args = prs.parse_args()
+
+    rows = []
+    for n_cells in map(int, args.cells.split(',')):
+        X, labels = synthetic_reference(n_cells, args.genes, args.types, args.n_genes)
+        genes = [f"gene{j}" for j in range(args.genes)]
+        adata = None
+        if not args.no_scanpy:
+            import anndata
+            adata = anndata.AnnData(X=X, obs=pd.DataFrame({'celltype': labels}, index=[str(i) for i in range(n_cells)]),
+                                    var=pd.DataFrame(index=genes))
+        for method in ('t-test', 'wilcoxon'):
+            row = {'cells': n_cells, 'method': method}
+            row['fast_s'], fast = timed(markers.rank_genes_groups, X, labels, genes, method, args.n_genes)
+            if args.max_cells:
+                row['fast_subsampled_s'], sub = timed(markers.rank_genes_groups, X, labels, genes, method,
+                                                      args.n_genes, args.max_cells)
+                row['subsampled_overlap'] = overlap(fast, sub)
+            if adata is not None:
+                row['scanpy_s'], ref = timed(markers.scanpy_rank_genes_groups, adata, 'celltype', method, args.n_genes)
+                row['speedup'] = row['scanpy_s'] / row['fast_s']
+                row['overlap'] = overlap(ref, fast)
+            rows.append(row)
+            print(pd.DataFrame([row]).to_string(index=False, float_format='%.3f'), flush=True)
+    print()
+    print(pd.DataFrame(rows).to_string(index=False, float_format='%.3f'))
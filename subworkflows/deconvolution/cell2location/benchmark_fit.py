@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+
+CPU time of fitting N spatial sections one process each (the per-sample path of run_fit.py) versus
+one batched Cell2location model over all of them (fit_model.py with comma-separated sections), and
+agreement of their proportions. CPU time is user + system time of the fit processes (os.wait4).
+
+    python3 subworkflows/deconvolution/cell2location/benchmark_fit.py signatures.npz s1.h5ad s2.h5ad ... \\
+        --cuda_device cpu --epochs 30000 --out bench_fit
+"""
+import argparse as arp
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from fit_model import section_names
+
+FIT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fit_model.py")
+
+
+def run_fit(sp_paths, signatures, out_dir, cuda_device, fit_args):
+    """(wall seconds, CPU seconds) of one fit_model.py process."""
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, FIT_SCRIPT, ",".join(sp_paths), signatures, cuda_device,
+                             "-o", out_dir] + fit_args)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise SystemExit(f"fit_model.py failed on {', '.join(sp_paths)}")
+    return time.perf_counter() - start, rusage.ru_utime + rusage.ru_stime
+
+
+def agreement(per_sample, batched):
+    """Mean Pearson correlation of the proportions of the same spot in both fits."""
+    per_sample, batched = per_sample.align(batched, join='inner')
+    return np.mean([np.corrcoef(a, b)[0, 1] for a, b in zip(per_sample.to_numpy(), batched.to_numpy())])
+
+
+if __name__ == "__main__":
+    prs = arp.ArgumentParser()
+    prs.add_argument('signatures', type=str, help='reference signatures (.npz) or regression model h5ad')
+    prs.add_argument('sections', type=str, nargs='+', help='spatial sections (.h5ad or .rds)')
+    prs.add_argument('--cuda_device', type=str, default='cpu')
+    prs.add_argument('--epochs', type=int, default=30000)
+    prs.add_argument('--out', type=str, default='benchmark_fit')
+    args = prs.parse_args()
+
+    fit_args = ["-e", str(args.epochs)]
+    per_wall, per_cpu = 0.0, 0.0
+    for name, path in zip(section_names(args.sections), args.sections):
+        wall, cpu = run_fit([path], args.signatures, os.path.join(args.out, "per_sample", name), args.cuda_device,
+                            fit_args)
+        per_wall, per_cpu = per_wall + wall, per_cpu + cpu
+        print(f"{name}: {wall:.0f} s wall, {cpu / 3600:.3f} CPU h", flush=True)
+    batched_dir = os.path.join(args.out, "batched")
+    batch_wall, batch_cpu = run_fit(args.sections, args.signatures, batched_dir, args.cuda_device, fit_args)
+
+    print(f"\n{len(args.sections)} sections, {args.epochs} epochs")
+    print(f"per-sample: {per_wall / 3600:7.3f} h wall  {per_cpu / 3600:7.3f} CPU h")
+    print(f"   batched: {batch_wall / 3600:7.3f} h wall  {batch_cpu / 3600:7.3f} CPU h")
+    print(f"   CPU ratio per-sample / batched: {per_cpu / batch_cpu:.2f}")
+    for name in section_names(args.sections):
+        per_sample = pd.read_csv(os.path.join(args.out, "per_sample", name, "proportions.tsv"), sep="\t", index_col=0)
+        batched = pd.read_csv(os.path.join(batched_dir, f"proportions_{name}.tsv"), sep="\t", index_col=0)
+        print(f"{name}: spot-wise correlation of the proportions {agreement(per_sample, batched):.3f}")
@@ -11,6 +11,23 @@ def get_basename(file_path):
     return os.path.splitext(os.path.basename(file_path))[0]
 
 
+def filter_genes(adata, cell_count_cutoff=15, cell_percentage_cutoff2=0.05, nonz_mean_cutoff=1.12):
+    """cell2location.utils.filtering.filter_genes, on statistics streamed over blocks of cells
+    (the matrix of a backed input is never loaded) and without its plot."""
+    import numpy as np
+    from lazy_input import gene_stats
+
+    stats = gene_stats(adata)
+    adata.var['n_cells'] = stats['n_cells'].values
+    adata.var['nonz_mean'] = stats['sum'].values / stats['n_cells'].values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_cells, log_mean = np.log10(adata.var['n_cells'].values), np.log10(adata.var['nonz_mean'].values)
+    selected = (log_cells > np.log10(adata.n_obs * cell_percentage_cutoff2)) | (
+        (log_cells > np.log10(cell_count_cutoff)) & (log_mean > np.log10(nonz_mean_cutoff))
+    )
+    return adata.var_names[selected]
+
+
 def main():
     prs = arp.ArgumentParser()
 
@@ -66,6 +83,30 @@ def main():
         type=int,
         help='number of samples to take from the posterior distribution'
     )
+    prs.add_argument(
+        '--posterior_export',
+        default='samples',
+        choices=['samples', 'streamed'],
+        help='samples: export_posterior (all summaries); streamed: posterior means of the signatures only, '
+             'samples drawn --posterior_chunk at a time'
+    )
+    prs.add_argument(
+        '--posterior_chunk',
+        default=100,
+        type=int,
+        help='posterior samples drawn at once by the streamed export'
+    )
+    prs.add_argument(
+        '--signatures',
+        default=None,
+        type=str,
+        help='reference signatures output (.npz, default: signatures.npz in the output directory)'
+    )
+    prs.add_argument(
+        '--signatures_only',
+        action='store_true',
+        help='only write the signatures, not the model and its posterior h5ad'
+    )
 
     args = prs.parse_args()
     cuda_device = args.cuda_device
@@ -86,9 +127,14 @@ def main():
 
     print("Parameters\n==========")
     print("Training epochs: {}\nPosterior sampling: {}".format(args.epochs, args.posterior_sampling))
+    print("Posterior export: {}".format(args.posterior_export))
     print("==========")
 
-    import anndata
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from lazy_input import open_input, materialize  # .h5ad (backed) or .rds inputs
+    from signature_registry import GENE_FILTER, extract_signatures, save_signatures
+    from posterior_export import export_signatures
     import scanpy as sc  # noqa: F401
     import pandas as pd  # noqa: F401
     import numpy as np  # noqa: F401
@@ -101,25 +147,20 @@ def main():
     rcParams['pdf.fonttype'] = 42
     import seaborn as sns  # noqa: F401
 
-    from cell2location.utils.filtering import filter_genes
     from cell2location.models import RegressionModel
 
     import warnings
     warnings.filterwarnings('ignore')
 
     print("Reading scRNA-seq data from " + args.sc_data_path + "...")
-    adata_scrna_raw = anndata.read_h5ad(args.sc_data_path)
-    adata_scrna_raw.var['SYMBOL'] = adata_scrna_raw.var_names
+    adata_scrna_raw = open_input(args.sc_data_path, args.annotation_column)
 
     print("Before filtering: {} cells and {} genes.".format(*adata_scrna_raw.shape))
-    selected = filter_genes(
-        adata_scrna_raw,
-        cell_count_cutoff=5,
-        cell_percentage_cutoff2=0.03,
-        nonz_mean_cutoff=1.12
-    )
+    selected = filter_genes(adata_scrna_raw, **GENE_FILTER)
     print("After selecting genes.")
-    adata_scrna_raw = adata_scrna_raw[:, selected].copy()
+    # Only the selected genes are read into memory
+    adata_scrna_raw = materialize(adata_scrna_raw, genes=selected)
+    adata_scrna_raw.var['SYMBOL'] = adata_scrna_raw.var_names
 
     print("After filtering: {} cells and {} genes.".format(*adata_scrna_raw.shape))
     print("Preparing anndata for the regression model...")
@@ -142,14 +183,28 @@ def main():
         accelerator=accelerator
     )
 
-    print("Exporting posterior on CPU...")
-    adata_scrna_raw = mod.export_posterior(
-        adata_scrna_raw,
-        sample_kwargs={
-            'num_samples': args.posterior_sampling,
-            'batch_size': 2500
-        }
-    )
+    print("Exporting posterior ({})...".format(args.posterior_export))
+    if args.posterior_export == 'streamed':
+        adata_scrna_raw = export_signatures(mod, adata_scrna_raw, num_samples=args.posterior_sampling,
+                                            chunk=args.posterior_chunk, batch_size=2500)
+    else:
+        adata_scrna_raw = mod.export_posterior(
+            adata_scrna_raw,
+            sample_kwargs={
+                'num_samples': args.posterior_sampling,
+                'batch_size': 2500
+            }
+        )
+
+    # The fit only needs the signatures: a few MB, reused by every spatial sample of the reference
+    signatures_file = args.signatures or os.path.join(output_folder, "signatures.npz")
+    print("Saving reference signatures to " + signatures_file + "...")
+    save_signatures(extract_signatures(adata_scrna_raw), signatures_file, reference=os.path.abspath(args.sc_data_path),
+                    annot=args.annotation_column, sample_column=args.sample_column, tech_column=args.tech_column,
+                    epochs=args.epochs, posterior_sampling=args.posterior_sampling)
+    if args.signatures_only:
+        print("Done.")
+        return
 
     print("Saving model...")
     mod.save(output_folder, overwrite=True)
@@ -1,45 +1,51 @@
 #!/usr/bin/env python3
 import argparse as arp
 import os
+import sys
+import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import early_stopping  # --early_stopping / --patience / --rel_tol
 
-try:
-    from pybiomart import Server
-except ImportError:
-    Server = None
 
-
-def convert_query_geneSymbol_to_ensemblID(adata):
+def convert_query_geneSymbol_to_ensemblID(var, species, release, store_dir):
+    """Ensembl IDs of the SYMBOL column of var, from the local mapping store of species / release
+    (gene_mapping.py; no network access). Genes without an ID are dropped."""
     import pandas as pd
+    from gene_mapping import map_symbols
 
-    if Server is None:
-        raise ImportError("pybiomart is required only when map_genes=true")
+    # On the var table only: the matrix is subset once afterwards
+    ensembl = map_symbols(var['SYMBOL'].values, species, release, store_dir)
+    var = var[pd.notna(ensembl)].copy()
+    var['ENSEMBL'] = ensembl[pd.notna(ensembl)]
+    var.index = pd.Index(var['ENSEMBL'].values)
+    var['features'] = var['ENSEMBL']
+    return var
 
-    server = Server(host='http://www.ensembl.org')
-    dataset = (
-        server.marts['ENSEMBL_MART_ENSEMBL']
-        .datasets['hsapiens_gene_ensembl']
-    )
 
-    gene_map = dataset.query(
-        attributes=['ensembl_gene_id', 'external_gene_name']
-    )
+def section_names(paths):
+    """Name of each section (file name without extension), made unique with a suffix."""
+    names = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+    return [n if names.count(n) == 1 else f"{n}_{i + 1}" for i, n in enumerate(names)]
 
-    adata.var['SYMBOL'] = adata.var_names
-    adata = adata[:, adata.var['SYMBOL'].isin(gene_map['Gene name'].values)].copy()
-    adata.var['ENSEMBL'] = adata.var['SYMBOL'].map(
-        dict(zip(gene_map['Gene name'], gene_map['Gene stable ID']))
-    )
-    adata.var_names = adata.var['ENSEMBL']
-    adata.var['features'] = adata.var['ENSEMBL']
-    return adata
+
+def minibatch_plan(n_obs, batch_size, epochs, lr, lr_end):
+    """plan_kwargs of a minibatched fit: ClippedAdam (clip_norm of cell2location) whose learning rate
+    decays geometrically from lr to lr * lr_end over the epochs * ceil(n_obs / batch_size) steps, so
+    that the noisy minibatch gradients settle by the end of training."""
+    import math
+    from pyro.optim import ClippedAdam
+
+    steps = max(1, epochs * math.ceil(n_obs / batch_size))
+    return {'optim': ClippedAdam({'lr': lr, 'clip_norm': 200, 'lrd': lr_end ** (1 / steps)})}
 
 
 def main():
     prs = arp.ArgumentParser()
 
-    prs.add_argument('sp_data_path', type=str, help='path of spatial data')
-    prs.add_argument('model_path', type=str, help='path to regression model')
+    prs.add_argument('sp_data_path', type=str,
+                     help='path of spatial data, or comma-separated paths of sections fitted in one model')
+    prs.add_argument('model_path', type=str, help='reference signatures (.npz) or regression model h5ad')
     prs.add_argument('cuda_device', type=str, help='index of cuda device ID or cpu')
 
     prs.add_argument(
@@ -60,6 +66,19 @@ def main():
         type=int,
         help='number of samples to take from the posterior distribution'
     )
+    prs.add_argument(
+        '--posterior_export',
+        default='samples',
+        choices=['samples', 'streamed', 'quantiles'],
+        help='samples: export_posterior over all spots at once; streamed: posterior samples drawn per '
+             'batch of spots, only q05 kept; quantiles: q05 from the guide, no sampling'
+    )
+    prs.add_argument(
+        '--posterior_batch',
+        default=2048,
+        type=int,
+        help='spots per batch of the streamed / quantiles posterior export'
+    )
     prs.add_argument(
         '-n', '--n_cells_per_location',
         default=8,
@@ -72,19 +91,56 @@ def main():
         type=int,
         help='within-experiment variation in RNA detection sensitivity'
     )
+    prs.add_argument(
+        '-b', '--batch_size',
+        default=None,
+        type=int,
+        help='spots per minibatch (default: full batch, all the data on the device at once)'
+    )
+    prs.add_argument(
+        '--lr',
+        default=0.002,
+        type=float,
+        help='learning rate'
+    )
+    prs.add_argument(
+        '--lr_end',
+        default=0.1,
+        type=float,
+        help='final learning rate of a minibatched fit, as a fraction of --lr (1: constant)'
+    )
     prs.add_argument(
         '-m', '--map_genes',
         default="false",
         type=str,
         help='map genes between single cell and spatial'
     )
+    prs.add_argument(
+        '--species',
+        default='hsapiens',
+        type=str,
+        help='species of the gene mapping store (map_genes)'
+    )
+    prs.add_argument(
+        '--ensembl_release',
+        default='latest',
+        type=str,
+        help='Ensembl release of the gene mapping store, or latest built (map_genes)'
+    )
+    prs.add_argument(
+        '--mapping_store',
+        default='.deconvolista_cache/gene_mappings',
+        type=str,
+        help='directory of the gene mapping stores built by gene_mapping.py'
+    )
+    early_stopping.add_arguments(prs, patience=1000)
 
     args = prs.parse_args()
 
     cuda_device = args.cuda_device
     print("cuda device requested =", cuda_device)
 
-    sp_data_path = args.sp_data_path
+    sp_paths = args.sp_data_path.split(',')
     output_folder = args.out_dir
 
     assert (cuda_device.isdigit() or cuda_device == "cpu"), "invalid device input"
@@ -98,51 +154,69 @@ def main():
     print("Training epochs: {}\nPosterior sampling: {}".format(
         args.epochs, args.posterior_sampling
     ))
+    print("Early stopping: {}".format(
+        f"patience {args.patience}, rel_tol {args.rel_tol}" if args.early_stopping else "off"))
+    print("Batch size: {}".format(args.batch_size or "full batch"))
+    print("Posterior export: {} (batches of {} spots)".format(args.posterior_export, args.posterior_batch))
     print("Map genes: {}".format(args.map_genes))
+    print("Sections: {}".format(len(sp_paths)))
     print("==========")
 
-    import scanpy as sc
-    import numpy as np
+    from lazy_input import open_input, materialize  # .h5ad (backed) or .rds inputs
+    from signature_registry import load_signatures
+    from posterior_export import export_abundance
+    import anndata
+    import scipy.sparse
     import cell2location
     from cell2location.models import Cell2location
 
     import warnings
     warnings.filterwarnings('ignore')
 
-    print("Reading in spatial data from " + sp_data_path + "...")
-    adata = sc.read_h5ad(sp_data_path)
-    adata.var['SYMBOL'] = adata.var_names
-
-    adata.var['mt'] = [gene.lower().startswith('mt-') for gene in adata.var['SYMBOL']]
-    adata = adata[:, ~adata.var['mt'].values].copy()
+    # Reference signatures: a registry entry (.npz) or the h5ad exported by a model build
+    print("Reading in the reference signatures...")
+    inf_aver = load_signatures(args.model_path)
 
-    adata_vis = adata.copy()
-    adata_vis.raw = adata_vis
+    # The genes kept are decided on var alone: only the final subset of the matrices is read
+    sections = []
+    for name, sp_data_path in zip(section_names(sp_paths), sp_paths):
+        print("Opening spatial data from " + sp_data_path + "...")
+        adata = open_input(sp_data_path)
+        adata.var['SYMBOL'] = adata.var_names
+        adata.var['mt'] = [gene.lower().startswith('mt-') for gene in adata.var['SYMBOL']]
+        genes = adata.var[~adata.var['mt'].values]
 
-    if str(args.map_genes).lower() == "true":
-        adata_vis = convert_query_geneSymbol_to_ensemblID(adata_vis)
-
-    print("Reading in the model...")
-    adata_scrna_raw = sc.read(args.model_path)
-
-    if 'means_per_cluster_mu_fg' in adata_scrna_raw.varm.keys():
-        inf_aver = adata_scrna_raw.varm['means_per_cluster_mu_fg'][
-            [f'means_per_cluster_mu_fg_{i}' for i in adata_scrna_raw.uns['mod']['factor_names']]
-        ].copy()
-    else:
-        inf_aver = adata_scrna_raw.var[
-            [f'means_per_cluster_mu_fg_{i}' for i in adata_scrna_raw.uns['mod']['factor_names']]
-        ].copy()
-
-    inf_aver.columns = adata_scrna_raw.uns['mod']['factor_names']
+        if str(args.map_genes).lower() == "true":
+            genes = convert_query_geneSymbol_to_ensemblID(genes, args.species, args.ensembl_release, args.mapping_store)
+        sections.append((name, adata, genes[~genes.index.duplicated()]))
 
     print("Finding shared genes...")
-    intersect = np.intersect1d(adata_vis.var_names, inf_aver.index)
-    adata_vis = adata_vis[:, intersect].copy()
-    inf_aver = inf_aver.loc[intersect, :].copy()
+    shared = inf_aver.index
+    for _, _, genes in sections:
+        shared = shared.intersection(genes.index)
+    shared = shared.sort_values()
+    inf_aver = inf_aver.loc[shared, :].copy()
+
+    parts = []
+    for name, adata, genes in sections:
+        part = materialize(adata, genes=genes.loc[shared, 'SYMBOL'].values)
+        part.var = genes.loc[shared]
+        part.obs['sample'] = name
+        parts.append(part)
+    multi = len(parts) > 1
+    if multi:
+        # One model for all the sections, the section being the batch (per-sample detection efficiency)
+        adata_vis = anndata.concat(parts, keys=[p.obs['sample'].iloc[0] for p in parts], index_unique='|')
+        adata_vis.var = parts[0].var.copy()
+    else:
+        adata_vis = parts[0]
+    del parts, sections
+    if args.batch_size and not scipy.sparse.issparse(adata_vis.X):
+        # Minibatches are then densified one at a time, the full-batch dense copy is never made
+        adata_vis.X = scipy.sparse.csr_matrix(adata_vis.X)
 
     print("Preparing anndata for cell2location...")
-    Cell2location.setup_anndata(adata=adata_vis)
+    Cell2location.setup_anndata(adata=adata_vis, batch_key='sample' if multi else None)
 
     print("Building cell2location model...")
     mod = cell2location.models.Cell2location(
@@ -152,35 +226,62 @@ def main():
         detection_alpha=args.detection_alpha
     )
 
+    plateau = early_stopping.from_args(args)
+    train_kwargs = early_stopping.train_kwargs(plateau)
+    if args.batch_size:
+        train_kwargs['plan_kwargs'] = minibatch_plan(adata_vis.n_obs, args.batch_size, args.epochs, args.lr,
+                                                     args.lr_end)
+
     print("Training cell2location model on", accelerator, "...")
+    start = time.perf_counter()
     mod.train(
         max_epochs=args.epochs,
-        batch_size=None,
+        batch_size=args.batch_size,
         train_size=1,
-        accelerator=accelerator
+        lr=args.lr,
+        accelerator=accelerator,
+        **train_kwargs
     )
-
-    print("Exporting posterior on CPU...")
-    adata_vis = mod.export_posterior(
+    seconds = time.perf_counter() - start
+    if plateau:
+        print(plateau.report(args.epochs))
+    epochs = len(mod.history['elbo_train'])
+    print("Trained {} epochs of {} spots in {:.0f} s: {:.0f} spots/s".format(
+        epochs, adata_vis.n_obs, seconds, epochs * adata_vis.n_obs / seconds))
+
+    print("Exporting posterior ({})...".format(args.posterior_export))
+    # Only the 5% quantile of the cell abundance is used
+    adata_vis = export_abundance(
+        mod,
         adata_vis,
-        sample_kwargs={
-            'num_samples': args.posterior_sampling,
-            'batch_size': mod.adata.n_obs
-        }
+        args.posterior_export,
+        num_samples=args.posterior_sampling,
+        batch_size=args.posterior_batch
     )
 
-    print("Writing proportions.tsv ...")
     props = adata_vis.obsm['q05_cell_abundance_w_sf'].copy()
     props = props.rename(
         columns={x: x.replace("q05cell_abundance_w_sf_", "") for x in props.columns}
     )
     props = props.div(props.sum(axis=1), axis='index')
 
-    props.to_csv(
-        os.path.join(output_folder, 'proportions.tsv'),
-        sep="\t",
-        index=True
-    )
+    if not multi:
+        print("Writing proportions.tsv ...")
+        props.to_csv(
+            os.path.join(output_folder, 'proportions.tsv'),
+            sep="\t",
+            index=True
+        )
+    else:
+        # One file per section, with the spot barcodes of its input
+        for name, section in props.groupby(adata_vis.obs['sample'].values, sort=False):
+            print(f"Writing proportions_{name}.tsv ...")
+            section.index = section.index.str.rsplit('|', n=1).str[0]
+            section.to_csv(
+                os.path.join(output_folder, f'proportions_{name}.tsv'),
+                sep="\t",
+                index=True
+            )
 
     print("Done.")
 
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-bounded posterior export for cell2location models. export_posterior draws num_samples values
+of every site over all the observations at once (num_samples x spots x cell types for the spatial
+model), then keeps summaries only. Here:
+
+- streamed_quantiles(): spatial model, posterior samples of one site drawn for one batch of spots
+  at a time, only the requested quantiles of each batch kept (the samples of a spot are all in its batch);
+- streamed_means(): global site of the reference model, samples drawn in chunks and averaged as they come;
+- guide_quantiles(): quantiles computed from the guide (export_posterior(use_quantiles=True)), no sampling.
+
+Memory is set by the batch (spots x samples x cell types) and chunk sizes, not by the dataset.
+"""
+import numpy as np
+import pandas as pd
+
+MODES = ['samples', 'streamed', 'quantiles']
+
+
+def _batches(mod, batch_size):
+    """Model arguments of consecutive batches of observations (in adata order), on the model device."""
+    from scvi.dataloaders import AnnDataLoader
+
+    for tensor_dict in AnnDataLoader(mod.adata_manager, shuffle=False, batch_size=batch_size):
+        args, kwargs = mod.module._get_fn_args_from_batch(tensor_dict)
+        yield [a.to(mod.device) for a in args], {k: v.to(mod.device) for k, v in kwargs.items()}
+
+
+def streamed_quantiles(mod, quantiles=(0.05,), site='w_sf', num_samples=1000, batch_size=2048):
+    """{q: observations x factors array} of posterior quantiles of an observation-plate site."""
+    mod.module.eval()
+    out = {q: np.empty((mod.adata.n_obs, len(mod.factor_names_)), dtype=np.float32) for q in quantiles}
+    start = 0
+    for args, kwargs in _batches(mod, batch_size):
+        samples = mod._get_posterior_samples(args, kwargs, num_samples=num_samples, return_sites=[site])[site]
+        samples = samples.reshape(num_samples, -1, samples.shape[-1])
+        stop = start + samples.shape[1]
+        for q, values in zip(quantiles, np.quantile(samples, quantiles, axis=0)):
+            out[q][start:stop] = values
+        start = stop
+        del samples
+    return out
+
+
+def streamed_means(mod, site='per_cluster_mu_fg', num_samples=1000, chunk=100, batch_size=2500):
+    """Posterior mean of a global site, from num_samples samples drawn `chunk` at a time."""
+    mod.module.eval()
+    args, kwargs = next(_batches(mod, batch_size))
+    total, drawn = 0.0, 0
+    while drawn < num_samples:
+        n = min(chunk, num_samples - drawn)
+        samples = mod._get_posterior_samples(args, kwargs, num_samples=n, return_sites=[site])[site]
+        total = total + samples.sum(axis=0, dtype=np.float64)
+        drawn += n
+    return np.squeeze(total / drawn)
+
+
+def export_abundance(mod, adata, mode, num_samples=1000, batch_size=2048, summaries=('q05',)):
+    """Cell abundance summaries (adata.obsm['<summary>_cell_abundance_w_sf'], as export_posterior names
+    them) of a Cell2location model, exported in `mode`:
+    samples (export_posterior, all spots at once), streamed or quantiles (guide quantiles)."""
+    if mode == 'samples':
+        return mod.export_posterior(adata, sample_kwargs={'num_samples': num_samples, 'batch_size': mod.adata.n_obs})
+    if mode == 'quantiles':
+        return mod.export_posterior(adata, sample_kwargs={'batch_size': batch_size},
+                                    add_to_obsm=list(summaries), use_quantiles=True)
+    quantiles = [float(f"0.{s[1:]}") for s in summaries]
+    values = streamed_quantiles(mod, quantiles, num_samples=num_samples, batch_size=batch_size)
+    for s, q in zip(summaries, quantiles):
+        adata.obsm[f"{s}_cell_abundance_w_sf"] = pd.DataFrame(
+            values[q], index=mod.adata.obs_names, columns=[f"{s}cell_abundance_w_sf_{f}" for f in mod.factor_names_]
+        ).loc[adata.obs_names]
+    adata.uns['mod'] = {'model_name': type(mod.module).__name__, 'factor_names': list(mod.factor_names_),
+                        'posterior_export': mode, 'num_samples': num_samples}
+    return adata
+
+
+def export_signatures(mod, adata, num_samples=1000, chunk=100, batch_size=2500):
+    """Reference model adata with the posterior means of the signatures only (varm['means_per_cluster_mu_fg']
+    and uns['mod']['factor_names'], as export_posterior writes them), from streamed_means()."""
+    factors = list(mod.factor_names_)
+    means = streamed_means(mod, num_samples=num_samples, chunk=chunk, batch_size=batch_size)
+    adata.varm['means_per_cluster_mu_fg'] = pd.DataFrame(
+        means.T, index=mod.adata.var_names, columns=[f"means_per_cluster_mu_fg_{f}" for f in factors]
+    ).loc[adata.var_names]
+    adata.uns['mod'] = {'model_name': type(mod.module).__name__, 'factor_names': factors,
+                        'posterior_export': 'streamed', 'num_samples': num_samples}
+    return adata
@@ -8,24 +8,31 @@ import yaml
 with open("subworkflows/deconvolution/cell2location/config.yaml", "r") as config_file:
     params = yaml.safe_load(config_file)
 
-def build_cell2location_model(sc_input, sp_input, output_dir, use_gpu, annot):
+def build_args():
+    """Build arguments of config.yaml, part of the registry key."""
+    return f"epochs={params['epoch_build']} {params.get('deconv_args', {}).get('cell2location', {}).get('build', '')}"
+
+
+def build_cell2location_model(sc_input, sp_input, output_dir, use_gpu, annot, signatures=None):
     """
     Build cell2location model.
     
     Args:
         sc_input (str): Path to single-cell input file.
+        signatures (str): Registry entry to write; only the signatures are kept when given.
     """
     tag_suffix = sc_input.split('/')[-1]
     sample_id_arg = f"-s {params['sampleID']}" if params['sampleID'] != "none" else ""
     epochs = f"-e {params['epoch_build']}" if params['epoch_build'] != "default" else ""
     args = params.get('deconv_args', {}).get('cell2location', {}).get('build', "")
     cuda_device = params["cuda_device"] if use_gpu == "true" else "cpu"
+    signatures_arg = f"--signatures {signatures} --signatures_only" if signatures else ""
     # p_parameter = f"-p 5"
     run_dev = 'GPU' if use_gpu == "true" else 'CPU'
     print(f"Building cell2location model with {run_dev}...")
     import os
     command = [
-        "bash", "-c", f"source activate cell2loc_env && python subworkflows/deconvolution/cell2location/build_model.py {sc_input} {sp_input} {cuda_device} -a {annot} {sample_id_arg} {epochs} {args} -o {output_dir} "
+        "bash", "-c", f"source activate cell2loc_env && python subworkflows/deconvolution/cell2location/build_model.py {sc_input} {sp_input} {cuda_device} -a {annot} {sample_id_arg} {epochs} {args} -o {output_dir} {signatures_arg}"
     ]
     print(command)
     subprocess.run(command, check=True)
@@ -42,7 +49,28 @@ if __name__ == "__main__":
     output_dir = args[3]
     use_gpu = args[4]
     annot = args[5]
+    output = args[6] if len(args) > 6 else None
 
     print()
-    build_cell2location_model(sc_input, sp_input, output_dir, use_gpu, annot)
+    if output is None:
+        build_cell2location_model(sc_input, sp_input, output_dir, use_gpu, annot)
+    else:
+        # Signatures of the registry entry of this reference, built on a miss, linked to the output
+        import shutil
+        import signature_registry
+
+        registry = args[7] if len(args) > 7 else signature_registry.DEFAULT_REGISTRY
+        entry = signature_registry.signature_path(sc_input, annot, sample_column=params["sampleID"],
+                                                  build_args=build_args(), registry=registry)
+        if os.path.exists(entry):
+            print(f"Reusing the reference signatures {entry}")
+        else:
+            build_cell2location_model(sc_input, sp_input, output_dir, use_gpu, annot, entry)
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        if os.path.exists(output):
+            os.remove(output)
+        try:
+            os.link(entry, output)
+        except OSError:
+            shutil.copyfile(entry, output)
   
\ No newline at end of file
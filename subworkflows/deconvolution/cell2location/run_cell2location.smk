@@ -1,4 +1,5 @@
 import os
+import sys
 import yaml
 import time
 
@@ -34,42 +35,32 @@ map_genes = get_config_var(config, "map_genes", "false")
 
 # Absolute path to the R script
 script_dir = os.path.dirname(os.path.abspath(__file__))
-convert_script = "subworkflows/deconvolution/convertBetweenRDSandH5AD.R"
 load_model = get_config_var(config, "load_model", "false") == 'true'
 
 # cbib image on GHCR: clean build with torch cu128 (needed for the 570-series GPU drivers / CUDA
-# 12.8 on Apollo) + pybiomart for map_genes. NB: ghcr-only for now to test the registry; the
+# 12.8 on Apollo) + pybiomart to build gene mapping stores. NB: ghcr-only for now to test the registry; the
 # local-sif override will be re-added later.
 c2l_image = "docker://ghcr.io/cbib/sp_cell2location:latest"
 
 
 if not load_model:
-    rule convertBetweenRDSandH5AD:
-        input:
-            sc_rds_file=sc_input,
-            sp_rds_file=sp_input
-        output:
-            sc_h5ad_file=temp(f"{get_basename(sc_input)}.h5ad"),
-            sp_h5ad_file=temp(f"{get_basename(sp_input)}.h5ad")
-        singularity:
-            "docker://csangara/seuratdisk:latest"
-        threads:
-            8
-        shell:
-            """
-            start_time=$(date +%s)
-            Rscript {convert_script} --input_path {input.sc_rds_file} --annot {annot}
-            Rscript {convert_script} --input_path {input.sp_rds_file} --annot {annot}
-            end_time=$(date +%s)
-            elapsed_time=$((end_time - start_time))
-            echo "convertBetweenRDSandH5AD took $elapsed_time seconds"
-            """
+    # Shared, cached conversions of the inputs, or the .rds files with read_rds=python
+    # (convert_h5ad.smk, included by run_methods.smk)
+    sc_h5ad_file = method_input(sc_input, annot)
+    sp_h5ad_file = method_input(sp_input, annot)
+    # Signature registry: the reference is built once per content, annotation and build arguments,
+    # and its signatures are reused by every spatial sample (and later runs). The job resolves the
+    # registry entry (hashing the reference there, not when the workflow is parsed) and links it to
+    # its output: registry entries are not outputs, so Snakemake never deletes them.
     rule build_cell2location:
         input:
-            rules.convertBetweenRDSandH5AD.output.sc_h5ad_file,
-            rules.convertBetweenRDSandH5AD.output.sp_h5ad_file
+            # The registry key already changes with the reference content
+            ancient(sc_h5ad_file)
         output:
-            temp(f"{output_dir}/sc_{get_basename(sc_input)}_{get_basename(sp_input)}.h5ad")
+            f"{output_dir}/signatures_cell2location_{get_basename(sc_input)}.npz"
+        params:
+            sp_name=sp_input,
+            registry=config.get("signature_registry", ".deconvolista_cache/cell2location_signatures")
         singularity:
             c2l_image
         threads:
@@ -80,14 +71,14 @@ if not load_model:
         shell:
             """
             start_time=$(date +%s)
-            /opt/conda/envs/cell2loc_env/bin/python subworkflows/deconvolution/cell2location/run_build.py {input[0]} {input[1]} {output_dir} {use_gpu} {annot}
+            /opt/conda/envs/cell2loc_env/bin/python subworkflows/deconvolution/cell2location/run_build.py {input[0]} {params.sp_name} {output_dir} {use_gpu} {annot} {output} {params.registry}
             end_time=$(date +%s)
             elapsed_time=$((end_time - start_time))
             echo "build_cell2location took $elapsed_time seconds"
             """
     rule fit_cell2location:
         input:
-            rules.convertBetweenRDSandH5AD.output.sp_h5ad_file,
+            sp_h5ad_file,
             model= rules.build_cell2location.output
         output:
             temp(f"{output_dir}/proportions_cell2location_{output_suffix}{runID_props}.preformat")
@@ -107,27 +98,11 @@ if not load_model:
             echo "fit_cell2location took $elapsed_time seconds"
             """
 else:
-    rule convertBetweenRDSandH5AD:
-        input:
-            sp_rds_file=sp_input
-        output:
-            sp_h5ad_file=temp(f"{get_basename(sp_input)}.h5ad")
-        singularity:
-            "docker://csangara/seuratdisk:latest"
-        threads:
-            8
-        shell:
-            """
-            start_time=$(date +%s)
-            Rscript {convert_script} --input_path {input.sp_rds_file} --annot {annot}
-            end_time=$(date +%s)
-            elapsed_time=$((end_time - start_time))
-            echo "convertBetweenRDSandH5AD took $elapsed_time seconds"
-            """
+    sp_h5ad_file = method_input(sp_input, annot)
     model_path  = config.get("model_path")
     rule fit_cell2location:
         input:
-            rules.convertBetweenRDSandH5AD.output.sp_h5ad_file,
+            sp_h5ad_file,
             model = model_path
         output:
             temp(f"{output_dir}/proportions_cell2location_{output_suffix}{runID_props}.preformat")
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of cell2location reference signatures (the means_per_cluster_mu_fg matrix exported by the
+RegressionModel, genes x cell types), so that the reference is built once for all the spatial samples.
+
+The signatures only depend on the reference content, the annotation, batch and technical columns,
+the gene filter and the training arguments: these make the key of an entry
+<registry>/<key>/signatures.npz (float32 values, gene and cell-type names). fit_model.py reads an
+entry, or the h5ad of a model built elsewhere (load_model / model_path).
+"""
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import conversion_cache
+
+DEFAULT_REGISTRY = ".deconvolista_cache/cell2location_signatures"
+# Gene filter of build_model.py (cell2location.utils.filtering.filter_genes thresholds)
+GENE_FILTER = {'cell_count_cutoff': 5, 'cell_percentage_cutoff2': 0.03, 'nonz_mean_cutoff': 1.12}
+
+
+def signature_path(sc_path, annot, sample_column=None, tech_column=None, build_args="",
+                   registry=DEFAULT_REGISTRY):
+    """Entry of the signatures of a reference built with these columns and arguments (may not exist yet)."""
+    fields = {'reference': conversion_cache.file_digest(sc_path, registry), 'annot': annot,
+              'sample_column': sample_column, 'tech_column': tech_column,
+              'build_args': " ".join(str(build_args).split()), 'gene_filter': GENE_FILTER}
+    key = hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:24]
+    return os.path.join(registry, key, "signatures.npz")
+
+
+def extract_signatures(adata):
+    """Signatures (genes x cell types) of the adata exported by RegressionModel.export_posterior."""
+    factors = adata.uns['mod']['factor_names']
+    columns = [f'means_per_cluster_mu_fg_{i}' for i in factors]
+    if 'means_per_cluster_mu_fg' in adata.varm.keys():
+        signatures = adata.varm['means_per_cluster_mu_fg'][columns].copy()
+    else:
+        signatures = adata.var[columns].copy()
+    signatures.columns = factors
+    return signatures
+
+
+def save_signatures(signatures, path, **meta):
+    """Write a signatures DataFrame as an entry (meta: provenance, stored in signatures.json)."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.npz"
+    np.savez(tmp, values=signatures.to_numpy(dtype=np.float32),
+             genes=np.asarray(signatures.index, dtype=str), cell_types=np.asarray(signatures.columns, dtype=str))
+    with open(os.path.join(os.path.dirname(path) or '.', 'signatures.json'), 'w') as f:
+        json.dump({'genes': signatures.shape[0], 'cell_types': list(map(str, signatures.columns)), **meta},
+                  f, indent=2, default=str)
+    os.replace(tmp, path)
+    return path
+
+
+def load_signatures(path):
+    """Signatures of a registry entry (.npz) or of an exported reference model (.h5ad)."""
+    if path.endswith('.npz'):
+        with np.load(path) as entry:
+            return pd.DataFrame(entry['values'], index=entry['genes'], columns=entry['cell_types'])
+    import anndata
+
+    return extract_signatures(anndata.read_h5ad(path))
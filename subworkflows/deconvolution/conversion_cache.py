@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of the RDS <-> h5ad conversions of convertBetweenRDSandH5AD.R.
+
+An entry is <cache_dir>/<key>/<name>.<ext>, where the key hashes the content of the input file
+and the annotation column: the same reference is converted once, whatever its path, the method
+or the run asking for it. Entries are evicted least recently used first when the cache grows
+over its size budget. Used by convert_h5ad.smk (deconvolution methods) and by
+data_generation/script.py.
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+DEFAULT_CACHE_DIR = ".deconvolista_cache/conversions"
+DEFAULT_MAX_SIZE = "100G"
+CONVERT_SCRIPT = "subworkflows/deconvolution/convertBetweenRDSandH5AD.R"
+LAST_USED = ".last_used"
+# Entries used more recently than this are never evicted: they may be read by a concurrent run
+MIN_AGE = 24 * 3600
+DIGESTS = "digests.json"
+
+
+def parse_size(value):
+    """'100G', '500M' or a number of bytes -> bytes; None (no limit) for empty / 'none'."""
+    if value in (None, '', 'None', 'none'):
+        return None
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def file_digest(path, cache_dir=DEFAULT_CACHE_DIR):
+    """sha256 of a file, remembered in <cache_dir>/digests.json against its size and mtime so that
+    a multi-GB reference is hashed once, not at every Snakemake parse."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    digests_path = os.path.join(cache_dir, DIGESTS)
+    try:
+        with open(digests_path) as f:
+            digests = json.load(f)
+    except (OSError, ValueError):
+        digests = {}
+    known = digests.get(path)
+    if known and known['stamp'] == stamp:
+        return known['sha256']
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 23), b''):
+            sha.update(block)
+    digests[path] = {'stamp': stamp, 'sha256': sha.hexdigest()}
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{digests_path}.{os.getpid()}"
+    with open(tmp, 'w') as f:
+        json.dump(digests, f)
+    os.replace(tmp, digests_path)
+    return digests[path]['sha256']
+
+
+def converted_name(path):
+    """File written by convertBetweenRDSandH5AD.R: first dot-separated part of the name, other extension."""
+    name, ext = os.path.basename(path).split('.')[0], os.path.basename(path).split('.')[-1].lower()
+    return f"{name}.h5ad" if ext == 'rds' else f"{name}.rds"
+
+
+def cache_path(path, annot, cache_dir=DEFAULT_CACHE_DIR):
+    """Cache entry of the conversion of `path` with the annotation column `annot` (may not exist yet)."""
+    key = hashlib.sha256(f"{file_digest(path, cache_dir)}\0{annot}".encode()).hexdigest()[:24]
+    return os.path.join(cache_dir, key, converted_name(path))
+
+
+def link_existing(entry_file):
+    """Same content already converted under another file name: hard link it to the expected name."""
+    entry = os.path.dirname(entry_file)
+    ext = os.path.splitext(entry_file)[1]
+    existing = [f for f in os.listdir(entry) if f.endswith(ext)] if os.path.isdir(entry) else []
+    if not existing:
+        return False
+    try:
+        os.link(os.path.join(entry, existing[0]), entry_file)
+    except OSError:
+        shutil.copyfile(os.path.join(entry, existing[0]), entry_file)
+    return True
+
+
+def touch(entry_file):
+    """Mark the entry of `entry_file` as just used (recency of the LRU eviction)."""
+    entry = os.path.dirname(entry_file)
+    os.makedirs(entry, exist_ok=True)
+    with open(os.path.join(entry, LAST_USED), 'w') as f:
+        f.write(str(time.time()))
+
+
+def _entries(cache_dir):
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if not os.path.isdir(entry) or name.startswith('.'):
+            continue
+        # Names of the same content are hard links: count each inode once.
+        stats = {st.st_ino: st.st_size for st in (os.stat(os.path.join(entry, f)) for f in os.listdir(entry))}
+        size = sum(stats.values())
+        stamp = os.path.join(entry, LAST_USED)
+        yield (os.path.getmtime(stamp) if os.path.exists(stamp) else os.path.getmtime(entry)), size, entry
+
+
+def evict(cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE, keep=(), min_age=MIN_AGE):
+    """Delete least recently used entries until the cache fits in max_size; entries in `keep`
+    (those of the current run) and entries used in the last `min_age` seconds are never deleted.
+    Returns the deleted entries."""
+    max_bytes = parse_size(max_size)
+    if max_bytes is None or not os.path.isdir(cache_dir):
+        return []
+    keep = {os.path.abspath(os.path.dirname(k)) for k in keep}
+    entries = sorted(_entries(cache_dir))
+    total = sum(size for _, size, _ in entries)
+    deleted = []
+    now = time.time()
+    for last_used, size, entry in entries:
+        if total <= max_bytes or now - last_used < min_age:
+            break
+        if os.path.abspath(entry) in keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        deleted.append(entry)
+    return deleted
+
+
+def convert(path, annot, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+    """Converted file of `path`, running convertBetweenRDSandH5AD.R only on a cache miss (for scripts;
+    Snakemake workflows go through the rule of convert_h5ad.smk)."""
+    output = cache_path(path, annot, cache_dir)
+    if not os.path.exists(output) and not link_existing(output):
+        os.makedirs(cache_dir, exist_ok=True)
+        # The R script writes into its working directory: one private directory per conversion.
+        tmp = tempfile.mkdtemp(prefix='.tmp.', dir=cache_dir)
+        try:
+            subprocess.run(["Rscript", os.path.abspath(CONVERT_SCRIPT), "--input_path", os.path.abspath(path),
+                            "--annot", annot], cwd=tmp, check=True)
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            os.replace(os.path.join(tmp, os.path.basename(output)), output)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    touch(output)
+    evict(cache_dir, max_size, keep=[output])
+    return output
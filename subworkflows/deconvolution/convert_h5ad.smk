@@ -0,0 +1,81 @@
+# Shared RDS -> h5ad conversions of the sc / sp inputs, for all the Python methods.
+# Converted files live in a content-addressed cache (conversion_cache.py): a reference is converted
+# once per content and annotation column, not once per method and per run.
+import os
+import sys
+
+sys.path.insert(0, "subworkflows/deconvolution")
+import conversion_cache
+
+conversion_cache_dir = config.get("conversion_cache", conversion_cache.DEFAULT_CACHE_DIR)
+conversion_cache_size = config.get("conversion_cache_size", conversion_cache.DEFAULT_MAX_SIZE)
+conversion_sources = {}
+# "python": the methods read the .rds inputs themselves (rds_reader.py), no conversion at all
+read_rds = config.get("read_rds", "convert")
+
+def cached_h5ad(rds_path, annot):
+    """Path of the h5ad conversion of rds_path in the cache; the rule below creates it on a miss.
+    The key hashes the content of rds_path (memoized against its size and mtime), so the file must
+    exist when the workflow is parsed."""
+    if not os.path.exists(rds_path):
+        raise ValueError(f"Error: {rds_path} not found. The conversion cache key is a hash of its content, "
+                         f"so it must exist before this workflow runs (generate it first, e.g. mode=generate_data).")
+    output = conversion_cache.cache_path(rds_path, annot, conversion_cache_dir)
+    key = os.path.basename(os.path.dirname(output))
+    if key not in conversion_sources:
+        conversion_sources[key] = (rds_path, annot)
+        # Only marks the entry as used (a concurrent run's eviction then keeps it), never deletes
+        if os.path.exists(output):
+            conversion_cache.touch(output)
+    return output
+
+def method_input(path, annot):
+    """Input file of a Python method: the .rds itself with read_rds=python, else its cached h5ad."""
+    if read_rds == "python" or not path.lower().endswith(".rds"):
+        return path
+    return cached_h5ad(path, annot)
+
+rule convert_h5ad_cached:
+    input:
+        # The key already changes with the content: a touched or copied input is not converted again.
+        rds_file=lambda wildcards: ancient(conversion_sources[wildcards.key][0])
+    output:
+        f"{conversion_cache_dir}/{{key}}/{{name}}.h5ad"
+    wildcard_constraints:
+        key="[0-9a-f]+"
+    params:
+        annot=lambda wildcards: conversion_sources[wildcards.key][1],
+        convert_script=conversion_cache.CONVERT_SCRIPT
+    singularity:
+        "docker://csangara/seuratdisk:latest"
+    threads:
+        8
+    shell:
+        """
+        start_time=$(date +%s)
+        existing=$(ls {conversion_cache_dir}/{wildcards.key}/*.h5ad 2>/dev/null | head -n 1)
+        if [ -n "$existing" ]; then
+            # Same content already converted under another file name
+            ln -f "$existing" {output} || cp "$existing" {output}
+        else
+            # convertBetweenRDSandH5AD.R writes into its working directory: one private directory per conversion
+            tmp_dir=$(mktemp -d {conversion_cache_dir}/.tmp.XXXXXX)
+            script=$(readlink -f {params.convert_script})
+            input_path=$(readlink -f {input.rds_file})
+            (cd $tmp_dir && Rscript $script --input_path $input_path --annot {params.annot})
+            mv $tmp_dir/{wildcards.name}.h5ad {output}
+            rm -rf $tmp_dir
+        fi
+        end_time=$(date +%s)
+        elapsed_time=$((end_time - start_time))
+        echo "convert_h5ad_cached took $elapsed_time seconds"
+        """
+
+onsuccess:
+    # Size budget enforced once per successful run, in the main Snakemake process only (not when
+    # cluster jobs re-parse the workflow). Entries of this run, or used by another run recently, are kept.
+    used = [conversion_cache.cache_path(p, a, conversion_cache_dir) for p, a in conversion_sources.values()]
+    for entry_file in used:
+        if os.path.exists(entry_file):
+            conversion_cache.touch(entry_file)
+    conversion_cache.evict(conversion_cache_dir, conversion_cache_size, keep=used)
@@ -2,6 +2,9 @@ import argparse as arp
 import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import early_stopping  # --early_stopping / --patience / --rel_tol
+
 ##### PARSING COMMAND LINE ARGUMENTS #####
 prs = arp.ArgumentParser()
 
@@ -24,6 +27,14 @@ prs.add_argument('-e', '--epochs', default=300, type = int,
 prs.add_argument('-n', '--n_hvgs', default=2000, type = int,
                 help = "number of highly variable genes to use")
 
+prs.add_argument('--norm_cache', default=".deconvolista_cache/normalized", type = str,
+                help = "directory of the normalized references shared between methods")
+
+prs.add_argument('--hvg_cache', default=".deconvolista_cache/hvgs", type = str,
+                help = "directory of the cached highly variable genes")
+
+early_stopping.add_arguments(prs, patience=20)
+
 args = prs.parse_args()
 cuda_device = args.cuda_device
 
@@ -39,14 +50,17 @@ assert not os.path.exists(output_folder), "folder already exists"
 
 print("Parameters\n==========")
 print("Training epochs: {}".format(args.epochs))
+print("Early stopping: {}".format(f"patience {args.patience}, rel_tol {args.rel_tol}" if args.early_stopping else "off"))
 print("==========")
 
 ##### MAIN CODE #####
 if cuda_device.isdigit():
     os.environ["CUDA_VISIBLE_DEVICES"]=cuda_device
 
-import scanpy as sc
 from scvi.model import CondSCVI, DestVI
+from lazy_input import open_input, materialize  # .h5ad (backed) or .rds inputs
+from normalized_reference import normalized_input
+from hvgs import highly_variable_genes
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -56,36 +70,33 @@ mpl.use('Agg')
 import warnings
 warnings.filterwarnings('ignore')
 
-## scRNA reference (raw counts)
-print("Reading scRNA-seq data from " + args.sc_data_path + "...")
-sc_adata = sc.read_h5ad(args.sc_data_path)
+## scRNA reference: X normalized and logarithmized once for all the methods, raw counts in layers["counts"]
+print("Reading normalized scRNA-seq data of " + args.sc_data_path + "...")
+sc_adata = normalized_input(args.sc_data_path, 10e4, args.annotation_column, args.norm_cache)
 
+# Only the gene names of the spatial data are needed (its matrix stays on disk for h5ad inputs)
 print("Reading in spatial data from " + args.sp_data_path + "...")
-st_adata = sc.read_h5ad(args.sp_data_path)
+st_genes = open_input(args.sp_data_path).var_names
 
-if not all(sc_adata.var_names.isin(st_adata.var_names)):
+# The gene subsets are decided on the memory-mapped reference, then materialized once
+in_spatial = sc_adata.var_names.isin(st_genes)
+if not all(in_spatial):
     print("Subsetting single-cell data to match genes in spatial data...")
     print("Before subsetting: {} genes.".format(sc_adata.shape[1]))
-    sc_adata = sc_adata[:, sc_adata.var_names.isin(st_adata.var_names)].copy()
-    print("After subsetting: {} genes.".format(sc_adata.shape[1]))
+    print("After subsetting: {} genes.".format(in_spatial.sum()))
 
 # Filter genes
-print("Before filtering: {} genes.".format(sc_adata.shape[1]))
+print("Before filtering: {} genes.".format(in_spatial.sum()))
 G = args.n_hvgs
-sc.pp.filter_genes(sc_adata, min_counts=10)
-print("After filtering: {} genes.".format(sc_adata.shape[1]))
-sc_adata.layers["counts"] = sc_adata.X.copy()
+candidates = in_spatial & (np.asarray(sc_adata.layers["counts"].sum(axis=0)).ravel() >= 10)
+print("After filtering: {} genes.".format(candidates.sum()))
 
 print("Subsetting on HVGs...")
-sc.pp.highly_variable_genes(
-    sc_adata,
-    n_top_genes=G,
-    subset=True,
-    layer="counts",
-    flavor="seurat_v3"
-)
-sc.pp.normalize_total(sc_adata, target_sum=10e4)
-sc.pp.log1p(sc_adata)
+# Streamed over blocks of cells (flavor 'seurat_v3' on the counts, as sc.pp.highly_variable_genes) and cached;
+# the candidates are a mask of the memory-mapped counts, not a column copy of them
+hvgs = highly_variable_genes(sc_adata.layers["counts"], sc_adata.var_names[candidates], "seurat_v3", G,
+                             sc_path=args.sc_data_path, cache_dir=args.hvg_cache, mask=candidates)
+sc_adata = materialize(sc_adata, genes=sc_adata.var_names.isin(hvgs))
 sc_adata.raw = sc_adata
 
 print("Single-cell data now has {} genes.".format(sc_adata.shape[1]))
@@ -95,7 +106,10 @@ CondSCVI.setup_anndata(sc_adata, layer="counts", labels_key=args.annotation_colu
 # Run the model
 sc_model = CondSCVI(sc_adata, weight_obs=False)
 sc_model.view_anndata_setup()
-sc_model.train(max_epochs=args.epochs)
+plateau = early_stopping.from_args(args)
+sc_model.train(max_epochs=args.epochs, **early_stopping.train_kwargs(plateau))
+if plateau:
+    print(plateau.report(args.epochs))
 
 # Save training figure
 sc_model.history["elbo_train"].iloc[5:].plot()
@@ -3,6 +3,9 @@ import argparse as arp
 import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import early_stopping  # --early_stopping / --patience / --rel_tol
+
 ##### PARSING COMMAND LINE ARGUMENTS #####
 prs = arp.ArgumentParser()
 
@@ -19,6 +22,8 @@ prs.add_argument('-e', '--epochs', default=2500, type = int, help = "number of e
 
 prs.add_argument('-b', '--batch_size', default=128, type=int, help = "minibatch size to use during training.")
 
+early_stopping.add_arguments(prs, patience=50)
+
 args = prs.parse_args()
 
 cuda_device = args.cuda_device
@@ -30,14 +35,14 @@ assert (cuda_device.isdigit() or cuda_device == "cpu"), "invalid device input"
 print("Parameters\n==========")
 print("Training epochs: {}".format(args.epochs))
 print("Batch size: {}".format(args.batch_size))
+print("Early stopping: {}".format(f"patience {args.patience}, rel_tol {args.rel_tol}" if args.early_stopping else "off"))
 print("==========")
 
 ##### MAIN PART #####
 if cuda_device.isdigit():
     os.environ["CUDA_VISIBLE_DEVICES"]=cuda_device
 
-import scanpy as sc
-import numpy as np
+from lazy_input import open_input, materialize  # .h5ad (backed) or .rds inputs
 from scvi.model import CondSCVI, DestVI
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -47,16 +52,16 @@ mpl.use('Agg')
 import warnings
 warnings.filterwarnings('ignore')
 
-print("Reading in spatial data from " + sp_data_path + "...")
-st_adata = sc.read_h5ad(sp_data_path)
-st_adata.layers["counts"] = st_adata.X.copy()
-
 print("Reading in the sc model...")
 sc_model = CondSCVI.load(args.model_path)
 
+print("Reading in spatial data from " + sp_data_path + "...")
+st_adata = open_input(sp_data_path)
 if st_adata.shape[1] != sc_model.adata.shape[1]:
     print("The number of genes do not match. Subsetting spatial data...")
-    st_adata = st_adata[:, st_adata.var_names.isin(sc_model.adata.var_names)].copy()
+# Only the genes of the model are read into memory; the counts layer shares X
+st_adata = materialize(st_adata, genes=st_adata.var_names.isin(sc_model.adata.var_names))
+st_adata.layers["counts"] = st_adata.X
 
 # Prepare anndata
 print("Setting up spatial model...")
@@ -65,7 +70,10 @@ DestVI.setup_anndata(st_adata, layer="counts")
 # Set up model
 st_model = DestVI.from_rna_model(st_adata, sc_model)
 st_model.view_anndata_setup()
-st_model.train(max_epochs=args.epochs, batch_size=args.batch_size)
+plateau = early_stopping.from_args(args)
+st_model.train(max_epochs=args.epochs, batch_size=args.batch_size, **early_stopping.train_kwargs(plateau))
+if plateau:
+    print(plateau.report(args.epochs))
 
 # Save training figure
 st_model.history["elbo_train"].iloc[5:].plot()
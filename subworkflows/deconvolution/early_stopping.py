@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Convergence-based early stopping shared by the methods trained for a fixed number of epochs
+(cell2location, DestVI, Tangram): training stops once the loss (ELBO) has not improved by more
+than rel_tol (relative to the best value) for `patience` epochs.
+
+Plateau holds the criterion; lightning_callback() plugs it into scvi-tools / cell2location training
+(train(callbacks=[...])), tangram_training() into Tangram's mapping optimizer. add_arguments() adds
+the same CLI options to each script.
+"""
+import contextlib
+
+PATIENCE = 100
+REL_TOL = 1e-4
+
+
+class Plateau:
+    """Loss plateau detection: update() with the loss of each epoch returns True when training should stop."""
+
+    def __init__(self, patience=PATIENCE, rel_tol=REL_TOL, min_epochs=0):
+        self.patience, self.rel_tol, self.min_epochs = patience, rel_tol, min_epochs
+        self.epoch, self.best, self.best_epoch, self.stopped_epoch = 0, None, 0, None
+
+    def update(self, loss):
+        self.epoch += 1
+        if self.best is None or loss < self.best - self.rel_tol * abs(self.best):
+            self.best, self.best_epoch = loss, self.epoch
+        elif self.epoch - self.best_epoch >= self.patience and self.epoch >= self.min_epochs:
+            self.stopped_epoch = self.epoch
+            print(f"Early stopping at epoch {self.epoch}: no relative improvement over {self.rel_tol:g} "
+                  f"in {self.patience} epochs (best loss {self.best:.6g} at epoch {self.best_epoch})", flush=True)
+            return True
+        return False
+
+    def report(self, max_epochs):
+        """One line on how training ended, for the logs."""
+        if self.stopped_epoch is None:
+            return f"Trained for all {max_epochs} epochs (no plateau detected)"
+        return f"Stopped at epoch {self.stopped_epoch} of {max_epochs} (converged at epoch {self.best_epoch})"
+
+
+def add_arguments(prs, patience=PATIENCE, rel_tol=REL_TOL, min_epochs=0):
+    """--early_stopping, --patience, --rel_tol and --min_epochs options of a method script."""
+    prs.add_argument('--early_stopping', action='store_true',
+                     help='stop training when the loss has plateaued (see --patience / --rel_tol)')
+    prs.add_argument('--patience', default=patience, type=int,
+                     help='epochs without relative improvement before stopping')
+    prs.add_argument('--rel_tol', default=rel_tol, type=float,
+                     help='minimal improvement of the loss, relative to its best value')
+    prs.add_argument('--min_epochs', default=min_epochs, type=int,
+                     help='epochs trained before early stopping can happen')
+
+
+def from_args(args):
+    """Plateau of the parsed options, or None without --early_stopping."""
+    return Plateau(args.patience, args.rel_tol, args.min_epochs) if args.early_stopping else None
+
+
+def lightning_callback(plateau, monitor='elbo_train'):
+    """Lightning callback stopping scvi-tools / cell2location training on a plateau of `monitor`.
+    It derives from EarlyStopping so that Lightning runs it after the training plan has logged the
+    epoch metrics."""
+    try:
+        from lightning.pytorch.callbacks import EarlyStopping
+    except ImportError:
+        from pytorch_lightning.callbacks import EarlyStopping
+
+    class PlateauStopping(EarlyStopping):
+        def __init__(self):
+            super().__init__(monitor=monitor, mode='min', strict=False, check_on_train_epoch_end=True)
+
+        def on_train_epoch_end(self, trainer, pl_module):
+            value = trainer.callback_metrics.get(monitor)
+            if value is not None and plateau.update(float(value)):
+                trainer.should_stop = True
+
+        def on_validation_end(self, trainer, pl_module):
+            pass
+
+    return PlateauStopping()
+
+
+def train_kwargs(plateau, monitor='elbo_train'):
+    """Extra keyword arguments of model.train(): the plateau callback, if any."""
+    return {'callbacks': [lightning_callback(plateau, monitor)]} if plateau else {}
+
+
+@contextlib.contextmanager
+def tangram_training(plateau):
+    """Within this context, tg.map_cells_to_space stops on a plateau of Tangram's total loss.
+
+    Tangram's optimizers have no callbacks: their train() is replaced by the same loop (Adam on the
+    mapping matrix, and the filter of the constrained mode) that also checks the plateau."""
+    if plateau is None:
+        yield
+        return
+    import torch
+    from torch.nn.functional import softmax
+    from tangram import mapping_optimizer
+
+    keys = ["total_loss", "main_loss", "vg_reg", "kl_reg", "entropy_reg", "count_reg", "lambda_f_reg"]
+
+    def train(self, num_epochs, learning_rate=0.1, print_each=100):
+        if self.random_state:
+            torch.manual_seed(seed=self.random_state)
+        constrained = hasattr(self, 'F')
+        optimizer = torch.optim.Adam([self.M, self.F] if constrained else [self.M], lr=learning_rate)
+        history = {}
+        for t in range(num_epochs):
+            run_loss = self._loss_fn(verbose=bool(print_each) and t % print_each == 0)
+            for key, value in zip(keys, run_loss):
+                history.setdefault(key, []).append(str(value))
+            optimizer.zero_grad()
+            run_loss[0].backward()
+            optimizer.step()
+            if plateau.update(float(run_loss[0])):
+                break
+        with torch.no_grad():
+            output = softmax(self.M, dim=1).cpu().numpy()
+            if constrained:
+                return output, torch.sigmoid(self.F).cpu().numpy(), history
+            return output, history
+
+    classes = [c for c in (getattr(mapping_optimizer, n, None) for n in ('Mapper', 'MapperConstrained')) if c]
+    originals = [c.train for c in classes]
+    for c in classes:
+        c.train = train
+    try:
+        yield
+    finally:
+        for c, original in zip(classes, originals):
+            c.train = original
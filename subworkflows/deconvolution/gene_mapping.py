@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Local gene symbol -> Ensembl ID mapping stores, so that map_genes never queries BioMart at fit time.
+
+A store is an SQLite file <store_dir>/<species>_<release>.sqlite (table genes(symbol, ensembl),
+indexed on symbol), built once per species and Ensembl release from an Ensembl GTF or a BioMart
+export (offline), or from BioMart itself on a node with network access:
+
+    python3 subworkflows/deconvolution/gene_mapping.py build --species hsapiens --gtf Homo_sapiens.GRCh38.110.gtf.gz
+    python3 subworkflows/deconvolution/gene_mapping.py build --species mmusculus --release 110 --tsv mart_export.txt
+    python3 subworkflows/deconvolution/gene_mapping.py build --species hsapiens --release 110 --biomart
+    python3 subworkflows/deconvolution/gene_mapping.py list
+
+A symbol listed with several IDs maps to the last one, as the dict(zip(...)) of the BioMart query did.
+"""
+import argparse as arp
+import functools
+import glob
+import gzip
+import os
+import re
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_STORE_DIR = ".deconvolista_cache/gene_mappings"
+DEFAULT_SPECIES = "hsapiens"
+
+
+def store_path(species=DEFAULT_SPECIES, release="latest", store_dir=DEFAULT_STORE_DIR):
+    """Store of a species and release; 'latest' is the highest release built for the species."""
+    if str(release) != "latest":
+        return os.path.join(store_dir, f"{species}_{release}.sqlite")
+    built = glob.glob(os.path.join(store_dir, f"{species}_*.sqlite"))
+    releases = [int(m.group(1)) for m in (re.search(r"_(\d+)\.sqlite$", p) for p in built) if m]
+    if not releases:
+        raise FileNotFoundError(
+            f"No gene mapping store for {species} in {store_dir}. Build one once (no network needed with a GTF):\n"
+            f"  python3 subworkflows/deconvolution/gene_mapping.py build --species {species} --gtf <Ensembl GTF> "
+            f"--store_dir {store_dir}")
+    return os.path.join(store_dir, f"{species}_{max(releases)}.sqlite")
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       SOURCES                                           !>
+# <! ------------------------------------------------------------------------!>
+
+def pairs_from_gtf(path):
+    """(ensembl, symbol) of the gene records of an Ensembl GTF (plain or gzipped)."""
+    opener = gzip.open if path.endswith('.gz') else open
+    gene_id, gene_name = re.compile(r'gene_id "([^"]+)"'), re.compile(r'gene_name "([^"]+)"')
+    rows = []
+    with opener(path, 'rt') as f:
+        for line in f:
+            fields = line.split('\t', 8)
+            if len(fields) < 9 or fields[2] != 'gene':
+                continue
+            ensembl, symbol = gene_id.search(fields[8]), gene_name.search(fields[8])
+            if ensembl and symbol:
+                rows.append((ensembl.group(1), symbol.group(1)))
+    return pd.DataFrame(rows, columns=['ensembl', 'symbol'])
+
+
+def pairs_from_tsv(path):
+    """(ensembl, symbol) of a BioMart export ('Gene stable ID', 'Gene name'; else the first two columns)."""
+    table = pd.read_csv(path, sep=None, engine='python', dtype=str)
+    if {'Gene stable ID', 'Gene name'} <= set(table.columns):
+        table = table[['Gene stable ID', 'Gene name']]
+    else:
+        table = table.iloc[:, :2]
+    table.columns = ['ensembl', 'symbol']
+    return table.dropna()
+
+
+def pairs_from_biomart(species, host='http://www.ensembl.org'):
+    """(ensembl, symbol) queried from BioMart (needs pybiomart and network access)."""
+    from pybiomart import Server
+
+    dataset = Server(host=host).marts['ENSEMBL_MART_ENSEMBL'].datasets[f'{species}_gene_ensembl']
+    table = dataset.query(attributes=['ensembl_gene_id', 'external_gene_name'])
+    table.columns = ['ensembl', 'symbol']
+    return table.dropna()
+
+
+def gtf_release(path):
+    """Ensembl release in a GTF file name (Homo_sapiens.GRCh38.110.gtf.gz -> '110'), or None."""
+    match = re.search(r"\.(\d+)(?:\.chr)?\.gtf(?:\.gz)?$", os.path.basename(path))
+    return match.group(1) if match else None
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       STORE                                             !>
+# <! ------------------------------------------------------------------------!>
+
+def build_store(pairs, species, release, store_dir=DEFAULT_STORE_DIR, source=""):
+    """Write the (ensembl, symbol) pairs, in their order, as the store of species / release."""
+    path = store_path(species, release, store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}"
+    with sqlite3.connect(tmp) as db:
+        db.execute("CREATE TABLE genes (symbol TEXT NOT NULL, ensembl TEXT NOT NULL)")
+        db.executemany("INSERT INTO genes VALUES (?, ?)", pairs[['symbol', 'ensembl']].itertuples(index=False))
+        db.execute("CREATE INDEX genes_symbol ON genes (symbol)")
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ('species', species), ('release', str(release)), ('source', source), ('genes', str(len(pairs))),
+            ('built', time.strftime('%Y-%m-%d %H:%M:%S'))])
+    db.close()
+    os.replace(tmp, path)
+    return path
+
+
+@functools.lru_cache(maxsize=None)
+def load_mapping(path):
+    """symbol -> Ensembl ID dict of a store, read once per process."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Gene mapping store {path} not found (see gene_mapping.py build)")
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+        rows = db.execute("SELECT symbol, ensembl FROM genes ORDER BY rowid").fetchall()
+    db.close()
+    return dict(rows)
+
+
+def map_symbols(symbols, species=DEFAULT_SPECIES, release="latest", store_dir=DEFAULT_STORE_DIR):
+    """Ensembl IDs of the symbols (an object array, NaN where a symbol is unknown)."""
+    mapping = load_mapping(store_path(species, release, store_dir))
+    return pd.Index(symbols).map(mapping).to_numpy(dtype=object, na_value=np.nan)
+
+
+if __name__ == "__main__":
+    prs = arp.ArgumentParser()
+    sub = prs.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='build the store of a species / release')
+    build.add_argument('--species', default=DEFAULT_SPECIES, help='Ensembl species name (hsapiens, mmusculus, ...)')
+    build.add_argument('--release', default=None, help='Ensembl release (read from the GTF file name if omitted)')
+    source = build.add_mutually_exclusive_group(required=True)
+    source.add_argument('--gtf', help='Ensembl GTF of the species (offline)')
+    source.add_argument('--tsv', help='BioMart export with Gene stable ID and Gene name columns (offline)')
+    source.add_argument('--biomart', action='store_true', help='query BioMart (network access needed)')
+    build.add_argument('--host', default='http://www.ensembl.org', help='BioMart host of the release')
+    build.add_argument('--store_dir', default=DEFAULT_STORE_DIR)
+    listing = sub.add_parser('list', help='list the stores built')
+    listing.add_argument('--store_dir', default=DEFAULT_STORE_DIR)
+    args = prs.parse_args()
+
+    if args.command == 'list':
+        for path in sorted(glob.glob(os.path.join(args.store_dir, '*.sqlite'))):
+            with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+                meta = dict(db.execute("SELECT key, value FROM meta"))
+            db.close()
+            print(f"{os.path.basename(path)}\t{meta.get('genes')} genes\t{meta.get('source')}\t{meta.get('built')}")
+    else:
+        release = args.release or (gtf_release(args.gtf) if args.gtf else None)
+        if release is None:
+            prs.error("--release is required (it could not be read from the GTF file name)")
+        if args.gtf:
+            pairs, source_name = pairs_from_gtf(args.gtf), os.path.basename(args.gtf)
+        elif args.tsv:
+            pairs, source_name = pairs_from_tsv(args.tsv), os.path.basename(args.tsv)
+        else:
+            pairs, source_name = pairs_from_biomart(args.species, args.host), args.host
+        path = build_store(pairs, args.species, release, args.store_dir, source_name)
+        print(f"{path}: {len(pairs)} genes")
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Highly variable genes of a reference, as sc.pp.highly_variable_genes computes them with the 'seurat'
+(stereoscope, log-normalized data) and 'seurat_v3' (destvi, raw counts) flavors, streamed over
+blocks of rows and cached per reference content, flavor, n_top_genes and candidate genes.
+Candidate genes are given as a column mask of the full matrix: the per-gene statistics are computed
+over all the columns and masked afterwards, so no column subset of the reference is ever copied.
+
+Per-gene means and variances are accumulated block by block (Chan's pairwise merge), from an
+in-memory or memory-mapped CSR matrix or from the X of an h5ad opened backed, so the densified
+matrix never exists. seurat_v3 needs a second pass for the clipped variances, once the loess fit of
+the first pass gives the clipping values.
+
+    python3 subworkflows/deconvolution/hvgs.py lognorm.h5ad --flavor seurat --n_top_genes 2000
+"""
+import argparse as arp
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import conversion_cache
+
+DEFAULT_CACHE_DIR = ".deconvolista_cache/hvgs"
+CHUNK_SIZE = 20000  # rows per block
+FLAVORS = ('seurat', 'seurat_v3')
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       STREAMING STATISTICS                              !>
+# <! ------------------------------------------------------------------------!>
+
+def open_backed(path):
+    """X of an h5ad opened backed (rows read on demand) and its genes."""
+    import anndata
+
+    adata = anndata.read_h5ad(path, backed='r')
+    return adata.X, list(adata.var_names)
+
+
+def row_blocks(X, chunk_size=CHUNK_SIZE):
+    """Blocks of at most chunk_size rows of X, as CSR matrices."""
+    for start in range(0, X.shape[0], chunk_size):
+        block = X[start:min(start + chunk_size, X.shape[0])]
+        yield block.tocsr() if sp.issparse(block) else sp.csr_matrix(np.asarray(block))
+
+
+def mean_var(X, transform=None, chunk_size=CHUNK_SIZE):
+    """Per-gene mean and variance (ddof=1) of X in one pass over its row blocks; transform
+    (e.g. np.expm1) is applied to the non-zero values of each block first."""
+    n_genes = X.shape[1]
+    n, mean, m2 = 0, np.zeros(n_genes), np.zeros(n_genes)
+    for block in row_blocks(X, chunk_size):
+        data = block.data.astype(np.float64)
+        if transform is not None:
+            data = transform(data)
+        nb = block.shape[0]
+        sums = np.bincount(block.indices, weights=data, minlength=n_genes)
+        block_mean = sums / nb
+        block_m2 = np.bincount(block.indices, weights=data * data, minlength=n_genes) - sums * block_mean
+        delta = block_mean - mean
+        mean = mean + delta * nb / (n + nb)
+        m2 = m2 + block_m2 + delta ** 2 * n * nb / (n + nb)
+        n += nb
+    return mean, m2 / max(n - 1, 1)
+
+
+def clipped_sums(X, clip, chunk_size=CHUNK_SIZE):
+    """Per-gene sums of min(x, clip) and of its square (second pass of seurat_v3)."""
+    n_genes = X.shape[1]
+    sums, sqsums = np.zeros(n_genes), np.zeros(n_genes)
+    for block in row_blocks(X, chunk_size):
+        data = np.minimum(block.data.astype(np.float64), clip[block.indices])
+        sums += np.bincount(block.indices, weights=data, minlength=n_genes)
+        sqsums += np.bincount(block.indices, weights=data * data, minlength=n_genes)
+    return sums, sqsums
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       FLAVORS                                           !>
+# <! ------------------------------------------------------------------------!>
+
+def seurat_hvgs(X, genes, n_top_genes, n_bins=20, chunk_size=CHUNK_SIZE, mask=None):
+    """flavor='seurat' on log-normalized X: normalized log-dispersions within 20 mean bins; genes
+    tied with the cutoff are all kept, as scanpy. With a mask, genes names the masked columns."""
+    mean, var = mean_var(X, np.expm1, chunk_size)
+    if mask is not None:
+        mean, var = mean[mask], var[mask]
+    mean[mean == 0] = 1e-12
+    dispersion = var / mean
+    dispersion[dispersion == 0] = np.nan
+    df = pd.DataFrame({'means': np.log1p(mean), 'dispersions': np.log(dispersion)})
+    df['mean_bin'] = pd.cut(df['means'], bins=n_bins)
+    grouped = df.groupby('mean_bin', observed=True)['dispersions']
+    bin_mean, bin_std = grouped.mean(), grouped.std(ddof=1)
+    # A bin with a single gene: normalized dispersion of 1
+    single = bin_std.isnull()
+    bin_std[single.values] = bin_mean[single.values].values
+    bin_mean[single.values] = 0
+    norm = ((df['dispersions'].values - bin_mean[df['mean_bin'].values].values)
+            / bin_std[df['mean_bin'].values].values)
+    ranked = np.sort(norm[~np.isnan(norm)])[::-1]
+    cutoff = ranked[min(n_top_genes, len(ranked)) - 1]
+    return [g for g, keep in zip(genes, np.nan_to_num(norm) >= cutoff) if keep]
+
+
+def seurat_v3_hvgs(counts, genes, n_top_genes, span=0.3, chunk_size=CHUNK_SIZE, mask=None):
+    """flavor='seurat_v3' on raw counts: variance of the standardized counts clipped at sqrt(n_cells),
+    the expected variance being a loess fit of log10(variance) on log10(mean). With a mask, genes
+    names the masked columns."""
+    from skmisc.loess import loess
+
+    mask = np.ones(counts.shape[1], dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    mean, var = mean_var(counts, chunk_size=chunk_size)
+    mean, var = mean[mask], var[mask]
+    not_const = var > 0
+    estimated = np.zeros(len(mean))
+    model = loess(np.log10(mean[not_const]), np.log10(var[not_const]), span=span, degree=2)
+    model.fit()
+    estimated[not_const] = model.outputs.fitted_values
+    reg_std = np.sqrt(10 ** estimated)
+    n = counts.shape[0]
+    clip = np.full(counts.shape[1], np.inf)  # columns outside the mask: sums computed and dropped
+    clip[mask] = reg_std * np.sqrt(n) + mean
+    sums, sqsums = clipped_sums(counts, clip, chunk_size)
+    sums, sqsums = sums[mask], sqsums[mask]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_var = (n * mean ** 2 + sqsums - 2 * mean * sums) / ((n - 1) * reg_std ** 2)
+    norm_var[~np.isfinite(norm_var)] = 0
+    top = np.zeros(len(genes), dtype=bool)
+    top[np.argsort(-norm_var, kind='stable')[:n_top_genes]] = True
+    return [g for g, keep in zip(genes, top) if keep]
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       CACHE                                             !>
+# <! ------------------------------------------------------------------------!>
+
+def cache_path(sc_path, flavor, n_top_genes, genes, target_sum=None, cache_dir=DEFAULT_CACHE_DIR):
+    """Cached gene list; the candidate genes are part of the key (destvi filters genes first)."""
+    genes_digest = hashlib.sha256("\n".join(map(str, genes)).encode()).hexdigest()
+    fields = [conversion_cache.file_digest(sc_path, cache_dir), flavor, n_top_genes, target_sum, genes_digest]
+    key = hashlib.sha256("\0".join(map(str, fields)).encode()).hexdigest()[:24]
+    return os.path.join(cache_dir, f"{key}.txt")
+
+
+def highly_variable_genes(X, genes, flavor, n_top_genes, sc_path=None, target_sum=None,
+                          cache_dir=DEFAULT_CACHE_DIR, chunk_size=CHUNK_SIZE, mask=None):
+    """Highly variable genes of X (log-normalized for 'seurat', counts for 'seurat_v3'), in the order
+    of `genes`. With a boolean mask over the columns of X, only the masked columns are candidates and
+    genes names them. With sc_path, the list is read from / stored in the cache."""
+    if flavor not in FLAVORS:
+        raise ValueError(f"Unknown HVG flavor {flavor} ({' or '.join(FLAVORS)})")
+    genes = list(genes)
+    path = cache_path(sc_path, flavor, n_top_genes, genes, target_sum, cache_dir) if sc_path else None
+    if path and os.path.exists(path):
+        print(f"Highly variable genes read from the cache ({path})")
+        with open(path) as f:
+            return f.read().splitlines()
+    if flavor == 'seurat':
+        hvgs = seurat_hvgs(X, genes, n_top_genes, chunk_size=chunk_size, mask=mask)
+    else:
+        hvgs = seurat_v3_hvgs(X, genes, n_top_genes, chunk_size=chunk_size, mask=mask)
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}"
+        with open(tmp, 'w') as f:
+            f.write("".join(f"{g}\n" for g in hvgs))
+        os.replace(tmp, path)
+    return hvgs
+
+
+if __name__ == "__main__":
+    prs = arp.ArgumentParser()
+    prs.add_argument('h5ad', type=str, help='reference whose X is read backed (log-normalized for seurat, counts for seurat_v3)')
+    prs.add_argument('--flavor', default='seurat', choices=FLAVORS)
+    prs.add_argument('--n_top_genes', type=int, default=2000)
+    prs.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='cells read per block')
+    prs.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR)
+    prs.add_argument('-o', '--output', type=str, default='hvgs.txt')
+    args = prs.parse_args()
+
+    X, genes = open_backed(args.h5ad)
+    hvgs = highly_variable_genes(X, genes, args.flavor, args.n_top_genes, sc_path=args.h5ad,
+                                 cache_dir=args.cache_dir, chunk_size=args.chunk_size)
+    with open(args.output, 'w') as f:
+        f.write("".join(f"{g}\n" for g in hvgs))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Loading layer of the Python methods: inputs are opened without their matrix in memory, the cell and
+gene subsets are decided on obs / var (or on statistics streamed over blocks of cells), and only the
+final subset is materialized, once.
+
+    adata = open_input(path, annot)                     # .h5ad: backed, X stays on disk
+    keep = ~adata.var_names.str.lower().str.startswith('mt-')
+    adata = materialize(adata, genes=keep)              # the only copy of the matrix
+
+.rds inputs have no backed mode: their dgCMatrix is parsed once by rds_reader and subset without
+intermediate copies.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hvgs import CHUNK_SIZE, row_blocks
+from rds_reader import read_input
+
+
+def open_input(path, annot=None):
+    """AnnData of an .h5ad (opened backed, read-only) or .rds input; annot as a string column."""
+    if path.lower().endswith('.rds'):
+        return read_input(path, annot)
+    import anndata
+
+    adata = anndata.read_h5ad(path, backed='r')
+    if annot and annot in adata.obs.columns:
+        adata.obs[annot] = adata.obs[annot].astype(str)
+    return adata
+
+
+def _selection(index, subset):
+    """Positions selected by subset: None (all), a slice, a boolean mask, names of index or positions."""
+    if subset is None:
+        return slice(None)
+    if isinstance(subset, slice):
+        return subset
+    subset = np.asarray(subset)
+    if subset.dtype == bool:
+        return np.flatnonzero(subset)
+    if subset.dtype.kind in 'iu':
+        return subset
+    positions = pd.Index(index).get_indexer(subset)
+    if (positions < 0).any():
+        raise KeyError(f"{(positions < 0).sum()} names not found, e.g. {subset[positions < 0][0]}")
+    return positions
+
+
+def materialize(adata, cells=None, genes=None):
+    """In-memory AnnData of the selected cells and genes only (backed inputs read just those)."""
+    view = adata[_selection(adata.obs_names, cells), _selection(adata.var_names, genes)]
+    return view.to_memory() if adata.isbacked else view.copy()
+
+
+def load_input(path, annot=None, cells=None, genes=None):
+    """open_input + materialize: the subset of an input, without the full matrix in memory."""
+    return materialize(open_input(path, annot), cells, genes)
+
+
+def gene_stats(adata, layer=None, chunk_size=CHUNK_SIZE):
+    """Per-gene number of cells with a positive value and sum of X (or of a layer), streamed over
+    blocks of cells: enough for count / mean based gene filters without loading the matrix."""
+    X = adata.X if layer is None else adata.layers[layer]
+    n_cells, sums = np.zeros(adata.n_vars), np.zeros(adata.n_vars)
+    for block in row_blocks(X, chunk_size):
+        n_cells += np.bincount(block.indices, weights=block.data > 0, minlength=adata.n_vars)
+        sums += np.bincount(block.indices, weights=block.data, minlength=adata.n_vars)
+    return pd.DataFrame({'n_cells': n_cells.astype(np.int64), 'sum': sums}, index=adata.var_names)
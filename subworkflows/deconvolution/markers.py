@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Marker genes of the cell types of a reference (one group vs the rest), as sc.tl.rank_genes_groups
+computes them for tangram (t-test) and stride (wilcoxon), with results cached per reference content,
+annotation column, test, target_sum, number of markers and subsampling.
+
+The 'fast' backend works on the CSR matrix directly: group sums and sums of squares come from one
+sparse product with the cells x groups indicator matrix (t-test), and the rank sums only rank the
+non-zero values of each gene, all the zeros sharing one average rank (wilcoxon). Cells can be
+subsampled per group (max_cells) for million-cell atlases. The 'scanpy' backend runs
+sc.tl.rank_genes_groups itself (see benchmark_markers.py for the comparison).
+"""
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import conversion_cache
+
+DEFAULT_CACHE_DIR = ".deconvolista_cache/markers"
+CHUNK_NNZ = 50_000_000  # non-zero values ranked at once (wilcoxon)
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       STATISTICS                                        !>
+# <! ------------------------------------------------------------------------!>
+
+def subsample(labels, max_cells, seed=0):
+    """Indices of at most max_cells cells per group, drawn without replacement (sorted)."""
+    codes = pd.Categorical(labels).codes
+    if max_cells is None:
+        return np.arange(len(codes))
+    rng = np.random.default_rng(seed)
+    keep = [rng.choice(idx, max_cells, replace=False) if len(idx) > max_cells else idx
+            for idx in (np.flatnonzero(codes == g) for g in range(codes.max() + 1))]
+    return np.sort(np.concatenate(keep))
+
+
+def _indicator(codes, n_groups):
+    return sp.csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))), shape=(n_groups, len(codes)))
+
+
+def ttest_scores(X, codes, n_groups):
+    """Welch t statistic of each group vs the rest, groups x genes (NaN -> 0, as scanpy)."""
+    G = _indicator(codes, n_groups)
+    n = np.asarray(G.sum(axis=1)).ravel()[:, None]
+    sums = np.asarray((G @ X).todense()) if sp.issparse(X) else G @ X
+    sq = X.multiply(X) if sp.issparse(X) else X * X
+    sqsums = np.asarray((G @ sq).todense()) if sp.issparse(sq) else G @ sq
+    n_rest, sums_rest, sqsums_rest = n.sum() - n, sums.sum(axis=0) - sums, sqsums.sum(axis=0) - sqsums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean, mean_rest = sums / n, sums_rest / n_rest
+        var = (sqsums - n * mean ** 2) / (n - 1)
+        var_rest = (sqsums_rest - n_rest * mean_rest ** 2) / (n_rest - 1)
+        scores = (mean - mean_rest) / np.sqrt(var / n + var_rest / n_rest)
+    scores[np.isnan(scores)] = 0
+    return scores
+
+
+def wilcoxon_scores(X, codes, n_groups, chunk_nnz=CHUNK_NNZ):
+    """Wilcoxon rank-sum z-score of each group vs the rest, groups x genes (no tie correction, as
+    scanpy). X must be non-negative: the zeros of a gene are its lowest values, tied."""
+    X = sp.csc_matrix(X)
+    if X.nnz and X.data.min() < 0:
+        raise ValueError("wilcoxon_scores expects non-negative (log-normalized) values")
+    X.sum_duplicates()
+    X.eliminate_zeros()  # stored zeros rank with the implicit ones
+    codes = np.asarray(codes, dtype=np.int64)
+    n_cells, n_genes = X.shape
+    n = np.bincount(codes, minlength=n_groups).astype(np.float64)
+    rank_sums = np.empty((n_groups, n_genes))
+    start = 0
+    while start < n_genes:
+        stop = max(int(np.searchsorted(X.indptr, X.indptr[start] + chunk_nnz, side='right')) - 1, start + 1)
+        stop = min(stop, n_genes)
+        lo, hi = X.indptr[start], X.indptr[stop]
+        nnz = np.diff(X.indptr[start:stop + 1])
+        genes = np.repeat(np.arange(stop - start), nnz)
+        # One sort for the whole chunk: gene offsets keep the genes apart, values sort within a gene
+        order = np.argsort(genes * (X.data[lo:hi].max(initial=0) + 1.0) + X.data[lo:hi], kind='stable')
+        values, genes = X.data[lo:hi][order], genes[order]
+        # Average rank of the ties among the non-zeros of a gene, shifted by its zeros
+        position = np.arange(hi - lo) - (X.indptr[start:stop] - lo)[genes]
+        first = np.r_[True, (values[1:] != values[:-1]) | (genes[1:] != genes[:-1])]
+        tie = np.cumsum(first) - 1
+        starts = np.flatnonzero(first)
+        ends = np.r_[starts[1:], hi - lo] - 1
+        zeros = n_cells - nnz
+        ranks = zeros[genes] + (position[starts] + position[ends])[tie] / 2 + 1
+        cells = codes[X.indices[lo:hi][order]] * (stop - start) + genes
+        nz_sums = np.bincount(cells, weights=ranks, minlength=n_groups * (stop - start)).reshape(n_groups, -1)
+        nz_counts = np.bincount(cells, minlength=n_groups * (stop - start)).reshape(n_groups, -1)
+        rank_sums[:, start:stop] = nz_sums + (n[:, None] - nz_counts) * (zeros + 1) / 2
+        start = stop
+    n_rest = n_cells - n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (rank_sums - (n * (n_cells + 1) / 2)[:, None]) / np.sqrt(n * n_rest * (n_cells + 1) / 12)[:, None]
+    scores[np.isnan(scores)] = 0
+    return scores
+
+
+def top_genes(scores, groups, genes, n_genes):
+    """DataFrame of the n_genes best genes of each group (columns), best first, as
+    pd.DataFrame(adata.uns['rank_genes_groups']['names'])."""
+    genes = np.asarray(genes, dtype=object)
+    order = np.argsort(-scores, axis=1, kind='stable')[:, :n_genes]
+    return pd.DataFrame({g: genes[order[i]] for i, g in enumerate(groups)})
+
+
+def rank_genes_groups(X, labels, genes, method='t-test', n_genes=100, max_cells=None, seed=0):
+    """Marker genes of each label vs the rest, from log-normalized X (cells x genes)."""
+    keep = subsample(labels, max_cells, seed)
+    labels = pd.Categorical(np.asarray(labels)[keep])
+    X = X[keep] if len(keep) < X.shape[0] else X
+    if method == 't-test':
+        scores = ttest_scores(X, labels.codes, len(labels.categories))
+    elif method == 'wilcoxon':
+        scores = wilcoxon_scores(X, labels.codes, len(labels.categories))
+    else:
+        raise ValueError(f"Unknown marker test {method} (t-test or wilcoxon)")
+    return top_genes(scores, list(labels.categories), genes, n_genes)
+
+
+def scanpy_rank_genes_groups(adata, annot, method='t-test', n_genes=100, max_cells=None, seed=0):
+    """The same table computed by sc.tl.rank_genes_groups (reference implementation)."""
+    import scanpy as sc
+
+    keep = subsample(adata.obs[annot], max_cells, seed)
+    adata = adata[keep].copy() if len(keep) < adata.n_obs else adata
+    adata.obs[annot] = adata.obs[annot].astype('category')
+    sc.tl.rank_genes_groups(adata, groupby=annot, method=method, n_genes=n_genes, use_raw=False)
+    return pd.DataFrame(adata.uns['rank_genes_groups']['names'])
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       CACHE                                             !>
+# <! ------------------------------------------------------------------------!>
+
+def cache_path(sc_path, annot, method, n_genes, target_sum, max_cells=None, seed=0, backend='fast',
+               cache_dir=DEFAULT_CACHE_DIR):
+    fields = [conversion_cache.file_digest(sc_path, cache_dir), annot, method, n_genes, float(target_sum),
+              max_cells, seed if max_cells else None, backend]
+    key = hashlib.sha256("\0".join(map(str, fields)).encode()).hexdigest()[:24]
+    return os.path.join(cache_dir, f"{key}.tsv")
+
+
+def markers(adata, sc_path, annot, method='t-test', n_genes=100, target_sum=1e4, max_cells=None, seed=0,
+            backend='fast', cache_dir=DEFAULT_CACHE_DIR):
+    """Marker table of the reference sc_path (adata: its log-normalized AnnData), read from the
+    cache or computed and stored there."""
+    path = cache_path(sc_path, annot, method, n_genes, target_sum, max_cells, seed, backend, cache_dir)
+    if os.path.exists(path):
+        print(f"Marker genes read from the cache ({path})")
+        return pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False)
+    if backend == 'scanpy':
+        table = scanpy_rank_genes_groups(adata, annot, method, n_genes, max_cells, seed)
+    else:
+        table = rank_genes_groups(adata.X, adata.obs[annot], adata.var_names, method, n_genes, max_cells, seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}"
+    table.to_csv(tmp, sep='\t', index=False)
+    os.replace(tmp, path)
+    return table
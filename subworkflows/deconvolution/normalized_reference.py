@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Normalized (normalize_total + log1p) single-cell reference, computed once per reference content and
+target_sum and shared by the Python methods (tangram, stride, stereoscope, destvi).
+
+An artifact is a directory <cache_dir>/<key>/ of .npy arrays opened memory-mapped: the CSR structure
+(indices.npy, indptr.npy) is shared by the log-normalized values (X.npy) and the raw counts
+(counts.npy), next to obs.tsv, genes.txt and normalization.json. Opening it reads no matrix data
+until the method touches it, and the pages are shared between the methods running on the node.
+
+    python3 subworkflows/deconvolution/normalized_reference.py sc.rds --target_sum 1e4 1e5
+"""
+import argparse as arp
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import conversion_cache
+import rds_reader
+
+DEFAULT_CACHE_DIR = ".deconvolista_cache/normalized"
+CHUNK_NNZ = 50_000_000  # non-zero values normalized at once
+
+
+def artifact_path(path, target_sum, cache_dir=DEFAULT_CACHE_DIR):
+    """Artifact of `path` normalized to `target_sum` counts per cell (may not exist yet);
+    10e4 and 1e5 are the same artifact."""
+    key = hashlib.sha256(f"{conversion_cache.file_digest(path, cache_dir)}\0{float(target_sum)!r}".encode())
+    return os.path.join(cache_dir, key.hexdigest()[:24])
+
+
+def read_reference(path):
+    """Raw counts (cells x genes CSR, canonical), obs and genes of an .rds or .h5ad reference."""
+    if path.lower().endswith('.rds'):
+        counts, obs, genes = rds_reader.read_counts(path)
+    else:
+        import anndata
+        adata = anndata.read_h5ad(path)
+        counts, obs, genes = adata.X, adata.obs.copy(), list(adata.var_names)
+    counts = sp.csr_matrix(counts, dtype=np.float32)
+    counts.sum_duplicates()
+    counts.sort_indices()
+    return counts, obs, genes
+
+
+def normalize_log1p(counts, target_sum, out, chunk_nnz=CHUNK_NNZ):
+    """log1p(counts * target_sum / counts per cell) written into `out` (the data array of the result,
+    same structure as counts), chunk by chunk. Empty cells stay at 0, as with sc.pp.normalize_total."""
+    totals = np.asarray(counts.sum(axis=1), dtype=np.float64).ravel()
+    scale = np.divide(target_sum, totals, out=np.zeros_like(totals), where=totals > 0)
+    indptr = counts.indptr
+    start = 0
+    while start < counts.shape[0]:
+        stop = max(int(np.searchsorted(indptr, indptr[start] + chunk_nnz, side='right')) - 1, start + 1)
+        stop = min(stop, counts.shape[0])
+        lo, hi = indptr[start], indptr[stop]
+        rows = np.repeat(scale[start:stop], np.diff(indptr[start:stop + 1]))
+        out[lo:hi] = np.log1p(counts.data[lo:hi] * rows)
+        start = stop
+    return out
+
+
+def _save(array, path):
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=array.dtype, shape=array.shape)
+    out[:] = array
+    out.flush()
+
+
+def prepare(path, target_sum, cache_dir=DEFAULT_CACHE_DIR, chunk_nnz=CHUNK_NNZ):
+    """Artifact of `path` normalized to `target_sum`, computed on a cache miss."""
+    artifact = artifact_path(path, target_sum, cache_dir)
+    if os.path.exists(os.path.join(artifact, 'normalization.json')):
+        return artifact
+    counts, obs, genes = read_reference(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.tmp.', dir=cache_dir)
+    try:
+        _save(counts.indices, os.path.join(tmp, 'indices.npy'))
+        _save(counts.indptr, os.path.join(tmp, 'indptr.npy'))
+        _save(counts.data, os.path.join(tmp, 'counts.npy'))
+        normalized = np.lib.format.open_memmap(os.path.join(tmp, 'X.npy'), mode='w+', dtype=np.float32,
+                                               shape=counts.data.shape)
+        normalize_log1p(counts, float(target_sum), normalized, chunk_nnz)
+        normalized.flush()
+        del normalized
+        obs.index = obs.index.astype(str)
+        obs.to_csv(os.path.join(tmp, 'obs.tsv'), sep='\t')
+        with open(os.path.join(tmp, 'genes.txt'), 'w') as f:
+            f.write('\n'.join(map(str, genes)) + '\n')
+        with open(os.path.join(tmp, 'normalization.json'), 'w') as f:
+            json.dump({'source': os.path.abspath(path), 'target_sum': float(target_sum),
+                       'shape': list(counts.shape), 'nnz': int(counts.nnz)}, f, indent=2)
+        try:
+            os.rename(tmp, artifact)
+        except OSError:
+            # Another method normalized the same reference meanwhile: keep its artifact.
+            if not os.path.exists(os.path.join(artifact, 'normalization.json')):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return artifact
+
+
+def load_arrays(artifact):
+    """(X, counts, obs, genes) of an artifact: X and counts are CSR matrices over copy-on-write
+    memory maps, so that in-place scanpy steps never write to the shared files."""
+    with open(os.path.join(artifact, 'normalization.json')) as f:
+        shape = tuple(json.load(f)['shape'])
+    indices = np.load(os.path.join(artifact, 'indices.npy'), mmap_mode='c')
+    indptr = np.load(os.path.join(artifact, 'indptr.npy'), mmap_mode='c')
+    matrices = [sp.csr_matrix((np.load(os.path.join(artifact, f'{name}.npy'), mmap_mode='c'), indices, indptr),
+                              shape=shape, copy=False) for name in ('X', 'counts')]
+    obs = pd.read_csv(os.path.join(artifact, 'obs.tsv'), sep='\t', index_col=0, keep_default_na=False,
+                      na_values=[''])
+    obs.index = obs.index.astype(str)
+    with open(os.path.join(artifact, 'genes.txt')) as f:
+        genes = f.read().splitlines()
+    return matrices[0], matrices[1], obs, genes
+
+
+def normalized_input(path, target_sum, annot=None, cache_dir=DEFAULT_CACHE_DIR):
+    """AnnData of the normalized reference: X log-normalized, layers['counts'] the raw counts,
+    annot as a string column (as rds_reader.read_input)."""
+    import anndata
+
+    X, counts, obs, genes = load_arrays(prepare(path, target_sum, cache_dir))
+    if annot and annot in obs.columns:
+        obs[annot] = obs[annot].astype(str)
+    adata = anndata.AnnData(X=X, obs=obs, var=pd.DataFrame(index=pd.Index(genes, dtype=str)))
+    adata.layers['counts'] = counts
+    return adata
+
+
+if __name__ == "__main__":
+    prs = arp.ArgumentParser()
+    prs.add_argument('sc_input', type=str, help='single-cell reference (.rds or .h5ad)')
+    prs.add_argument('--target_sum', type=float, nargs='+', default=[1e4],
+                     help='counts per cell after normalization, one artifact each (default: 1e4)')
+    prs.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='directory of the artifacts')
+    args = prs.parse_args()
+
+    for target_sum in args.target_sum:
+        print(f"{target_sum:g}: {prepare(args.sc_input, target_sum, args.cache_dir)}")
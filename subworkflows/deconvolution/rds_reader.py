@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Python reader of the Seurat / synthspot .rds inputs: loads the count matrix (dgCMatrix), the cell
+metadata and, for synthetic datasets, relative_spot_composition straight into CSR / AnnData, with
+no R container and no intermediate h5ad.
+
+    from rds_reader import read_input
+    adata = read_input("reference.rds", annot="celltype")   # also reads .h5ad files
+
+The parser decodes R's XDR serialization format (gzip / bzip2 / xz compressed, versions 2 and 3)
+with numpy: numeric vectors are read in one frombuffer call, so a large dgCMatrix costs about the
+time of reading its bytes. Closures in bytecode form (BCODESXP) are not supported; they do not
+appear in the data slots of Seurat objects or synthspot lists.
+"""
+import bz2
+import gzip
+import lzma
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+NA_INTEGER = -2 ** 31
+
+# SEXP types and the special items of the serialization format
+NILSXP, SYMSXP, LISTSXP, CLOSXP, ENVSXP, PROMSXP, LANGSXP, SPECIALSXP, BUILTINSXP, CHARSXP = 0, 1, 2, 3, 4, 5, 6, 7, 8, 9
+LGLSXP, INTSXP, REALSXP, CPLXSXP, STRSXP, DOTSXP, VECSXP, EXPRSXP = 10, 13, 14, 15, 16, 17, 19, 20
+BCODESXP, EXTPTRSXP, WEAKREFSXP, RAWSXP, S4SXP = 21, 22, 23, 24, 25
+REFSXP, NILVALUE_SXP, GLOBALENV_SXP, UNBOUNDVALUE_SXP, MISSINGARG_SXP, BASENAMESPACE_SXP = 255, 254, 253, 252, 251, 250
+NAMESPACESXP, PACKAGESXP, PERSISTSXP, EMPTYENV_SXP, BASEENV_SXP = 249, 248, 247, 242, 241
+ATTRLANGSXP, ATTRLISTSXP, ALTREP_SXP = 240, 239, 238
+PAIRLIST_TYPES = (LISTSXP, LANGSXP, CLOSXP, PROMSXP, DOTSXP, ATTRLANGSXP, ATTRLISTSXP)
+LATIN1_MASK = 1 << 2
+OBSOLETE_PAIRLISTS = {ATTRLANGSXP: LANGSXP, ATTRLISTSXP: LISTSXP}
+
+
+class RSymbol(str):
+    pass
+
+
+class RObject:
+    """An R value: rtype (SEXP type), value (numpy array for atomic vectors, list for lists and
+    pairlists, None for S4 objects whose content is in their attributes / slots) and attributes."""
+    __slots__ = ('rtype', 'value', 'attributes')
+
+    def __init__(self, rtype, value=None, attributes=None):
+        self.rtype, self.value, self.attributes = rtype, value, attributes or {}
+
+    def attr(self, name, default=None):
+        return self.attributes.get(name, default)
+
+    @property
+    def classes(self):
+        cls = self.attributes.get('class')
+        return list(cls.value) if cls is not None else []
+
+    def __getitem__(self, name):
+        """Element of a named list (or slot of an S4 object)."""
+        if self.rtype == S4SXP:
+            return self.attributes[name]
+        names = list(self.attr('names').value)
+        return self.value[names.index(name)]
+
+    def __repr__(self):
+        size = len(self.value) if hasattr(self.value, '__len__') else ''
+        return f"RObject(type={self.rtype}, class={self.classes}, len={size})"
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       PARSER                                            !>
+# <! ------------------------------------------------------------------------!>
+
+def _decompress(raw):
+    if raw[:2] == b'\x1f\x8b':
+        return gzip.decompress(raw)
+    if raw[:3] == b'BZh':
+        return bz2.decompress(raw)
+    if raw[:6] == b'\xfd7zXZ\x00':
+        return lzma.decompress(raw)
+    return raw
+
+
+class _Parser:
+    def __init__(self, data):
+        self.data, self.pos, self.refs = memoryview(data), 0, []
+
+    def int(self):
+        value = int.from_bytes(self.data[self.pos:self.pos + 4], 'big', signed=True)
+        self.pos += 4
+        return value
+
+    def array(self, dtype, n):
+        size = np.dtype(dtype).itemsize * n
+        values = np.frombuffer(self.data, dtype=dtype, count=n, offset=self.pos)
+        self.pos += size
+        return values.astype(dtype.replace('>', '='))
+
+    def length(self):
+        n = self.int()
+        if n == -1:  # long vector
+            upper, lower = self.int(), self.int()
+            n = (upper << 32) + (lower & 0xFFFFFFFF)
+        return n
+
+    def string(self, levels):
+        n = self.int()
+        if n == -1:
+            return None
+        raw = bytes(self.data[self.pos:self.pos + n])
+        self.pos += n
+        return raw.decode('latin-1' if levels & LATIN1_MASK else 'utf-8', errors='replace')
+
+    def attributes(self, flags):
+        if not flags & (1 << 9):
+            return {}
+        return self.pairlist_dict(self.item())
+
+    @staticmethod
+    def pairlist_dict(pairlist):
+        if not isinstance(pairlist, RObject) or pairlist.rtype not in PAIRLIST_TYPES:
+            return {}
+        return {str(tag): value for tag, value in pairlist.value}
+
+    def header(self):
+        fmt = bytes(self.data[:2])
+        if fmt != b'X\n':
+            raise ValueError(f"Unsupported RDS format {fmt!r} (only the default XDR format is read)")
+        self.pos = 2
+        version = self.int()
+        self.int(), self.int()  # writer / minimal reader R versions
+        if version == 3:
+            n = self.int()
+            self.pos += n  # native encoding
+        elif version != 2:
+            raise ValueError(f"Unsupported serialization version {version}")
+
+    def pairlist(self, flags):
+        """Pairlist-like items (LISTSXP, LANGSXP, CLOSXP, ...) read iteratively: long pairlists would
+        exceed the recursion limit otherwise."""
+        rtype, items, attributes = OBSOLETE_PAIRLISTS.get(flags & 0xFF, flags & 0xFF), [], {}
+        while True:
+            if flags & 0xFF in OBSOLETE_PAIRLISTS:
+                flags |= 1 << 9  # always followed by attributes
+            attrs = self.attributes(flags)
+            if not items:
+                attributes = attrs
+            tag = self.item() if flags & (1 << 10) else None
+            items.append((tag, self.item()))
+            flags = self.int()
+            if flags & 0xFF not in PAIRLIST_TYPES:
+                tail = self.item(flags)
+                if not (isinstance(tail, RObject) and tail.rtype == NILSXP):
+                    items.append((None, tail))
+                return RObject(rtype, items, attributes)
+
+    def item(self, flags=None):
+        if flags is None:
+            flags = self.int()
+        rtype, levels = flags & 0xFF, flags >> 12
+
+        if rtype == NILVALUE_SXP:
+            return RObject(NILSXP)
+        if rtype in (EMPTYENV_SXP, BASEENV_SXP, GLOBALENV_SXP, BASENAMESPACE_SXP):
+            return RObject(ENVSXP, {})
+        if rtype in (UNBOUNDVALUE_SXP, MISSINGARG_SXP):
+            return RObject(NILSXP)
+        if rtype == REFSXP:
+            index = flags >> 8
+            return self.refs[(index if index else self.int()) - 1]
+        if rtype in (PERSISTSXP, NAMESPACESXP, PACKAGESXP):
+            self.int()  # 0
+            obj = RObject(ENVSXP, [self.item() for _ in range(self.int())])
+            self.refs.append(obj)
+            return obj
+        if rtype == SYMSXP:
+            obj = RSymbol(self.item())
+            self.refs.append(obj)
+            return obj
+        if rtype == ENVSXP:
+            obj = RObject(ENVSXP, {})
+            self.refs.append(obj)
+            self.int()  # locked
+            self.item()  # enclosing environment, not needed to read the frame
+            frame, hashtab, attributes = self.item(), self.item(), self.item()
+            obj.value.update(self.pairlist_dict(frame))
+            if isinstance(hashtab, RObject) and hashtab.rtype == VECSXP:
+                for bucket in hashtab.value:
+                    obj.value.update(self.pairlist_dict(bucket))
+            obj.attributes = self.pairlist_dict(attributes)
+            return obj
+        if rtype in PAIRLIST_TYPES:
+            return self.pairlist(flags)
+        if rtype == CHARSXP:
+            value = self.string(levels)
+            self.attributes(flags)  # read and dropped, as R does
+            return value
+        if rtype in (SPECIALSXP, BUILTINSXP):
+            return RObject(rtype, self.string(0))
+        if rtype == EXTPTRSXP:
+            obj = RObject(EXTPTRSXP)
+            self.refs.append(obj)
+            self.item(), self.item()
+            obj.attributes = self.attributes(flags)
+            return obj
+        if rtype == WEAKREFSXP:
+            obj = RObject(WEAKREFSXP)
+            self.refs.append(obj)
+            obj.attributes = self.attributes(flags)
+            return obj
+        if rtype == ALTREP_SXP:
+            return self.altrep()
+        if rtype == BCODESXP:
+            raise NotImplementedError("Byte-compiled closures (BCODESXP) are not supported")
+
+        if rtype in (LGLSXP, INTSXP):
+            value = self.array('>i4', self.length())
+        elif rtype == REALSXP:
+            value = self.array('>f8', self.length())
+        elif rtype == CPLXSXP:
+            value = self.array('>c16', self.length())
+        elif rtype == RAWSXP:
+            n = self.length()
+            value = np.frombuffer(self.data, dtype=np.uint8, count=n, offset=self.pos).copy()
+            self.pos += n
+        elif rtype == STRSXP:
+            value = np.array([self.item() for _ in range(self.length())], dtype=object)
+        elif rtype in (VECSXP, EXPRSXP):
+            value = [self.item() for _ in range(self.length())]
+        elif rtype == S4SXP:
+            value = None
+        else:
+            raise ValueError(f"Unsupported SEXP type {rtype} at byte {self.pos}")
+        return RObject(rtype, value, self.attributes(flags))
+
+    def altrep(self):
+        """ALTREP vectors written in compact form: compact sequences, deferred strings, wrappers."""
+        info, state, attributes = self.item(), self.item(), self.item()
+        cls = str(info.value[0][1])
+        if cls in ('compact_intseq', 'compact_realseq'):
+            n, start, step = state.value[:3]
+            value = start + step * np.arange(int(n))
+            rtype = INTSXP if cls == 'compact_intseq' else REALSXP
+            value = value.astype(np.int32 if rtype == INTSXP else np.float64)
+        elif cls == 'deferred_string':
+            numbers = state.value[0][1] if state.rtype in PAIRLIST_TYPES else state
+            rtype = STRSXP
+            if numbers.rtype == INTSXP:
+                value = np.array([None if v == NA_INTEGER else str(v) for v in numbers.value], dtype=object)
+            else:
+                value = np.array([None if np.isnan(v) else f"{v:.15g}" for v in numbers.value], dtype=object)
+        elif cls.startswith('wrap_'):
+            # state: CONS(wrapped vector, metadata)
+            wrapped = state.value[0][1] if state.rtype in PAIRLIST_TYPES else state
+            rtype, value = wrapped.rtype, wrapped.value
+        else:
+            raise NotImplementedError(f"Unsupported ALTREP class {cls}")
+        return RObject(rtype, value, self.pairlist_dict(attributes))
+
+
+def read_rds(path):
+    """Parse an .rds file into RObject values."""
+    with open(path, 'rb') as f:
+        parser = _Parser(_decompress(f.read()))
+    parser.header()
+    return parser.item()
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       R OBJECTS -> PYTHON                               !>
+# <! ------------------------------------------------------------------------!>
+
+def _names(obj):
+    return None if obj is None or obj.rtype == NILSXP else list(obj.value)
+
+
+def to_csr(matrix):
+    """dgCMatrix (genes x cells) -> (cells x genes CSR float32, cell names, gene names)."""
+    if 'dgCMatrix' not in matrix.classes:
+        raise ValueError(f"Expected a dgCMatrix, got {matrix.classes}")
+    n_rows, n_cols = matrix.attr('Dim').value
+    csc = sp.csc_matrix((matrix.attr('x').value.astype(np.float32), matrix.attr('i').value, matrix.attr('p').value),
+                        shape=(n_rows, n_cols))
+    dimnames = matrix.attr('Dimnames')
+    rows, cols = (_names(dimnames.value[0]), _names(dimnames.value[1])) if dimnames is not None else (None, None)
+    # The transpose of a CSC matrix is a CSR matrix on the same arrays: no copy.
+    return csc.T.tocsr(), cols, rows
+
+
+def to_series(obj, index=None):
+    if 'factor' in obj.classes:
+        codes = obj.value.astype(np.int64) - 1
+        codes[obj.value == NA_INTEGER] = -1
+        return pd.Series(pd.Categorical.from_codes(codes, categories=list(obj.attr('levels').value)), index=index)
+    if obj.rtype == LGLSXP:
+        return pd.Series(pd.array(np.where(obj.value == NA_INTEGER, None, obj.value != 0), dtype='boolean'), index=index)
+    if obj.rtype == INTSXP:
+        na = obj.value == NA_INTEGER
+        return pd.Series(np.where(na, np.nan, obj.value) if na.any() else obj.value, index=index)
+    return pd.Series(obj.value, index=index)
+
+
+def to_dataframe(obj):
+    """data.frame -> pandas DataFrame (factors as categoricals, row names as index)."""
+    row_names = obj.attr('row.names')
+    index = None
+    if row_names is not None and row_names.rtype == STRSXP:
+        index = pd.Index(row_names.value)
+    columns = _names(obj.attr('names')) or []
+    return pd.DataFrame({name: to_series(col, index) for name, col in zip(columns, obj.value)}, index=index)
+
+
+def _logmap_names(logmap, layer):
+    """Names of a Seurat v5 LogMap (features / cells) that belong to `layer`."""
+    names, layers = (_names(d) for d in logmap.attr('dimnames').value)
+    column = logmap.value.reshape(len(layers), len(names)).T[:, layers.index(layer)] if layers else None
+    return [n for n, keep in zip(names, column) if keep] if column is not None else names
+
+
+def seurat_counts(seurat, assay=None):
+    """Raw counts (cells x genes CSR), cell and gene names of a Seurat object (v3/v4 Assay or v5 Assay5)."""
+    assays = seurat['assays']
+    assay = assay or str(seurat['active.assay'].value[0])
+    obj = assays[assay]
+    if 'layers' in obj.attributes:
+        matrix = obj['layers']['counts']
+        counts, cells, genes = to_csr(matrix)
+        cells = cells or _logmap_names(obj['cells'], 'counts')
+        genes = genes or _logmap_names(obj['features'], 'counts')
+        return counts, cells, genes
+    return to_csr(obj['counts'])
+
+
+def read_counts(path, assay=None):
+    """Counts (cells/spots x genes CSR), obs DataFrame and gene names of a Seurat object or of a
+    synthspot list (obs then holds relative_spot_composition)."""
+    obj = read_rds(path)
+    if 'Seurat' in obj.classes:
+        counts, cells, genes = seurat_counts(obj, assay)
+        obs = to_dataframe(obj['meta.data'])
+        obs = obs.reindex(cells) if cells is not None and len(obs) else pd.DataFrame(index=cells)
+        return counts, obs, genes
+    if obj.rtype == VECSXP and 'counts' in (_names(obj.attr('names')) or []):
+        counts, spots, genes = to_csr(obj['counts'])
+        names = _names(obj.attr('names'))
+        obs = pd.DataFrame(index=spots)
+        if 'relative_spot_composition' in names:
+            composition = to_dataframe(obj['relative_spot_composition'])
+            if 'name' in composition.columns:
+                composition = composition.set_index('name')
+            obs = composition.drop(columns=[c for c in ('region',) if c in composition.columns]).reindex(spots)
+        return counts, obs, genes
+    raise ValueError(f"{path}: expected a Seurat object or a synthspot list with 'counts', got {obj.classes}")
+
+
+def read_input(path, annot=None, assay=None):
+    """AnnData of an .h5ad or .rds input (the methods' readers go through this function).
+    For .rds files, X holds the raw counts and obs the metadata (annot as a string column)."""
+    import anndata
+
+    if not path.lower().endswith('.rds'):
+        return anndata.read_h5ad(path)
+    counts, obs, genes = read_counts(path, assay)
+    if annot and annot in obs.columns:
+        obs[annot] = obs[annot].astype(str)
+    obs.index = obs.index.astype(str)
+    return anndata.AnnData(X=counts, obs=obs, var=pd.DataFrame(index=pd.Index(genes, dtype=str)))
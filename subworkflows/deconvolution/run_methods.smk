@@ -4,6 +4,8 @@ import sys
 import yaml
 
 methods = config["methods"].split(',')   
+# Shared sc / sp conversions (cached_h5ad), defined before the methods that use them
+include: "convert_h5ad.smk"
 # Dynamically include the appropriate pipelines based on the selected methods
 for method in methods:
     method = method.strip()  
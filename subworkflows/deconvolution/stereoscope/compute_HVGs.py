@@ -1,6 +1,9 @@
-import scanpy as sc
+import os
 import sys
 import re
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from normalized_reference import DEFAULT_CACHE_DIR, normalized_input
+import hvgs
 
 args = " ".join(sys.argv[1:])
 
@@ -11,12 +14,18 @@ n_hvgs = m.group(0)
 m = re.search('(?<=--sc_cnt )[^ ]+', args)
 sc_path = m.group(0)
 
-print("Computing {} HVGs from {}...".format(n_hvgs, sc_path))
+m = re.search('(?<=--norm_cache )[^ ]+', args)
+norm_cache = m.group(0) if m else DEFAULT_CACHE_DIR
+
+m = re.search('(?<=--hvg_cache )[^ ]+', args)
+hvg_cache = m.group(0) if m else hvgs.DEFAULT_CACHE_DIR
 
-adata = sc.read_h5ad(sc_path)
+print("Computing {} HVGs from {}...".format(n_hvgs, sc_path))
 
-sc.pp.normalize_total(adata, target_sum=1e4)
-sc.pp.log1p(adata)
-sc.pp.highly_variable_genes(adata, n_top_genes=int(n_hvgs), subset=True)
+# Normalized and logarithmized once for all the methods
+adata = normalized_input(sc_path, 1e4, cache_dir=norm_cache)
+# Streamed over blocks of cells (flavor 'seurat', as sc.pp.highly_variable_genes) and cached
+genes = hvgs.highly_variable_genes(adata.X, adata.var_names, 'seurat', int(n_hvgs), sc_path=sc_path,
+                                   target_sum=1e4, cache_dir=hvg_cache)
 
-adata.var_names.to_frame().to_csv("hvgs.txt", header=False, index=False)
\ No newline at end of file
+adata.var_names[adata.var_names.isin(genes)].to_frame().to_csv("hvgs.txt", header=False, index=False)
\ No newline at end of file
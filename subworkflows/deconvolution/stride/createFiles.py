@@ -1,17 +1,20 @@
-import scanpy as sc
+import os
 import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lazy_input import open_input, materialize  # .h5ad (backed) or .rds inputs
 
 
 filename = sys.argv[1]
 annot = sys.argv[2]
 
-adata = sc.read_h5ad(filename)
+# The annotation is in obs: the matrix is only read for the 500 cells of the dummy file
+adata = open_input(filename, annot)
 print("Writing the celltype annotation as annot.txt...")
 adata.obs[annot].to_csv('annot.txt', sep='\t', header=False)
 
 if len(sys.argv) > 3:
     print("Saving dummy ST file containing first 500 rows of sc file...")
-    dummy_st = adata[:500,:]     
+    dummy_st = materialize(adata, cells=slice(0, 500))
     try:
         dummy_st.write_h5ad("dummy_st.h5ad")
     except ValueError:
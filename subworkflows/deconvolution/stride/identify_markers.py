@@ -1,7 +1,10 @@
-import scanpy as sc
 import pandas as pd
+import os
 import sys
 import re
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from normalized_reference import DEFAULT_CACHE_DIR, normalized_input
+import markers as marker_genes
 
 args = " ".join(sys.argv[1:])
 
@@ -15,17 +18,28 @@ sc_path = m.group(0)
 m = re.search('(?<=--annot )[^ ]+', args)
 celltype = m.group(0)
 
-print("Computing {} markers from {}...".format(n_markers, sc_path))
+m = re.search('(?<=--norm-cache )[^ ]+', args)
+norm_cache = m.group(0) if m else DEFAULT_CACHE_DIR
+
+# Marker computation: fast (sparse, markers.py) or scanpy, optionally on a per cell type subsample
+m = re.search('(?<=--marker-backend )[^ ]+', args)
+backend = m.group(0) if m else 'fast'
+
+m = re.search('(?<=--marker-cells )[0-9]+', args)
+max_cells = int(m.group(0)) if m else None
 
-adata = sc.read_h5ad(sc_path)
+m = re.search('(?<=--marker-cache )[^ ]+', args)
+marker_cache = m.group(0) if m else marker_genes.DEFAULT_CACHE_DIR
+
+print("Computing {} markers from {}...".format(n_markers, sc_path))
 
-sc.pp.normalize_total(adata, target_sum=1e4)
-sc.pp.log1p(adata)
-adata.raw = adata
-sc.tl.rank_genes_groups(adata, celltype, method='wilcoxon', n_genes=n_markers)
+# Normalized and logarithmized once for all the methods
+adata = normalized_input(sc_path, 1e4, celltype, norm_cache)
+markers_df = marker_genes.markers(adata, sc_path, celltype, method='wilcoxon', n_genes=n_markers, target_sum=1e4,
+                                  max_cells=max_cells, backend=backend, cache_dir=marker_cache)
 
 markers = []
-for i in adata.uns['rank_genes_groups']['names']:
+for i in markers_df.itertuples(index=False):
     markers.extend(i)
     
 pd.DataFrame(set(markers)).to_csv("markers.txt", header=False, index=False)
\ No newline at end of file
@@ -3,13 +3,16 @@ import argparse as arp
 import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import early_stopping  # --early_stopping / --patience / --rel_tol
+
 ##### PARSING COMMAND LINE ARGUMENTS #####
 prs = arp.ArgumentParser()
 
 prs.add_argument('sc_data_path',
-                    type = str, help = 'path to single cell h5ad count data')
+                    type = str, help = 'path to single cell h5ad (or Seurat rds) count data')
 
-prs.add_argument('sp_data_path', type = str, help = 'path to h5ad spatial data')
+prs.add_argument('sp_data_path', type = str, help = 'path to h5ad (or Seurat / synthspot rds) spatial data')
 
 prs.add_argument('cuda_device', type = str, help = "index of cuda device ID or cpu")
 
@@ -34,6 +37,20 @@ prs.add_argument('-m', '--mode', default="clusters", type = str,
 prs.add_argument('-d', '--density_prior', default="rna_count_based", type = str,
                 help = "density prior of the deconvolution")
 
+prs.add_argument('--norm_cache', default=".deconvolista_cache/normalized", type = str,
+                help = "directory of the normalized references shared between methods")
+
+prs.add_argument('--marker_backend', default="fast", type = str,
+                help = "marker gene computation: fast (sparse, markers.py) or scanpy")
+
+prs.add_argument('--marker_cells', default=None, type = int,
+                help = "subsample the reference to this number of cells per cell type for the markers")
+
+prs.add_argument('--marker_cache', default=".deconvolista_cache/markers", type = str,
+                help = "directory of the cached marker genes")
+
+early_stopping.add_arguments(prs, patience=50)
+
 args = prs.parse_args()
 cuda_device = args.cuda_device
 
@@ -44,37 +61,38 @@ if args.cell_count_file:
     assert os.path.exists(args.cell_count_file), "cell count file not found"
 assert args.mode in ['cells', 'clusters', 'constrained'], "deconvolution mode must be either, cells, clusters, or constrained"
 assert args.density_prior in ['rna_count_based', 'uniform'], "density prior must be either rna_count_based or uniform"
+assert args.marker_backend in ['fast', 'scanpy'], "marker backend must be either fast or scanpy"
 
 print("Parameters\n==========")
 print("Training epochs: {}".format(args.epochs))
 print("Deconvolution mode: {}".format(args.mode))
 print("Density prior: {}".format(args.density_prior))
 print("Number of top markers: {}".format(args.n_top_markers))
+print("Early stopping: {}".format(f"patience {args.patience}, rel_tol {args.rel_tol}" if args.early_stopping else "off"))
 print("==========")
 
 ##### MAIN CODE #####
-import scanpy as sc
 import tangram as tg
+from rds_reader import read_input  # .h5ad or .rds inputs
+from normalized_reference import normalized_input
+from markers import markers as marker_genes
 import pandas as pd
 import numpy as np
 
 if cuda_device.isdigit():
     os.environ["CUDA_VISIBLE_DEVICES"]=cuda_device
 
-## scRNA reference (raw counts)
-print("Reading scRNA-seq data from " + args.sc_data_path + "...")
-sc_adata = sc.read_h5ad(args.sc_data_path)
+## scRNA reference, normalized and logarithmized once for all the methods
+print("Reading normalized scRNA-seq data of " + args.sc_data_path + "...")
+sc_adata = normalized_input(args.sc_data_path, 10e4, args.annotation_column, args.norm_cache)
 
 print("Reading spatial data from " + args.sp_data_path + "...")
-sp_adata = sc.read_h5ad(args.sp_data_path)
-
-print("Normalizing and logarithmizing data...")
-sc.pp.normalize_total(sc_adata, target_sum=10e4)
-sc.pp.log1p(sc_adata)
+sp_adata = read_input(args.sp_data_path)
 
 print("Getting marker genes...")
-sc.tl.rank_genes_groups(sc_adata, groupby=args.annotation_column, use_raw=False)
-markers_df = pd.DataFrame(sc_adata.uns["rank_genes_groups"]["names"]).iloc[0:args.n_top_markers, :]
+markers_df = marker_genes(sc_adata, args.sc_data_path, args.annotation_column, method='t-test',
+                          n_genes=args.n_top_markers, target_sum=10e4, max_cells=args.marker_cells,
+                          backend=args.marker_backend, cache_dir=args.marker_cache)
 markers = list(np.unique(markers_df.melt().value.values))
 tg.pp_adatas(sc_adata, sp_adata, genes=markers)
 
@@ -142,15 +160,19 @@ print("==========")
 
 
 # Deconvolution
-ad_map = tg.map_cells_to_space(
-    sc_adata, sp_adata,
-    mode=deconv_mode,
-    target_count=target_counts,
-    density_prior=density_prior,
-    cluster_label=None if deconv_mode != "clusters" else args.annotation_column,
-    num_epochs=args.epochs,
-    device='cuda:'+cuda_device if cuda_device.isdigit() else cuda_device
-)
+plateau = early_stopping.from_args(args)
+with early_stopping.tangram_training(plateau):
+    ad_map = tg.map_cells_to_space(
+        sc_adata, sp_adata,
+        mode=deconv_mode,
+        target_count=target_counts,
+        density_prior=density_prior,
+        cluster_label=None if deconv_mode != "clusters" else args.annotation_column,
+        num_epochs=args.epochs,
+        device='cuda:'+cuda_device if cuda_device.isdigit() else cuda_device
+    )
+if plateau:
+    print(plateau.report(args.epochs))
 
 tg.project_cell_annotations(ad_map, sp_adata, annotation=args.annotation_column)
 
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmarks for the data preparation steps of sp_visualizer.py, run on synthetic
+proportion matrices (Dirichlet draws, sparse like the output of most methods).
+
+    python3 subworkflows/visualization/benchmark_visualizer.py top_n --spots 5000,50000,500000
+    python3 subworkflows/visualization/benchmark_visualizer.py disagreement --methods 6
+    python3 subworkflows/visualization/benchmark_visualizer.py loader --methods 6
+    python3 subworkflows/visualization/benchmark_visualizer.py html --spots 5000,50000
+    python3 subworkflows/visualization/benchmark_visualizer.py image --pixels 2000,8000,20000
+    python3 subworkflows/visualization/benchmark_visualizer.py frames --spots 10000,100000 --out frames/
+"""
+import argparse as arp
+import html
+import json
+import math
+import os
+import re
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from PIL import Image
+
+import sp_visualizer
+
+
+def synthetic_proportions(n_spots, n_cell_types=50, seed=0):
+    rng = np.random.default_rng(seed)
+    props = rng.dirichlet(np.full(n_cell_types, 0.3), size=n_spots)
+    props[props < 0.01] = 0
+    props /= props.sum(axis=1, keepdims=True)
+    barcodes = [f"spot{i}" for i in range(n_spots)]
+    cell_types = [f"celltype{j}" for j in range(n_cell_types)]
+    return pd.DataFrame(props, index=barcodes, columns=cell_types)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       TOP-N CELL TYPES (process_data)                   !>
+# <! ------------------------------------------------------------------------!>
+
+def legacy_top_n(norm_weights_df, n_largest_cell_types):
+    # Row-wise nlargest + per-barcode .loc lookups, as process_data used to do it
+    max_weights = norm_weights_df.apply(lambda x: x.nlargest(n_largest_cell_types).index.values, axis=1)
+    types, values = [], []
+    for i in range(n_largest_cell_types):
+        types.append([max_weights.loc[b][i] for b in max_weights.index])
+        values.append([norm_weights_df.loc[b, max_weights.loc[b][i]] for b in max_weights.index])
+    return types, values
+
+
+def bench_top_n(spots, n_largest_cell_types, legacy_max_spots):
+    print(f"{'spots':>10} {'legacy (s)':>12} {'numpy (s)':>12} {'speedup':>9}")
+    for n_spots in spots:
+        df = synthetic_proportions(n_spots)
+        t_new, (top_types, top_values, _) = timed(
+            sp_visualizer.top_n_cell_types, df.to_numpy(), df.columns, n_largest_cell_types)
+        if n_spots <= legacy_max_spots:
+            t_old, (old_types, old_values) = timed(legacy_top_n, df, n_largest_cell_types)
+            assert (np.array(old_types).T == top_types).all()
+            assert np.allclose(np.array(old_values).T, top_values)
+            print(f"{n_spots:>10} {t_old:>12.3f} {t_new:>12.3f} {t_old / t_new:>8.0f}x")
+        else:
+            print(f"{n_spots:>10} {'skipped':>12} {t_new:>12.3f} {'-':>9}")
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                  METHODS DISAGREEMENT (post_process_data)               !>
+# <! ------------------------------------------------------------------------!>
+
+def legacy_disagreement(dfs):
+    # Row-wise apply over the merged proportions, as post_process_data used to do it
+    def stddev(vector):
+        mean = sum(vector) / len(vector)
+        return math.sqrt(sum((x - mean) ** 2 for x in vector) / len(vector))
+    cell_types = dfs[0].columns
+    merged = pd.concat([df.add_prefix(f"m{i}_") for i, df in enumerate(dfs)], axis=1)
+    if len(dfs) == 2:
+        return merged.apply(lambda row: math.sqrt(sum(
+            (row[f"m0_{t}"] - row[f"m1_{t}"]) ** 2 for t in cell_types) / len(cell_types)), axis=1)
+    return merged.apply(lambda row: stddev(
+        [stddev([row[f"m{i}_{t}"] for i in range(len(dfs))]) for t in cell_types]), axis=1)
+
+
+def vectorized_disagreement(dfs):
+    stacked = sp_visualizer.stack_method_proportions(dfs, dfs[0].index, dfs[0].columns)
+    return sp_visualizer.disagreement_metrics(stacked)
+
+
+def bench_disagreement(spots, n_methods, legacy_max_spots):
+    print(f"{n_methods} methods")
+    print(f"{'spots':>10} {'legacy (s)':>12} {'numpy (s)':>12} {'speedup':>9}")
+    for n_spots in spots:
+        dfs = [synthetic_proportions(n_spots, seed=m) for m in range(n_methods)]
+        t_new, metrics = timed(vectorized_disagreement, dfs)
+        error_value = metrics['rmsd'] if n_methods == 2 else metrics['std_of_std']
+        if n_spots <= legacy_max_spots:
+            t_old, old = timed(legacy_disagreement, dfs)
+            assert np.allclose(old.to_numpy(), error_value, atol=1e-6)
+            print(f"{n_spots:>10} {t_old:>12.3f} {t_new:>12.3f} {t_old / t_new:>8.0f}x")
+        else:
+            print(f"{n_spots:>10} {'skipped':>12} {t_new:>12.3f} {'-':>9}")
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       PROPORTIONS LOADING                               !>
+# <! ------------------------------------------------------------------------!>
+
+def write_r_style_tsv(df, filepath):
+    # Same layout as R write.table(row.names=TRUE): no header field for the barcodes
+    with open(filepath, 'w') as f:
+        f.write('\t'.join(df.columns) + '\n')
+        df.to_csv(f, sep='\t', header=False)
+
+
+def legacy_loading(filepaths):
+    # Each TSV used to be parsed by process_data, post_process_data, _composition (per
+    # clustering, 2 with the toggle) and for full_props
+    for _ in range(5):
+        for fp in filepaths:
+            pd.read_csv(fp, sep='\t')
+
+
+def cached_loading(filepaths):
+    sp_visualizer._file_cache.clear()
+    for _ in range(5):
+        for fp in filepaths:
+            sp_visualizer.read_proportions(fp)
+
+
+def bench_loader(spots, n_methods):
+    engine = 'pyarrow' if sp_visualizer.pa_csv is not None else 'pandas'
+    print(f"{n_methods} methods, loader engine: {engine}")
+    print(f"{'spots':>10} {'legacy (s)':>12} {'cached (s)':>12} {'speedup':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_spots in spots:
+            filepaths = []
+            for m in range(n_methods):
+                filepaths.append(os.path.join(tmp, f"proportions_{m}_{n_spots}.tsv"))
+                write_r_style_tsv(synthetic_proportions(n_spots, seed=m), filepaths[-1])
+            t_old, _ = timed(legacy_loading, filepaths)
+            t_new, _ = timed(cached_loading, filepaths)
+            print(f"{n_spots:>10} {t_old:>12.3f} {t_new:>12.3f} {t_old / t_new:>8.1f}x")
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       STANDALONE HTML                                   !>
+# <! ------------------------------------------------------------------------!>
+
+def write_synthetic_sample(tmp, n_spots, n_methods, n_clusters=8):
+    # Visium-like grid of spots, a 2-clustering toggle and a plain tissue image
+    side = int(np.ceil(np.sqrt(n_spots)))
+    rng = np.random.default_rng(0)
+    props = [synthetic_proportions(n_spots, seed=m) for m in range(n_methods)]
+    barcodes = props[0].index
+    filepaths = []
+    for m, df in enumerate(props):
+        filepaths.append(os.path.join(tmp, f"proportions_{m}.tsv"))
+        write_r_style_tsv(df, filepaths[-1])
+    rows, cols = np.arange(n_spots) // side, np.arange(n_spots) % side
+    pd.DataFrame({0: barcodes, 1: 1, 2: rows, 3: cols, 4: rows * 20 + 10, 5: cols * 20 + 10}).to_csv(
+        os.path.join(tmp, "positions.csv"), header=False, index=False)
+    for name in ("clustering.csv", "clustering2.csv"):
+        pd.DataFrame({"BayesSpace": rng.integers(1, n_clusters + 1, n_spots)}, index=barcodes).to_csv(
+            os.path.join(tmp, name))
+    Image.new("RGB", (side * 20 + 20, side * 20 + 20), (230, 200, 210)).save(os.path.join(tmp, "image.png"))
+    return filepaths
+
+
+def embedded_document_load(output_html):
+    # Size of the embedded Bokeh document and time to parse it (proxy of the browser load)
+    with open(output_html) as f:
+        match = re.search(r'<script type="application/json" id="[^"]+">\s*(.*?)\s*</script>', f.read(), re.S)
+    start = time.perf_counter()
+    json.loads(html.unescape(match.group(1)))
+    return len(match.group(1)), time.perf_counter() - start
+
+
+def bench_html(spots, n_methods, encodings):
+    print(f"{n_methods} methods")
+    print(f"{'spots':>10} {'encoding':>9} {'build (s)':>10} {'HTML (MB)':>10} {'doc (MB)':>9} {'parse (s)':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_spots in spots:
+            filepaths = write_synthetic_sample(tmp, n_spots, n_methods)
+            for encoding in encodings:
+                sp_visualizer._file_cache.clear()
+                output_html = os.path.join(tmp, f"{n_spots}_{encoding}.html")
+                t_build, _ = timed(
+                    sp_visualizer.generate_visualization, filepaths, os.path.join(tmp, "positions.csv"),
+                    os.path.join(tmp, "clustering.csv"), os.path.join(tmp, "image.png"), 5, 1.0, output_html,
+                    [f"method{m}" for m in range(n_methods)], os.path.join(tmp, "clustering2.csv"),
+                    ["Seurat", "BayesSpace"], encoding)
+                doc_size, t_parse = embedded_document_load(output_html)
+                print(f"{n_spots:>10} {encoding:>9} {t_build:>10.2f} {os.path.getsize(output_html) / 1e6:>10.1f} "
+                      f"{doc_size / 1e6:>9.1f} {t_parse:>10.2f}")
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       FRAME TIME (browser)                              !>
+# <! ------------------------------------------------------------------------!>
+
+# Appended to the generated HTML: shows the first method's plot, pans it 60 times, and reports the
+# median / 95th percentile time per rendered frame in the page title, a banner and the console.
+FRAME_TIMER_JS = """
+<script>
+window.addEventListener('load', () => setTimeout(async () => {
+  const doc = Bokeh.documents[0], plots = [];
+  for (const m of doc.all_models) if (m.title && m.title.text !== undefined && 'x_range' in m) plots.push(m);
+  const plot = plots.find(m => m.title.text.startsWith('Deconvolution results - '));
+  for (const m of plots) m.visible = (m === plot);
+  const xr = plot.x_range, step = (xr.end - xr.start) / 200, frame = () => new Promise(r => requestAnimationFrame(r));
+  await frame(); await frame();
+  const times = [];
+  for (let i = 0; i < 60; i++) {
+    const t0 = performance.now(), dx = i < 30 ? step : -step;
+    xr.setv({start: xr.start + dx, end: xr.end + dx});
+    await frame(); await frame();
+    times.push(performance.now() - t0);
+  }
+  times.sort((a, b) => a - b);
+  const msg = `frame ms: median ${times[30].toFixed(1)}, p95 ${times[57].toFixed(1)}`;
+  document.title = msg; console.log(msg);
+  document.body.insertAdjacentHTML('afterbegin', `<div id="frame-timer" style="font:16px monospace">${msg}</div>`);
+}, 1000));
+</script>
+"""
+
+
+def bench_frames(spots, n_methods, out_dir, backends):
+    # Frame times need a browser: writes one page per (spots, backend), to open one by one
+    os.makedirs(out_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_spots in spots:
+            filepaths = write_synthetic_sample(tmp, n_spots, n_methods)
+            for backend in backends:
+                sp_visualizer._file_cache.clear()
+                output_html = os.path.join(out_dir, f"frames_{n_spots}_{backend}.html")
+                sp_visualizer.generate_visualization(
+                    filepaths, os.path.join(tmp, "positions.csv"), os.path.join(tmp, "clustering.csv"),
+                    os.path.join(tmp, "image.png"), 5, 1.0, output_html, [f"method{m}" for m in range(n_methods)],
+                    os.path.join(tmp, "clustering2.csv"), ["Seurat", "BayesSpace"], 'compact', 'tiles', 'jpeg', backend)
+                with open(output_html) as f:
+                    page = f.read()
+                with open(output_html, 'w') as f:
+                    f.write(page.replace("</body>", FRAME_TIMER_JS + "</body>"))
+                print(f"{output_html}: {n_spots} spots, {backend}")
+    print("Open each page in a browser; the frame times appear on top of the page and in its title.")
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       TISSUE IMAGE                                      !>
+# <! ------------------------------------------------------------------------!>
+
+def synthetic_tissue_image(filepath, size):
+    # Smooth H&E-like colors (compress like a real section, unlike noise)
+    ramp = np.linspace(0, 1, size, dtype=np.float32)
+    shade = np.add.outer(np.sin(ramp * 20), np.cos(ramp * 13)) * 0.25 + 0.5
+    rgb = np.stack([200 + 40 * shade, 120 + 60 * shade, 180 + 40 * shade], axis=-1).astype(np.uint8)
+    Image.fromarray(rgb).save(filepath)
+
+
+def full_decode_size(image_path):
+    # What get_image_display_infos used to do to read the size
+    return Image.open(image_path).convert("RGB").size
+
+
+def bench_image(pixels, tile_format):
+    print(f"tiles: {sp_visualizer.TILE_SIZE}px {tile_format}")
+    print(f"{'pixels':>8} {'embed (MB)':>11} {'decode (s)':>11} {'probe (s)':>10} {'pyramid (s)':>12} "
+          f"{'tiles':>7} {'first view (MB)':>16}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in pixels:
+            image_path = os.path.join(tmp, f"image_{size}.png")
+            synthetic_tissue_image(image_path, size)
+            embed_size = len(sp_visualizer.image_to_base64(image_path))
+            t_decode, _ = timed(full_decode_size, image_path)
+            t_probe, _ = timed(sp_visualizer.get_image_display_infos, image_path)
+            tiles_dir = os.path.join(tmp, f"tiles_{size}")
+            t_pyramid, max_zoom = timed(sp_visualizer.write_tile_pyramid, image_path, tiles_dir,
+                                        sp_visualizer.TILE_SIZE, tile_format)
+            tiles = [os.path.join(d, f) for d, _, fs in os.walk(tiles_dir) for f in fs if f != 'tiles.json']
+            # A 900px wide plot showing the whole section loads the level whose width is <= 1024px
+            first_level = os.path.join(tiles_dir, str(min(max_zoom, 2)))
+            first_view = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(first_level) for f in fs)
+            print(f"{size:>8} {embed_size / 1e6:>11.1f} {t_decode:>11.3f} {t_probe:>10.4f} {t_pyramid:>12.2f} "
+                  f"{len(tiles):>7} {first_view / 1e6:>16.2f}")
+
+
+if __name__ == "__main__":
+    prs = arp.ArgumentParser()
+    prs.add_argument('benchmark', choices=['top_n', 'disagreement', 'loader', 'html', 'image', 'frames'], help='step of the visualizer to benchmark')
+    prs.add_argument('--spots', default='5000,50000,500000', type=str,
+                     help='comma separated numbers of synthetic spots')
+    prs.add_argument('-n', '--n_largest_cell_types', default=5, type=int,
+                     help='number of top cell types per spot')
+    prs.add_argument('--methods', default=3, type=int,
+                     help='number of deconvolution methods compared')
+    prs.add_argument('--legacy_max_spots', default=50000, type=int,
+                     help='largest matrix on which the legacy pandas code is also timed')
+    prs.add_argument('--out', default='frames', type=str,
+                     help='directory of the pages written by the frames benchmark')
+    prs.add_argument('--pixels', default='2000,8000,20000', type=str,
+                     help='comma separated sizes (pixels per side) of the synthetic tissue images')
+    prs.add_argument('--tile_format', default='jpeg', choices=sorted(sp_visualizer.TILE_EXTENSIONS),
+                     help='image format of the tiles')
+    args = prs.parse_args()
+    spots = [int(s) for s in args.spots.split(',')]
+
+    if args.benchmark == 'top_n':
+        bench_top_n(spots, args.n_largest_cell_types, args.legacy_max_spots)
+    elif args.benchmark == 'disagreement':
+        bench_disagreement(spots, args.methods, args.legacy_max_spots)
+    elif args.benchmark == 'loader':
+        bench_loader(spots, args.methods)
+    elif args.benchmark == 'html':
+        bench_html(spots, args.methods, ['json', 'compact'])
+    elif args.benchmark == 'frames':
+        bench_frames(spots, args.methods, args.out, ['canvas', 'webgl'])
+    elif args.benchmark == 'image':
+        bench_image([int(s) for s in args.pixels.split(',')], args.tile_format)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+
+Server mode of sp_visualizer.py, for sections too large for a standalone HTML file.
+The processed matrices stay in this Python process: the browser only receives the spots of
+the current viewport, aggregated into hexagons when too many are visible, and the cell-type
+heatmap / pie of selected types layers are computed here on demand.
+
+    python3 subworkflows/visualization/sp_visualizer.py <same arguments> --serve 5006
+"""
+# <! ------------------------------------------------------------------------!>
+# <!                       IMPORTS                                           !>
+# <! ------------------------------------------------------------------------!>
+import os
+from functools import partial
+from math import pi
+
+import numpy as np
+import pandas as pd
+
+from bokeh.events import RangesUpdate
+from bokeh.layouts import column, row
+from bokeh.models import ColumnDataSource, Div, HoverTool, MultiChoice, RadioButtonGroup, Range1d, Select, Slider
+from bokeh.palettes import Viridis256
+from bokeh.plotting import figure
+from bokeh.util.hex import axial_to_cartesian, cartesian_to_axial
+
+from sp_visualizer import (clusters_colordict, colordict, get_image_display_infos, post_process_data,
+                           read_proportions, stack_method_proportions, tissue_tile_source)
+
+LAYERS = ['Clusters', 'Top cell type', 'Cell-type heatmap', 'Pie of selected types', 'Methods disagreement']
+MAX_PIE_TYPES = 8
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       SPOT STORE (server side data)                     !>
+# <! ------------------------------------------------------------------------!>
+
+class SpotStore:
+    """All the spots of a section, kept in memory and queried by viewport.
+
+    Per-spot data are flat NumPy arrays aligned on `barcodes`, the proportions of all methods
+    one (methods x spots x cell types) float32 array.
+    """
+
+    def __init__(self, norm_weights_filepaths, st_coords_filepath, data_clustered, deconv_methods,
+                 n_largest_cell_types, scale_factor, data_clustered2=None, max_spots=20000, hexes_across=120):
+        data = post_process_data(norm_weights_filepaths=norm_weights_filepaths, st_coords_filepath=st_coords_filepath,
+                                 data_clustered=data_clustered, deconv_methods=deconv_methods,
+                                 n_largest_cell_types=n_largest_cell_types, scale_factor=scale_factor,
+                                 data_clustered2=data_clustered2)
+        data = data[data["in_tissue"] == 1].reset_index(drop=True)
+        self.deconv_methods = list(deconv_methods)
+        self.barcodes = data["barcode"].to_numpy()
+        self.x = data["pxl_col_in_fullres"].to_numpy(dtype=np.float64) / 2
+        self.y = -data["pxl_row_in_fullres"].to_numpy(dtype=np.float64) / 2
+        self.clusters = [data["Cluster"].fillna(0).to_numpy(dtype=np.int64),
+                         data["Cluster2" if "Cluster2" in data.columns else "Cluster"].fillna(0).to_numpy(dtype=np.int64)]
+        full_props = [read_proportions(fp) for fp in norm_weights_filepaths]
+        self.cell_types = list(full_props[0].columns)
+        self.props = stack_method_proportions(full_props, self.barcodes, self.cell_types)
+        self.error = data["error_value"].to_numpy(dtype=np.float64)
+        self.error_range = (float(self.error.min()), float(self.error.max())) if len(self.error) else (0.0, 1.0)
+        self.ct_colors = np.array([colordict.get(ct, "#000000") for ct in self.cell_types])
+        self.max_spots = max_spots
+        self.hexes_across = hexes_across
+
+        # Spot radius from the actual spot spacing (median nearest-neighbour distance), as in the HTML
+        xy = np.column_stack([self.x, self.y])
+        if len(xy) > 1:
+            samp = xy[np.random.RandomState(0).choice(len(xy), min(300, len(xy)), replace=False)]
+            d = np.sqrt(((samp[:, None, :] - xy[None, :, :]) ** 2).sum(-1))
+            d[d == 0] = np.inf
+            self.spot_radius = float(np.median(d.min(axis=1))) * 0.5
+        else:
+            self.spot_radius = 4.7
+
+    def visible(self, x0, x1, y0, y1):
+        """Indices of the spots inside the viewport."""
+        return np.flatnonzero((self.x >= x0) & (self.x <= x1) & (self.y >= y0) & (self.y <= y1))
+
+    def hexbin(self, idx, size):
+        """Hexagon (pointytop, `size` plot units) of each visible spot: returns the axial
+        coordinates of the occupied hexagons and each spot's hexagon number."""
+        q, r = cartesian_to_axial(self.x[idx], self.y[idx], size, "pointytop")
+        span = int(r.max() - r.min()) + 1
+        _, first, inverse = np.unique((q - q.min()) * span + (r - r.min()), return_index=True, return_inverse=True)
+        return q[first], r[first], inverse
+
+    @staticmethod
+    def aggregate_mean(values, inverse, n_groups):
+        """Mean of `values` (spots, or spots x columns) per group."""
+        order = np.argsort(inverse, kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0])
+        sums = np.add.reduceat(values[order], starts, axis=0)
+        counts = np.bincount(inverse, minlength=n_groups).astype(np.float64)
+        return sums / (counts[:, None] if sums.ndim == 2 else counts)
+
+    @staticmethod
+    def aggregate_mode(labels, inverse, n_groups):
+        """Most frequent label per group."""
+        uniq, codes = np.unique(labels, return_inverse=True)
+        counts = np.bincount(inverse * len(uniq) + codes, minlength=n_groups * len(uniq)).reshape(n_groups, len(uniq))
+        return uniq[counts.argmax(axis=1)]
+
+    def query(self, x0, x1, y0, y1, layer, method, selected_types, clustering):
+        """Data of the three layers (spots, hexagons, pie wedges) for the viewport."""
+        idx = self.visible(x0, x1, y0, y1)
+        m = self.deconv_methods.index(method)
+        sel = [self.cell_types.index(ct) for ct in selected_types if ct in self.cell_types][:MAX_PIE_TYPES]
+
+        lod = len(idx) > self.max_spots
+        if lod:
+            size = max((x1 - x0) / self.hexes_across / np.sqrt(3), self.spot_radius)
+            q, r, inverse = self.hexbin(idx, size)
+            n_groups = len(q)
+            cx, cy = axial_to_cartesian(q, r, size, "pointytop")
+            counts = np.bincount(inverse, minlength=n_groups)
+            radius = size * 0.8
+        else:
+            size = self.spot_radius
+            cx, cy = self.x[idx], self.y[idx]
+            radius = self.spot_radius
+
+        def mean(values):
+            # Per-spot values, or their mean per hexagon when zoomed out
+            return self.aggregate_mean(values, inverse, n_groups) if lod else values
+        props = self.props[m][idx]
+
+        # Color + label of each spot / hexagon for the active layer
+        wedges = dict(x=[], y=[], start=[], end=[], color=[], label=[], radius=[])
+        if layer == 'Clusters':
+            labels = self.clusters[clustering][idx]
+            groups = self.aggregate_mode(labels, inverse, n_groups) if lod else labels
+            colors = pd.Series(groups).map(clusters_colordict).fillna("#000000").to_numpy()
+            label = pd.Series(groups).astype(str).radd("Cluster ").to_numpy()
+        elif layer == 'Top cell type':
+            top = mean(props).argmax(axis=1) if len(idx) else np.zeros(0, dtype=np.int64)
+            colors = self.ct_colors[top]
+            label = np.array(self.cell_types, dtype=object)[top]
+        elif layer in ('Cell-type heatmap', 'Methods disagreement'):
+            if layer == 'Cell-type heatmap':
+                values, (low, high) = mean(props[:, sel].sum(axis=1)), (0.0, 1.0)
+            else:
+                values, (low, high) = mean(self.error[idx]), self.error_range
+            scaled = (values - low) / (high - low) if high > low else np.zeros(len(values))
+            colors = np.asarray(Viridis256)[np.clip(np.rint(scaled * 255), 0, 255).astype(np.int64)]
+            label = pd.Series(values).map("{:.4f}".format).to_numpy()
+        else:
+            # Pie of the selected types, angles renormalized among them (no wedge where they are absent)
+            fractions = mean(props[:, sel]) if sel else np.zeros((len(cx), 0))
+            totals = fractions.sum(axis=1, keepdims=True)
+            shares = np.divide(fractions, totals, out=np.zeros_like(fractions), where=totals > 0)
+            ends = np.cumsum(shares, axis=1) * 2 * pi
+            starts = ends - shares * 2 * pi
+            spot_of, k = np.nonzero(shares > 0)
+            types = np.asarray(sel, dtype=np.int64)[k]
+            names = pd.Series(np.array(self.cell_types, dtype=object)[types])
+            wedges = dict(x=cx[spot_of], y=cy[spot_of], start=starts[spot_of, k], end=ends[spot_of, k],
+                          color=self.ct_colors[types], radius=np.full(len(spot_of), radius),
+                          label=(names + ": " + pd.Series(fractions[spot_of, k]).map("{:.4f}".format)).to_numpy())
+
+        spot_data = dict(x=[], y=[], color=[], label=[], barcode=[])
+        hex_data = dict(q=[], r=[], color=[], label=[], count=[])
+        if layer == 'Pie of selected types':
+            pass
+        elif lod:
+            hex_data = dict(q=q, r=r, color=colors, label=label, count=counts)
+        else:
+            spot_data = dict(x=cx, y=cy, color=colors, label=label, barcode=self.barcodes[idx])
+        status = f"{len(idx)} spots in view" + (f", aggregated into {len(cx)} hexagons" if lod else "")
+        return spot_data, hex_data, wedges, size, status
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       BOKEH SERVER DOCUMENT                             !>
+# <! ------------------------------------------------------------------------!>
+
+def make_document(doc, store, image_path, output, clustering_labels, tile_format='jpeg'):
+    image_display_infos = get_image_display_infos(image_path)
+    im_w, im_h = int(np.ceil(image_display_infos["im_w"] / 2)), int(np.ceil(image_display_infos["im_h"] / 2))
+
+    plot = figure(width=900, height=700, title="Deconvolution results", x_axis_label='x', y_axis_label='y',
+                  output_backend="webgl",
+                  x_range=Range1d(0, im_w), y_range=Range1d(-im_h, 0))
+    tile_renderer = plot.add_tile(tissue_tile_source(image_path, output, tile_format), alpha=1.0)
+
+    spot_source = ColumnDataSource(dict(x=[], y=[], color=[], label=[], barcode=[]))
+    hex_source = ColumnDataSource(dict(q=[], r=[], color=[], label=[], count=[]))
+    wedge_source = ColumnDataSource(dict(x=[], y=[], start=[], end=[], color=[], label=[], radius=[]))
+    spot_renderer = plot.circle(x='x', y='y', radius=store.spot_radius, fill_color='color', line_width=0,
+                                source=spot_source)
+    hex_renderer = plot.hex_tile(q='q', r='r', size=store.spot_radius, orientation='pointytop', fill_color='color',
+                                 fill_alpha=0.9, line_width=0, source=hex_source)
+    wedge_renderer = plot.wedge(x='x', y='y', radius='radius', start_angle='start', end_angle='end',
+                                fill_color='color', line_width=0, source=wedge_source)
+    plot.add_tools(HoverTool(tooltips="@barcode: @label", renderers=[spot_renderer]))
+    plot.add_tools(HoverTool(tooltips="@count spots: @label", renderers=[hex_renderer]))
+    plot.add_tools(HoverTool(tooltips="@label", renderers=[wedge_renderer]))
+
+    layer_select = RadioButtonGroup(labels=LAYERS, active=1)
+    method_select = Select(title="Method", value=store.deconv_methods[0], options=store.deconv_methods)
+    types_choice = MultiChoice(title="Cell types (heatmap / pie)", value=store.cell_types[:1], options=store.cell_types)
+    clustering_select = RadioButtonGroup(labels=list(clustering_labels), active=0)
+    slider = Slider(start=0, end=1, value=1, step=.1, title="Image Transparency")
+    status = Div(text="")
+
+    def refresh():
+        x0, x1 = plot.x_range.start, plot.x_range.end
+        y0, y1 = plot.y_range.start, plot.y_range.end
+        spot_data, hex_data, wedge_data, size, text = store.query(
+            x0, x1, y0, y1, LAYERS[layer_select.active], method_select.value, types_choice.value,
+            clustering_select.active)
+        hex_renderer.glyph.size = size
+        spot_source.data = spot_data
+        hex_source.data = hex_data
+        wedge_source.data = wedge_data
+        status.text = text
+
+    def set_alpha(attr, old, new):
+        tile_renderer.alpha = new
+
+    plot.on_event(RangesUpdate, lambda event: refresh())
+    layer_select.on_change('active', lambda attr, old, new: refresh())
+    method_select.on_change('value', lambda attr, old, new: refresh())
+    types_choice.on_change('value', lambda attr, old, new: refresh())
+    clustering_select.on_change('active', lambda attr, old, new: refresh())
+    slider.on_change('value', set_alpha)
+    refresh()
+
+    doc.add_root(row(column(layer_select, method_select, types_choice, clustering_select, slider, status, width=320), plot))
+    doc.title = "DeconvoliSTa"
+
+
+def serve(store, image_path, output, clustering_labels, port=5006, tile_format='jpeg', allow_websocket_origin=None):
+    """Run the Bokeh server on `port`, the tiles of the tissue image served next to the page."""
+    from bokeh.server.server import Server
+    from tornado.web import StaticFileHandler
+
+    tiles_dir = os.path.splitext(output)[0] + "_tiles"
+    tissue_tile_source(image_path, output, tile_format)  # builds (or reuses) the pyramid once
+    server = Server(
+        {'/': partial(make_document, store=store, image_path=image_path, output=output,
+                      clustering_labels=clustering_labels, tile_format=tile_format)},
+        port=port,
+        allow_websocket_origin=allow_websocket_origin or [f"localhost:{port}"],
+        extra_patterns=[(rf"/{os.path.basename(tiles_dir)}/(.*)", StaticFileHandler, {"path": tiles_dir})])
+    server.start()
+    print(f"Serving on http://localhost:{port}/ (Ctrl-C to stop)")
+    server.io_loop.start()
@@ -9,16 +9,28 @@ See documenation for use parameters .
 # <!                       IMPORTS                                           !>
 # <! ------------------------------------------------------------------------!>
 import pandas as pd
+import numpy as np
 from math import pi
 from bokeh.plotting import figure, output_file, save,output_notebook, show, curdoc
 
 from bokeh.transform import cumsum
 from bokeh.models import ColumnDataSource, HoverTool,Range1d
 from bokeh.palettes import Category20
-from bokeh.models import CustomJS, TapTool
+from bokeh.models import CustomJS, TapTool, WMTSTileSource
 from PIL import Image
 import base64
+import gzip
+import hashlib
 import io
+import json
+import os
+import shutil
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa_csv = None
 # Define color dictionary
 clusters_colordict = {
     0: "#CCCCCC",
@@ -101,22 +113,195 @@ colordict = {
 # <!                           DATA PREPARATION                              !>
 # <! ------------------------------------------------------------------------!>
 
-def process_data(norm_weights_filepath, st_coords_filepath, data_clustered, deconv_method, n_largest_cell_types, scale_factor, data_clustered2=None):
-    # Read spatial deconvolution result CSV file
-    norm_weights_df = pd.read_csv(norm_weights_filepath, sep = '\t')
-    norm_weights_df.index.name = None
+# Every input file is parsed once per run: process_data (once per method), post_process_data,
+# the cluster compositions and the heatmap proportions all read the same TSVs/CSVs, so the
+# parsed frames are kept here (keyed on path + mtime) and shared. Consumers must not modify
+# them in place.
+_file_cache = {}
+
+def _cached_read(reader, filepath):
+    key = (reader.__name__, os.path.abspath(filepath), os.path.getmtime(filepath))
+    if key not in _file_cache:
+        _file_cache[key] = reader(filepath)
+    return _file_cache[key]
+
+
+def read_proportions_header(filepath):
+    """Cell types of a proportions TSV, from its first two lines only."""
+    # Proportions TSVs are written by R (write.table, row.names=TRUE): the header has no
+    # field for the barcodes. Also accept a header naming the barcode column.
+    with open(filepath) as f:
+        header = f.readline().rstrip('\r\n').split('\t')
+        n_fields = len(f.readline().rstrip('\r\n').split('\t'))
+    return header if n_fields == len(header) + 1 else header[1:]
+
+
+def _parse_proportions(filepath):
+    cell_types = read_proportions_header(filepath)
+
+    if pa_csv is not None:
+        table = pa_csv.read_csv(
+            filepath,
+            read_options=pa_csv.ReadOptions(column_names=['barcode'] + cell_types, skip_rows=1),
+            parse_options=pa_csv.ParseOptions(delimiter='\t'),
+            convert_options=pa_csv.ConvertOptions(
+                column_types=dict({'barcode': pa.string()}, **{ct: pa.float32() for ct in cell_types})))
+        df = table.to_pandas().set_index('barcode')
+    else:
+        df = pd.read_csv(filepath, sep='\t', index_col=0, names=cell_types, skiprows=1,
+                         dtype={ct: np.float32 for ct in cell_types})
+    df.index.name = None
+    return df
+
+
+def read_proportions(filepath):
+    """Barcode-indexed float32 proportions (spots x cell types) of one method, parsed once."""
+    return _cached_read(_parse_proportions, filepath)
 
-    # Read spatial coordinates CSV file
-    st_coords_df = pd.read_csv(st_coords_filepath, header=None).set_index(0)
+
+def _parse_coordinates(filepath):
+    st_coords_df = pd.read_csv(filepath, header=None).set_index(0)
     st_coords_df.index.name = None
     st_coords_df.columns = [ "in_tissue", "array_row", "array_col", "pxl_row_in_fullres", "pxl_col_in_fullres"]
-    st_coords_df["pxl_row_in_fullres"] = st_coords_df["pxl_row_in_fullres"]*scale_factor
-    st_coords_df["pxl_col_in_fullres"] = st_coords_df["pxl_col_in_fullres"]*scale_factor
-    # It will be difficult to show the information of all 54 cell types when hovering
-    # Thus, for each barcoded spot, retrieve the maximum 5 weights and create new columns
-    # accordingly. Those 5 max columns will be the info shown in the hovertool
-    max_weights = norm_weights_df.apply(lambda x: x.nlargest(n_largest_cell_types).index.values, axis=1)
+    return st_coords_df
+
+
+def read_coordinates(filepath):
+    """Spot coordinates (tissue_positions format, unscaled), parsed once."""
+    return _cached_read(_parse_coordinates, filepath)
+
+
+def _parse_clustering(filepath):
+    data_with_clusters = pd.read_csv(filepath)
+    clusters = data_with_clusters.set_index(data_with_clusters.columns[0])["BayesSpace"]
+    clusters.index.name = None
+    return clusters
+
+
+def read_clustering(filepath):
+    """Cluster of every spot (the `BayesSpace` column, indexed by barcode), parsed once."""
+    return _cached_read(_parse_clustering, filepath)
+
+
+# On disk, the per-method intermediates (top-N frame, full proportions, aligned proportions for
+# the methods comparison, cluster compositions) are kept across runs in a cache directory, keyed
+# on the CONTENT of their inputs: re-running after adding or changing one method only recomputes
+# that method, the others are loaded back and the layout is reassembled.
+_digests = {}
+_disk_memo = {}
+cache_stats = {'reused': 0, 'computed': 0}
+
+def file_digest(filepath):
+    """sha256 of a file's content, hashed once per (path, mtime, size)."""
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_mtime, stat.st_size)
+    if key not in _digests:
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+
+def cache_key(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:32]
+
+
+def _disk_cached(cache_dir, kind, key, compute, fmt):
+    """compute() stored in cache_dir as <kind>-<key>, or loaded back from there.
+    fmt: 'frame' (Parquet, pickle without pyarrow), 'array' (.npy) or 'json'."""
+    if cache_dir is None:
+        return compute()
+    ext = {'frame': 'parquet' if pa_csv is not None else 'pkl', 'array': 'npy', 'json': 'json'}[fmt]
+    path = os.path.join(cache_dir, f"{kind}-{key}.{ext}")
+    if path in _disk_memo:
+        return _disk_memo[path]
+    if os.path.exists(path):
+        cache_stats['reused'] += 1
+        if ext == 'parquet':
+            value = pd.read_parquet(path)
+        elif ext == 'pkl':
+            value = pd.read_pickle(path)
+        elif ext == 'npy':
+            value = np.load(path)
+        else:
+            with open(path) as f:
+                value = json.load(f)
+        _disk_memo[path] = value
+        return value
+
+    value = compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written aside then renamed: concurrent runs (batch mode) never read a partial file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if ext == 'parquet':
+        value.to_parquet(tmp)
+    elif ext == 'pkl':
+        value.to_pickle(tmp, compression=None)
+    elif ext == 'npy':
+        with open(tmp, 'wb') as f:
+            np.save(f, value)
+    else:
+        with open(tmp, 'w') as f:
+            json.dump(value, f)
+    os.replace(tmp, path)
+    cache_stats['computed'] += 1
+    _disk_memo[path] = value
+    return value
 
+
+def load_proportions(filepath, cache_dir=None):
+    """read_proportions, through the on-disk cache (Parquet loads faster than the TSV parse)."""
+    return _disk_cached(cache_dir, 'proportions', cache_key(file_digest(filepath)),
+                        lambda: read_proportions(filepath), 'frame')
+
+
+def top_n_cell_types(proportions, cell_types, n_largest_cell_types):
+    """Top-N cell types of every spot, computed on the whole (spots x cell types) matrix.
+
+    Returns three (spots x N) arrays: the cell-type labels, their raw proportions and the
+    proportions renormalized over the top N (so each spot's pie sums to 1). Ranks follow
+    pandas' ``nlargest``: ties (typically the zeros of sparse methods) keep column order.
+    """
+    values = np.where(np.isnan(proportions), -np.inf, proportions)
+    n_spots, n_types = values.shape
+    n = min(n_largest_cell_types, n_types)
+
+    # argpartition only gives *some* N largest; keep every value above the N-th largest and
+    # fill the remaining slots with the first (leftmost) ties, as nlargest(keep='first') does.
+    kth = np.partition(values, n_types - n, axis=1)[:, n_types - n][:, None]
+    above = values > kth
+    n_ties_needed = n - above.sum(axis=1, keepdims=True)
+    ties = values == kth
+    keep = above | (ties & (np.cumsum(ties, axis=1) <= n_ties_needed))
+    candidates = np.nonzero(keep)[1].reshape(n_spots, n)
+
+    # Order the N candidates by decreasing value; the stable sort keeps column order on ties
+    order = np.argsort(-np.take_along_axis(values, candidates, axis=1), axis=1, kind='stable')
+    top_idx = np.take_along_axis(candidates, order, axis=1)
+
+    top_types = np.asarray(cell_types, dtype=object)[top_idx]
+    top_values = np.take_along_axis(proportions, top_idx, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        top_norm_values = top_values / top_values.sum(axis=1, keepdims=True)
+    return top_types, top_values, top_norm_values
+
+
+def process_data(norm_weights_filepath, st_coords_filepath, data_clustered, deconv_method, n_largest_cell_types, scale_factor, data_clustered2=None, cache_dir=None):
+    if cache_dir is not None:
+        key = cache_key(deconv_method, file_digest(norm_weights_filepath), file_digest(st_coords_filepath),
+                        file_digest(data_clustered), file_digest(data_clustered2) if data_clustered2 is not None else None,
+                        int(n_largest_cell_types), float(scale_factor))
+        return _disk_cached(cache_dir, 'processed', key, lambda: process_data(
+            norm_weights_filepath, st_coords_filepath, data_clustered, deconv_method, n_largest_cell_types,
+            scale_factor, data_clustered2), 'frame')
+
+    # Read spatial deconvolution result and spatial coordinates (shared, parsed once)
+    norm_weights_df = read_proportions(norm_weights_filepath)
+    st_coords_df = read_coordinates(st_coords_filepath).assign(
+        pxl_row_in_fullres=lambda df: df["pxl_row_in_fullres"]*scale_factor,
+        pxl_col_in_fullres=lambda df: df["pxl_col_in_fullres"]*scale_factor)
     merged_df = pd.concat([st_coords_df, norm_weights_df], axis = 1, join = 'inner')
 
     # Keep the spot barcode as an explicit column so it survives the inter-method
@@ -124,58 +309,30 @@ def process_data(norm_weights_filepath, st_coords_filepath, data_clustered, deco
     # align the full per-spot proportions used by the cell-type heatmap.
     merged_df["barcode"] = merged_df.index
 
-    data_with_clusters = pd.read_csv(data_clustered)
-    clusters_col =  pd.DataFrame(data_with_clusters["BayesSpace"]).set_index(data_with_clusters["Unnamed: 0"])
-    merged_df["Cluster"] = clusters_col
+    merged_df["Cluster"] = read_clustering(data_clustered)
 
     # Optional second clustering (for the Seurat <-> BayesSpace toggle)
     if data_clustered2 is not None:
-        dwc2 = pd.read_csv(data_clustered2)
-        merged_df["Cluster2"] = pd.DataFrame(dwc2["BayesSpace"]).set_index(dwc2["Unnamed: 0"])
-
-
-    # Create df columns with max cell types
-    cell_type_storage_arrays = list()
-    cell_value_storage_arrays = list()
+        merged_df["Cluster2"] = read_clustering(data_clustered2)
 
-    # Extract cell types with largest weights
-    for i in range(n_largest_cell_types):
-
-        cell_type_storage_array = list()
-        cell_value_storage_array = list()
-
-        for barcode in max_weights.index:
-
-            max_cell_types = max_weights.loc[barcode]
-            max_cell_type = max_cell_types[i]
-            max_cell_value = merged_df.loc[barcode, max_cell_types[i]]
 
-            cell_type_storage_array.append(max_cell_type)
-            cell_value_storage_array.append(max_cell_value)
-
-
-        cell_type_storage_arrays.append(cell_type_storage_array)
-        cell_value_storage_arrays.append(cell_value_storage_array)
-
-    # print(len(cell_type_storage_arrays[0]))
-    # Assign to new columns in the dataframe
-    for i in range(n_largest_cell_types):
-        merged_df[''.join([deconv_method,  '_Deconv_cell', str(i + 1)])] = cell_type_storage_arrays[i]
-        merged_df[''.join([deconv_method, '_Deconv_cell', str(i + 1), '_value'])] = cell_value_storage_arrays[i]
-
-    # Since we only consider the top N cell types, we need to correct the weight
-    # values so that the scatterpies account to the totality of the circle (sum of weights == 1)
-
-    deconv_weight_columns = [f"{deconv_method}_Deconv_cell{i + 1}_value" for i in range(n_largest_cell_types)]
-
-    # Create new normalized columns
+    # It will be difficult to show the information of all 54 cell types when hovering
+    # Thus, for each barcoded spot, retrieve the maximum 5 weights and create new columns
+    # accordingly. Those 5 max columns will be the info shown in the hovertool.
+    # The ranking runs on the proportions matrix aligned to merged_df, so each spot gets
+    # its own top types whatever the row order of the TSV vs the coordinates file.
+    cell_types = norm_weights_df.columns
+    top_types, top_values, top_norm_values = top_n_cell_types(
+        merged_df[cell_types].to_numpy(dtype=np.float64), cell_types, n_largest_cell_types)
+
+    # Since we only consider the top N cell types, the weight values are corrected
+    # so that the scatterpies account to the totality of the circle (sum of weights == 1)
+    new_columns = {}
     for i in range(n_largest_cell_types):
-
-        # Calculate the sum of the top cell type weights
-        total = merged_df.loc[:, deconv_weight_columns].sum(axis=1)
-
-        # Create column with corrected weight values
-        merged_df[''.join([deconv_method, '_Deconv_cell', str(i + 1), '_norm_value'])] =  merged_df[''.join([deconv_method, '_Deconv_cell', str(i + 1), '_value'])] / total
+        new_columns[f"{deconv_method}_Deconv_cell{i + 1}"] = top_types[:, i]
+        new_columns[f"{deconv_method}_Deconv_cell{i + 1}_value"] = top_values[:, i]
+        new_columns[f"{deconv_method}_Deconv_cell{i + 1}_norm_value"] = top_norm_values[:, i]
+    merged_df = pd.concat([merged_df, pd.DataFrame(new_columns, index=merged_df.index)], axis=1)
 
     # SLim down the df by selecting columns of interest only
     columns_of_interest = ['barcode', 'pxl_row_in_fullres', 'pxl_col_in_fullres','Cluster' , "in_tissue"] + [f"{deconv_method}_Deconv_cell{i + 1}_norm_value" for i in range(n_largest_cell_types)] \
@@ -195,37 +352,114 @@ def image_to_base64(image_path):
         encoded_string = base64.b64encode(image_file.read()).decode()
     return f"data:image/png;base64,{encoded_string}"
 def get_image_display_infos(image_path):
-    im = Image.open(image_path).convert("RGB")
-    # Merge coordinate df and cell weight df
+    # Image.open only parses the header, the pixels are decoded lazily (never, here)
+    with Image.open(image_path) as im:
+        im_w, im_h = im.size
     image_display_infos = {
         "image_path" : image_path,
         "x0" : 0,
         "y0" : 0,
-        "im_w" : im.size[0],
-        "im_h" : im.size[1],
+        "im_w" : im_w,
+        "im_h" : im_h,
 
     }
     return image_display_infos
 
 
-def calculate_stddev(vector):
-    mean = sum(vector) / len(vector)
-    # Calculate the variance
-    variance = sum((x - mean) ** 2 for x in vector) / len(vector)
-    stddev = math.sqrt(variance)
-    return stddev
+TILE_SIZE = 256
+TILE_EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp'}
 
-def calculate_rmsd(vector1, vector2):
-    if len(vector1) != len(vector2):
-        raise ValueError("The vectors must be of the same length")
-    
-    squared_diffs = [(v1 - v2) ** 2 for v1, v2 in zip(vector1, vector2)]
-    mean_squared_diff = sum(squared_diffs) / len(vector1)
-    return math.sqrt(mean_squared_diff)
-
-
-def post_process_data(norm_weights_filepaths, st_coords_filepath, data_clustered, deconv_methods, n_largest_cell_types, scale_factor, data_clustered2=None):
-    norm_weights_dfs = [process_data(props, st_coords_filepath,data_clustered, deconv_methods[index], n_largest_cell_types, scale_factor = scale_factor, data_clustered2=data_clustered2)\
+def write_tile_pyramid(image_path, tiles_dir, tile_size=TILE_SIZE, tile_format='jpeg'):
+    """Cut the tissue image into a pyramid of `tile_size` tiles, stored as {z}/{x}/{y}.<ext>
+    (WMTS layout: row 0 on top). The deepest level is the image at full resolution, each level
+    above it is downsampled 2x, down to level 0 which fits in a single tile. Border tiles are
+    padded in white to the full tile size. Returns the deepest zoom level.
+    The pyramid is reused as long as the image (path, size, mtime) and the settings are unchanged."""
+    image_display_infos = get_image_display_infos(image_path)
+    im_w, im_h = image_display_infos["im_w"], image_display_infos["im_h"]
+    max_zoom = max(0, math.ceil(math.log2(max(im_w, im_h) / tile_size)))
+    stat = os.stat(image_path)
+    manifest = {'image': os.path.abspath(image_path), 'bytes': stat.st_size, 'mtime': stat.st_mtime,
+                'tile_size': tile_size, 'format': tile_format, 'max_zoom': max_zoom}
+    manifest_path = os.path.join(tiles_dir, 'tiles.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                return max_zoom
+        shutil.rmtree(tiles_dir)
+
+    with Image.open(image_path) as im:
+        level = im.convert("RGB")
+    for z in range(max_zoom, -1, -1):
+        for tx in range(math.ceil(level.width / tile_size)):
+            os.makedirs(os.path.join(tiles_dir, str(z), str(tx)), exist_ok=True)
+            for ty in range(math.ceil(level.height / tile_size)):
+                box = (tx * tile_size, ty * tile_size,
+                       min((tx + 1) * tile_size, level.width), min((ty + 1) * tile_size, level.height))
+                tile = Image.new("RGB", (tile_size, tile_size), (255, 255, 255))
+                tile.paste(level.crop(box), (0, 0))
+                tile.save(os.path.join(tiles_dir, str(z), str(tx), f"{ty}.{TILE_EXTENSIONS[tile_format]}"),
+                          format=tile_format.upper(), quality=85)
+        if z > 0:
+            level = level.reduce(2)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return max_zoom
+
+
+def tissue_tile_source(image_path, output, tile_format='jpeg'):
+    """Write the tile pyramid of the tissue image next to the `output` HTML and return the
+    matching Bokeh tile source, in the plot coordinates (image pixels / 2, y pointing down from 0)."""
+    tiles_dir = os.path.splitext(output)[0] + "_tiles"
+    max_zoom = write_tile_pyramid(image_path, tiles_dir, tile_format=tile_format)
+    # The pyramid covers a square of TILE_SIZE * 2**max_zoom image pixels (TILE_SIZE * 2**(max_zoom - 1)
+    # plot units), anchored on the top-left corner of the image.
+    world = TILE_SIZE * 2 ** max_zoom / 2
+    return WMTSTileSource(
+        url=f"{os.path.basename(tiles_dir)}/{{Z}}/{{X}}/{{Y}}.{TILE_EXTENSIONS[tile_format]}",
+        tile_size=TILE_SIZE, min_zoom=0, max_zoom=max_zoom,
+        initial_resolution=world / TILE_SIZE, x_origin_offset=0, y_origin_offset=world,
+        wrap_around=False, snap_to_zoom=False, attribution="")
+
+
+def stack_method_proportions(norm_weights_dfs, barcodes, cell_types):
+    """Stack the per-method proportions into one (methods x spots x cell types) float32 array,
+    rows aligned on `barcodes` and columns on `cell_types` (a type a method lacks counts as 0)."""
+    stacked = np.empty((len(norm_weights_dfs), len(barcodes), len(cell_types)), dtype=np.float32)
+    for m, df in enumerate(norm_weights_dfs):
+        stacked[m] = df.reindex(index=barcodes, columns=cell_types, fill_value=0.0).to_numpy(dtype=np.float32)
+    return stacked
+
+
+def disagreement_metrics(stacked):
+    """Per-spot disagreement between methods, from the (methods x spots x cell types) array.
+
+    - rmsd: root mean squared difference between the two methods' proportions (2 methods only)
+    - std_of_std: standard deviation over cell types of the per-type standard deviation
+      across methods
+    - jsd: Jensen-Shannon divergence (base 2) between the methods' compositions
+    - max_abs_diff: largest spread (max - min across methods) of any cell type
+    """
+    n_methods = stacked.shape[0]
+    metrics = {}
+    if n_methods == 2:
+        metrics['rmsd'] = np.sqrt(np.mean((stacked[0] - stacked[1]) ** 2, axis=1))
+    metrics['std_of_std'] = np.std(np.std(stacked, axis=0), axis=1)
+
+    # Generalized JSD for equally weighted distributions: H(mean) - mean(H)
+    def entropy(p):
+        return -np.sum(p * np.log2(np.where(p > 0, p, 1)), axis=-1)
+    totals = stacked.sum(axis=2, keepdims=True)
+    dists = np.divide(stacked, totals, out=np.zeros_like(stacked), where=totals > 0)
+    jsd = entropy(dists.mean(axis=0)) - entropy(dists).mean(axis=0)
+    metrics['jsd'] = np.clip(jsd, 0, None)
+
+    metrics['max_abs_diff'] = (stacked.max(axis=0) - stacked.min(axis=0)).max(axis=1)
+    return metrics
+
+
+def post_process_data(norm_weights_filepaths, st_coords_filepath, data_clustered, deconv_methods, n_largest_cell_types, scale_factor, data_clustered2=None, cache_dir=None):
+    norm_weights_dfs = [process_data(props, st_coords_filepath,data_clustered, deconv_methods[index], n_largest_cell_types, scale_factor = scale_factor, data_clustered2=data_clustered2, cache_dir=cache_dir)\
                       for index, props  in enumerate(norm_weights_filepaths)]
     processed_data = norm_weights_dfs[0]
     for i in range(1, len(norm_weights_dfs)):
@@ -233,45 +467,31 @@ def post_process_data(norm_weights_filepaths, st_coords_filepath, data_clustered
     nb_spots_samples = processed_data.shape[0]
 
     for method in deconv_methods:
-        processed_data[f'{method}_values'] = processed_data.apply(
-            lambda row: [row[f"{method}_Deconv_cell{i}_norm_value"] for i in range(1, n_largest_cell_types + 1)],
-            axis=1
-        )
-    #process data again because i dont want to change all process_data
-    # i need methods comparing data, so i had to add this step
-
-    weights_gathered = pd.read_csv(norm_weights_filepaths[0], sep = '\t')
-    weights_gathered.index.name = None
-
-    cell_types = weights_gathered.columns.copy()
-    weights_gathered  =  weights_gathered.rename(columns=lambda x: f'{deconv_methods[0]}_{x}')
-    for i in range(1,len(norm_weights_filepaths)):
-      tmp_df = pd.read_csv(norm_weights_filepaths[i], sep = '\t')
-      tmp_df.index.name = None
-      tmp_df  =  tmp_df.rename(columns=lambda x: f'{deconv_methods[i]}_{x}')
-      weights_gathered = pd.merge(weights_gathered, tmp_df, left_index=True, right_index=True)
-    def comparing_value_stdev(row):
-      st_devs = []
-      for t in cell_types:
-        st_dev = calculate_stddev( [ row[f"{method}_{t}"] for method in deconv_methods] )
-        st_devs.append(st_dev)
-      return calculate_stddev(st_devs)
-
-
-    weights_gathered.reset_index(drop=True, inplace = True)
-    def comparing_value_rmsd(row):
-      v0 = [  row[f"{deconv_methods[0]}_{t}"] for t in cell_types]
-      v1 = [  row[f"{deconv_methods[1]}_{t}"] for t in cell_types]
-      return calculate_rmsd(v0 , v1)
-
-    if len(deconv_methods) == 2:
-      weights_gathered["error_value"] = weights_gathered.apply(lambda row : comparing_value_rmsd(row), axis = 1)
-    elif len(deconv_methods) > 2:
-      weights_gathered["error_value"] = weights_gathered.apply(lambda row : comparing_value_stdev(row), axis = 1)
+        norm_value_columns = [f"{method}_Deconv_cell{i}_norm_value" for i in range(1, n_largest_cell_types + 1)]
+        processed_data[f'{method}_values'] = processed_data[norm_value_columns].to_numpy().tolist()
+
+    # The methods comparison needs every cell type, not only the top N: stack the full
+    # proportions of all methods, aligned on the spots of processed_data.
+    # Each method's slice is cached on its own (keyed on its TSV and the spots/cell types it is aligned on).
+    barcodes = processed_data["barcode"]
+    cell_types = read_proportions_header(norm_weights_filepaths[0])
+    alignment = cache_key('\n'.join(map(str, barcodes)), tuple(cell_types))
+    stacked = np.stack([
+        _disk_cached(cache_dir, 'aligned', cache_key(file_digest(props), alignment),
+                     lambda props=props: stack_method_proportions([load_proportions(props, cache_dir)], barcodes, cell_types)[0],
+                     'array')
+        for props in norm_weights_filepaths])
+
+    # error_value drives the "Compare" view: RMSD for two methods, std of the per-type
+    # stds for more. The other metrics can be picked from the view.
+    if len(deconv_methods) > 1:
+        metrics = disagreement_metrics(stacked)
+        processed_data["error_value"] = metrics['rmsd'] if len(deconv_methods) == 2 else metrics['std_of_std']
+        processed_data["error_jsd"] = metrics['jsd']
+        processed_data["error_max_abs_diff"] = metrics['max_abs_diff']
     else:
-      # A single method: no inter-method comparison possible -> flat error (the "Compare" view is moot).
-      weights_gathered["error_value"] = 0.0
-    processed_data["error_value"] = weights_gathered["error_value"]
+        # A single method: no inter-method comparison possible -> flat error (the "Compare" view is moot).
+        processed_data["error_value"] = 0.0
     return processed_data
 
 # <! ------------------------------------------------------------------------!>
@@ -289,7 +509,7 @@ import math
 
     
    
-def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_spots_samples, n_largest_cell_types, output, cluster_composition=None, clustering_labels=None, full_props=None, show_legend=False, show_figure=False):
+def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_spots_samples, n_largest_cell_types, output, cluster_composition=None, clustering_labels=None, full_props=None, show_legend=False, show_figure=False, encoding='compact', image_mode='embed', tile_format='jpeg', backend='webgl'):
     from bokeh.models import LinearColorMapper, ColorBar
     from bokeh.palettes import Viridis256
 
@@ -299,6 +519,33 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
     test_df = reduced_df[reduced_df["in_tissue"] == 1].head(nb_spots_samples).copy().reset_index(drop=True)
     n_spots = len(test_df)
 
+    # Encoding of the per-spot columns. 'compact' ships NumPy typed arrays (base64 in the HTML):
+    # float32 numbers, uint8/uint16 palette indices turned back into colors by a color mapper
+    # in the browser, and proportions quantized to 1e-4 as uint16. 'json' writes plain lists.
+    compact = encoding == 'compact'
+    PROP_SCALE = 1e-4 if compact else 1.0
+
+    def _floats(values):
+        return np.asarray(values, dtype=np.float32) if compact else np.asarray(values, dtype=float).tolist()
+
+    def _ints(values):
+        return np.asarray(values, dtype=np.int32) if compact else list(values)
+
+    def _colors(colors, palette):
+        if not compact:
+            return list(colors)
+        index = {c: i for i, c in enumerate(palette)}
+        return pd.Series(colors).map(index).to_numpy(dtype=np.uint8 if len(palette) <= 256 else np.uint16)
+
+    def _fill(field, palette):
+        if not compact:
+            return field
+        return {'field': field, 'transform': LinearColorMapper(palette=palette, low=-0.5, high=len(palette) - 0.5)}
+
+    # Palette of the cell-type colors; the JS writes indices into it (compact) or the colors.
+    ct_palette = sorted(set(colordict.values()) | {'#000000'})
+    ct_palette_index = {c: i for i, c in enumerate(ct_palette)}
+
     # Spot barcodes in plotting order, and the full (all cell types) per-spot proportion
     # matrix per method, aligned to that order. These feed the clickable cell-type heatmap:
     # clicking a type in the side panel recolors the active method's map by that type's
@@ -310,8 +557,8 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
         for _m in deconv_methods:
             full_props_ordered[_m] = full_props[_m].reindex(index=barcodes, columns=all_cell_types)
 
-    all_x = [y/2 for y in test_df.pxl_col_in_fullres.tolist()]
-    all_y = [-x/2 for x in test_df.pxl_row_in_fullres.tolist()]
+    all_x = _floats(test_df.pxl_col_in_fullres.to_numpy() / 2)
+    all_y = _floats(-test_df.pxl_row_in_fullres.to_numpy() / 2)
 
     # Pie-glyph radius scaled to the ACTUAL spot spacing (median nearest-neighbour distance), so
     # the pies are sized right whatever the image resolution / scale_factor. A hardcoded radius
@@ -325,37 +572,59 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
     else:
         wedge_radius = 4.7
 
-    test_df['tooltip_data'] = test_df.apply(
-        lambda row: f"<span style='color: red;'> Spot</span> : (x = {row['pxl_col_in_fullres']/2:.2f}, y = {-row['pxl_row_in_fullres']/2:.2f})",
-        axis=1)
-    test_df['error_tooltip_data'] = test_df.apply(
-        lambda row: (f"<span style='color: red;'> Spot</span> : (x = {row['pxl_col_in_fullres']/2:.2f}, y = {-row['pxl_row_in_fullres']/2:.2f})<br>"
-                     f"<span style='color: blue;'> Cluster</span> : {row['Cluster']}"),
-        axis=1)
-
-    # Shared image source (one object, reused across all plots)
-    image_source = ColumnDataSource(data=dict(
-        url=[image_to_base64(image_display_infos.get("image_path"))],
-        x=[image_display_infos.get("x0")],
-        y=[image_display_infos.get("y0")],
-        w=[image_display_infos.get("im_w")],
-        h=[image_display_infos.get("im_h")],
-        alpha=[1.0]
-    ))
+    # Hover texts, built column-wise (string concatenation over whole columns, no per-row apply)
+    def _fmt(values, fmt):
+        return pd.Series(np.char.mod(fmt, np.asarray(values, dtype=float)), index=test_df.index, dtype=object)
+
+    spot_tip = ("<span style='color: red;'> Spot</span> : (x = " + _fmt(test_df['pxl_col_in_fullres'] / 2, '%.2f')
+                + ", y = " + _fmt(-test_df['pxl_row_in_fullres'] / 2, '%.2f') + ")")
+    test_df['tooltip_data'] = spot_tip
+    test_df['error_tooltip_data'] = spot_tip + "<br><span style='color: blue;'> Cluster</span> : " + test_df['Cluster'].astype(str)
+
+    # Tissue image. 'tiles': a tile pyramid written next to the HTML, the browser only fetches
+    # the tiles of the visible region at the current zoom. 'embed': the whole image inlined in
+    # the HTML as base64 (self-contained file, fine for lowres images only).
+    image_source, tile_source, tile_renderers = None, None, []
+    if image_mode == 'tiles':
+        tile_source = tissue_tile_source(image_display_infos.get("image_path"), output, tile_format)
+    else:
+        # Shared image source (one object, reused across all plots)
+        image_source = ColumnDataSource(data=dict(
+            url=[image_to_base64(image_display_infos.get("image_path"))],
+            x=[image_display_infos.get("x0")],
+            y=[image_display_infos.get("y0")],
+            w=[image_display_infos.get("im_w")],
+            h=[image_display_infos.get("im_h")],
+            alpha=[1.0]
+        ))
+
+    def _add_tissue_image(fig):
+        if tile_source is not None:
+            tile_renderers.append(fig.add_tile(tile_source, alpha=1.0))
+        else:
+            fig.image_url(url='url', x='x', y='y', w='w', h='h', alpha='alpha', source=image_source)
+
+    # The tile renderer needs explicit ranges (no auto-ranging on the tiles): the image extent
+    image_ranges = dict(x_range=Range1d(0, image_display_infos.get("im_w")),
+                        y_range=Range1d(-image_display_infos.get("im_h"), 0)) if tile_source is not None else {}
 
     slider = Slider(start=0, end=1, value=1, step=.1, title="Image Transparency")
-    slider.js_on_change('value', CustomJS(args=dict(image_source=image_source), code="""
+    slider.js_on_change('value', CustomJS(args=dict(image_source=image_source, tile_renderers=tile_renderers), code="""
         var alpha = cb_obj.value;
-        image_source.data['alpha'] = [alpha];
-        image_source.change.emit();
+        if (image_source) {
+            image_source.data['alpha'] = [alpha];
+            image_source.change.emit();
+        }
+        for (const r of tile_renderers) r.alpha = alpha;
     """))
 
     # --- Cluster plot: a single scatter colored by the ACTIVE clustering (toggleable). ---
     # Filtering is done via per-spot alpha (like the deconv plots), so the clustering toggle
     # only needs to swap the per-spot color/cluster fields.
+    # backend 'webgl': the scatter / wedge glyphs are drawn on the GPU (the others fall back to canvas)
     p = figure(width=900, height=700, title="Clustering results",
-               x_axis_label='x', y_axis_label='y')
-    p.image_url(url='url', x='x', y='y', w='w', h='h', alpha='alpha', source=image_source)
+               x_axis_label='x', y_axis_label='y', output_backend=backend, **image_ranges)
+    _add_tissue_image(p)
 
     has_two_clusterings = 'Cluster2' in test_df.columns
     clu0 = [int(c) for c in test_df['Cluster'].tolist()]
@@ -392,14 +661,16 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
     alt_cmap = _matched_colormap(clu0, clu1) if has_two_clusterings else primary_cmap
     col0 = [primary_cmap.get(c, '#000000') for c in clu0]
     col1 = [alt_cmap.get(c, '#000000') for c in clu1]
+    cluster_palette = sorted(set(col0) | set(col1))
     cluster_source = ColumnDataSource(dict(
         x=all_x, y=all_y,
-        cluster=clu0[:], cluster_0=clu0, cluster_1=clu1,
-        color=col0[:], color_0=col0, color_1=col1,
-        alpha=[1.0] * n_spots,
+        cluster=_ints(clu0), cluster_0=_ints(clu0), cluster_1=_ints(clu1),
+        color=_colors(col0, cluster_palette), color_0=_colors(col0, cluster_palette),
+        color_1=_colors(col1, cluster_palette),
+        alpha=_floats(np.ones(n_spots)),
         tooltip_data=test_df['tooltip_data'].tolist()
     ))
-    p.scatter(x='x', y='y', size=5, marker="circle", fill_color='color',
+    p.scatter(x='x', y='y', size=5, marker="circle", fill_color=_fill('color', cluster_palette),
               fill_alpha='alpha', line_width=0, source=cluster_source)
     p.add_tools(HoverTool(tooltips="<div style='width:220px'>@tooltip_data{safe}</div>"))
 
@@ -407,7 +678,7 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
     cluster_ids_list = [sorted(set(clu0)), sorted(set(clu1))]
     cluster_ids = cluster_ids_list[0]
 
-    # --- Deconv plots: vectorized — 1 source per method, n_largest_cell_types renderers ---
+    # --- Deconv plots: vectorized — 1 spots source per method, the pies batched in 1 wedge renderer ---
     # Replaces the previous n_spots × n_cell_types individual sources/renderers loop.
     deconv_plots = []
     deconv_sources = []
@@ -415,122 +686,148 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
     # single-circle layer colored by the selected cell type(s) abundance (heatmap view).
     wedge_renderers = []
     hm_renderers = []
-    method_pies = []          # per method: K wedge renderers for the "pie of selected types" layer
+    method_pies = []          # per method: the "pie of selected types" wedges + their hover layer
+    pie_sources = []          # per method: long-format source of those wedges (K_PIE rows per spot)
     K_PIE = 8                 # max number of cell types shown in a per-spot pie
+
+    # Copies the per-spot alpha (cluster filter) to the rows of the batched top-N wedges,
+    # whenever the spots source changes.
+    sync_alpha_code = """
+        const a = src.data['alpha'], wa = wedges.data['alpha'];
+        for (let r = 0; r < wa.length; r++) wa[r] = a[(r / N) | 0];
+        wedges.change.emit();
+    """
     for method in deconv_methods:
-        test_df[f"{method}_tooltip_data"] = test_df.apply(lambda row: '<br>'.join([
-            f"<div style='display:flex;align-items:center;'>"
-            f"<div style='width:10px;height:10px;background-color:{colordict.get(row[f'{method}_Deconv_cell{i+1}'], '#000000')};margin-right:5px;'></div>"
-            f"<span style='color: blue;'>{row[f'{method}_Deconv_cell{i+1}']}</span>: {row[f'{method}_Deconv_cell{i+1}_norm_value']*100:.2f}%"
-            f"</div>"
-            for i in range(n_largest_cell_types)
-        ] + [f"<span style='color: red;'> Spot</span> : (x = {row['pxl_col_in_fullres']/2:.2f}, y = {-row['pxl_row_in_fullres']/2:.2f})"]), axis=1)
+        tip = spot_tip
+        for i in reversed(range(n_largest_cell_types)):
+            names = test_df[f'{method}_Deconv_cell{i+1}'].astype(str)
+            tip = ("<div style='display:flex;align-items:center;'><div style='width:10px;height:10px;background-color:"
+                   + test_df[f'{method}_Deconv_cell{i+1}'].map(colordict).fillna('#000000')
+                   + ";margin-right:5px;'></div><span style='color: blue;'>" + names + "</span>: "
+                   + _fmt(test_df[f'{method}_Deconv_cell{i+1}_norm_value'] * 100, '%.2f') + "%</div><br>" + tip)
+        test_df[f"{method}_tooltip_data"] = tip
 
         # Cumulative angles per spot: shape (n_spots, n_largest_cell_types+1)
-        weights = np.array([
-            [test_df.iloc[i][f'{method}_Deconv_cell{j+1}_norm_value'] for j in range(n_largest_cell_types)]
-            for i in range(n_spots)
-        ])
+        weights = test_df[[f'{method}_Deconv_cell{j+1}_norm_value' for j in range(n_largest_cell_types)]].to_numpy(dtype=float)
         cumulative = np.hstack([np.zeros((n_spots, 1)), np.cumsum(weights, axis=1)]) * 2 * pi
 
         # One ColumnDataSource for all spots × all cell type positions
         source_data = {
             'x': all_x,
             'y': all_y,
-            'cluster': clu0[:],
-            'cluster_0': clu0,
-            'cluster_1': clu1,
-            'alpha': [1.0] * n_spots,
+            'cluster': _ints(clu0),
+            'cluster_0': _ints(clu0),
+            'cluster_1': _ints(clu1),
+            'alpha': _floats(np.ones(n_spots)),
             'tooltip_data': test_df[f"{method}_tooltip_data"].tolist()
         }
-        for j in range(n_largest_cell_types):
-            source_data[f'start_{j}'] = cumulative[:, j].tolist()
-            source_data[f'end_{j}'] = cumulative[:, j + 1].tolist()
-            source_data[f'color_{j}'] = [
-                colordict.get(test_df.iloc[i][f'{method}_Deconv_cell{j+1}'], '#000000')
-                for i in range(n_spots)
-            ]
+        # The top-N pies are drawn by ONE wedge glyph over a long-format source: one row per
+        # (spot, rank), spot-major (row = spot * n_largest_cell_types + rank). Its alpha column
+        # follows the per-spot alpha of shared_source (see sync_alpha_code).
+        top_colors = np.column_stack([test_df[f'{method}_Deconv_cell{j+1}'].map(colordict).fillna('#000000').to_numpy()
+                                      for j in range(n_largest_cell_types)])
+        wedge_source = ColumnDataSource({
+            'x': _floats(np.repeat(np.asarray(all_x), n_largest_cell_types)),
+            'y': _floats(np.repeat(np.asarray(all_y), n_largest_cell_types)),
+            'start': _floats(cumulative[:, :-1].ravel()),
+            'end': _floats(cumulative[:, 1:].ravel()),
+            'color': _colors(top_colors.ravel(), ct_palette),
+            'alpha': _floats(np.ones(n_spots * n_largest_cell_types)),
+        })
         # Full per-spot proportions for every cell type (for the clickable heatmap), plus the
         # running heatmap value (sum of the currently selected cell types), updated in JS.
         if full_props:
-            fpm = full_props_ordered[method]
-            for ct in all_cell_types:
-                source_data['prop_' + ct] = [
-                    round(float(v), 4) if pd.notna(v) else 0.0 for v in fpm[ct].tolist()
-                ]
+            fpm = full_props_ordered[method].fillna(0.0).to_numpy()
+            for c, ct in enumerate(all_cell_types):
+                source_data['prop_' + ct] = (np.clip(np.rint(fpm[:, c] / PROP_SCALE), 0, 65535).astype(np.uint16) if compact
+                                             else np.round(fpm[:, c].astype(float), 4).tolist())
             # Single cell-type map: per-spot color (the type's own color) + opacity (its
             # proportion) + hover text, all filled in by JS when a type is clicked.
-            source_data['hm_color'] = ['#000000'] * n_spots
-            source_data['hm_alpha'] = [0.0] * n_spots
+            source_data['hm_color'] = _colors(['#000000'] * n_spots, ct_palette)
+            source_data['hm_alpha'] = _floats(np.zeros(n_spots))
             source_data['hm_tip'] = [''] * n_spots
             # "Pie of selected types" layer: K wedges per spot (angles renormalized among the
-            # selected types), one shared opacity per spot. All filled in by JS.
-            source_data['pie_alpha'] = [0.0] * n_spots
+            # selected types), one shared opacity per spot, batched like the top-N pies
+            # (row = spot * K_PIE + k). All filled in by JS; the hover text stays per spot.
             source_data['pie_tip'] = [''] * n_spots
-            for k in range(K_PIE):
-                source_data[f'pie_start_{k}'] = [0.0] * n_spots
-                source_data[f'pie_end_{k}'] = [0.0] * n_spots
-                source_data[f'pie_color_{k}'] = ['#000000'] * n_spots
+        pie_source = ColumnDataSource({
+            'x': _floats(np.repeat(np.asarray(all_x), K_PIE)),
+            'y': _floats(np.repeat(np.asarray(all_y), K_PIE)),
+            'start': _floats(np.zeros(n_spots * K_PIE)),
+            'end': _floats(np.zeros(n_spots * K_PIE)),
+            'color': _colors(['#000000'] * (n_spots * K_PIE), ct_palette),
+            'alpha': _floats(np.zeros(n_spots * K_PIE)),
+        } if full_props else {k: [] for k in ('x', 'y', 'start', 'end', 'color', 'alpha')})
         shared_source = ColumnDataSource(source_data)
+        shared_source.js_on_change('change', CustomJS(
+            args=dict(src=shared_source, wedges=wedge_source, N=n_largest_cell_types), code=sync_alpha_code))
 
         plot = figure(width=900, height=700, title=f"Deconvolution results - {method}",
-                      x_axis_label='x', y_axis_label='y',
+                      x_axis_label='x', y_axis_label='y', output_backend=backend,
                       x_range=p.x_range, y_range=p.y_range)
-        plot.image_url(url='url', x='x', y='y', w='w', h='h', alpha='alpha', source=image_source)
+        _add_tissue_image(plot)
 
-        method_wedges = []
-        for j in range(n_largest_cell_types):
-            wr = plot.wedge(x='x', y='y', radius=wedge_radius,
-                            start_angle=f'start_{j}', end_angle=f'end_{j}',
-                            fill_color=f'color_{j}', fill_alpha='alpha', line_width=0, source=shared_source)
-            method_wedges.append(wr)
+        # Hover on the pies: an invisible disc per spot on shared_source (the wedges, one row per
+        # (spot, rank), would need the tooltip repeated per rank). Toggled with the wedges.
+        method_wedges = [
+            plot.wedge(x='x', y='y', radius=wedge_radius, start_angle='start', end_angle='end',
+                       fill_color=_fill('color', ct_palette), fill_alpha='alpha', line_width=0, source=wedge_source),
+            plot.circle(x='x', y='y', radius=wedge_radius, fill_alpha=0, line_alpha=0, source=shared_source),
+        ]
 
         # Single cell-type layer: each spot drawn in the cell type's own color, opacity ∝ its
         # proportion at that spot (a "where is this cell type" map). Hidden until a type is clicked.
         hm_renderer = plot.scatter(x='x', y='y', size=6, marker="circle",
-                                   fill_color='hm_color', fill_alpha='hm_alpha',
+                                   fill_color=_fill('hm_color', ct_palette), fill_alpha='hm_alpha',
                                    line_width=0, source=shared_source)
         hm_renderer.visible = False
 
-        # Pie-of-selected-types layer: K wedge renderers, hidden until "pie mode" is on.
-        pie_rends = []
-        for k in range(K_PIE):
-            pr = plot.wedge(x='x', y='y', radius=wedge_radius,
-                            start_angle=f'pie_start_{k}', end_angle=f'pie_end_{k}',
-                            fill_color=f'pie_color_{k}', fill_alpha='pie_alpha',
-                            line_width=0, source=shared_source)
+        # Pie-of-selected-types layer: one wedge glyph (+ its hover disc), hidden until "pie mode" is on.
+        pie_rends = [
+            plot.wedge(x='x', y='y', radius=wedge_radius, start_angle='start', end_angle='end',
+                       fill_color=_fill('color', ct_palette), fill_alpha='alpha', line_width=0, source=pie_source),
+            plot.circle(x='x', y='y', radius=wedge_radius, fill_alpha=0, line_alpha=0, source=shared_source),
+        ]
+        for pr in pie_rends:
             pr.visible = False
-            pie_rends.append(pr)
 
         plot.add_tools(HoverTool(tooltips="<div style='width:220px'>@tooltip_data{safe}</div>",
-                                 renderers=method_wedges))
+                                 renderers=[method_wedges[1]]))
         plot.add_tools(HoverTool(tooltips="<div style='width:220px'>@hm_tip{safe}</div>",
                                  renderers=[hm_renderer]))
         plot.add_tools(HoverTool(tooltips="<div style='width:240px'>@pie_tip{safe}</div>",
-                                 renderers=pie_rends))
+                                 renderers=[pie_rends[1]]))
         plot.visible = False
         deconv_plots.append(plot)
         deconv_sources.append(shared_source)
+        pie_sources.append(pie_source)
         wedge_renderers.append(method_wedges)
         hm_renderers.append(hm_renderer)
         method_pies.append(pie_rends)
 
     # --- RMSD plot: single vectorized scatter (replaces n_spots individual sources) ---
-    error_values = test_df["error_value"].tolist()
-    min_val, max_val = min(error_values), max(error_values)
+    error_values = test_df["error_value"].to_numpy(dtype=float)
+    min_val, max_val = float(error_values.min()), float(error_values.max())
     color_map = LinearColorMapper(palette=Viridis256, low=min_val, high=max_val)
 
-    rmsd_source = ColumnDataSource({
+    rmsd_data = {
         'x': all_x, 'y': all_y,
-        'cluster': clu0[:], 'cluster_0': clu0, 'cluster_1': clu1,
-        'alpha': [1.0] * n_spots,
-        'error_value': error_values,
+        'cluster': _ints(clu0), 'cluster_0': _ints(clu0), 'cluster_1': _ints(clu1),
+        'alpha': _floats(np.ones(n_spots)),
+        'error_value': _floats(error_values),
         'error_tooltip_data': test_df['error_tooltip_data'].tolist()
-    })
+    }
+    # Disagreement metrics the Compare view can switch between (error_value = the default one)
+    error_metrics = [('RMSD' if len(deconv_methods) == 2 else 'Std of stds', 'error_value')]
+    if 'error_jsd' in test_df.columns:
+        error_metrics += [('Jensen-Shannon', 'error_jsd'), ('Max abs. diff.', 'error_max_abs_diff')]
+    for _label, field in error_metrics:
+        rmsd_data[field + '_metric'] = _floats(test_df[field])
+    rmsd_source = ColumnDataSource(rmsd_data)
     rmsd_plot = figure(width=900, height=700, title="Deconvolution results comparing",
-                       x_axis_label='x', y_axis_label='y',
+                       x_axis_label='x', y_axis_label='y', output_backend=backend,
                        x_range=p.x_range, y_range=p.y_range)
-    rmsd_plot.image_url(url='url', x='x', y='y', w='w', h='h', alpha='alpha', source=image_source)
+    _add_tissue_image(rmsd_plot)
     rmsd_plot.scatter(x='x', y='y', size=5, marker="circle",
                       fill_color={'field': 'error_value', 'transform': color_map},
                       fill_alpha='alpha', line_width=0, source=rmsd_source)
@@ -540,6 +837,20 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
     rmsd_plot.add_layout(color_bar, 'right')
     rmsd_plot.visible = False
 
+    error_metric_toggle = RadioButtonGroup(labels=[label for label, _field in error_metrics], active=0)
+    error_metric_toggle.js_on_change('active', CustomJS(
+        args=dict(source=rmsd_source, color_map=color_map,
+                  fields=[field for _label, field in error_metrics]),
+        code="""
+        const values = source.data[fields[cb_obj.active] + '_metric'];
+        let lo = Infinity, hi = -Infinity;
+        for (const v of values) { if (v < lo) lo = v; if (v > hi) hi = v; }
+        source.data['error_value'] = values.slice();
+        color_map.low = lo;
+        color_map.high = hi;
+        source.change.emit();
+    """))
+
     # --- Cluster filter SHARED across all views (clusters + each method + comparison) ---
     # A cluster selection applies everywhere (like the zoom), via per-spot alpha. Select/Deselect all.
     # state_src holds: the active clustering index (0 = primary, 1 = alternative); the active
@@ -763,7 +1074,13 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
         window.dvState = state_src;
         window.dvM = {side_div, legend_html, comp_list, cluster_ids_list, checkbox, methods,
                       colordict, deconv_sources, hm_renderers, wedge_renderers, compare_note,
-                      clustering_labels, method_pies, K_PIE};
+                      clustering_labels, method_pies, pie_sources, K_PIE, prop_scale, ct_palette_index};
+        // Value written in a color column: the color itself, or its index in the cell-type
+        // palette when the columns are compact typed arrays.
+        window.dvColorOf = function(name) {
+            const col = (name !== null && window.dvM.colordict[name]) || '#000000';
+            return window.dvM.ct_palette_index ? window.dvM.ct_palette_index[col] : col;
+        };
         window.dvToggleCT = function(name) {
             const sel = window.dvState.data['selected'][0];
             const k = sel.indexOf(name);
@@ -864,34 +1181,36 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
                 // Per-spot pie of the selected types: wedge angles renormalized among the
                 // selected types (relative balance), one opacity per spot = their total
                 // proportion (scaled to the strongest visible spot) -> faint where they are scarce.
+                // The K wedges of spot i are the rows i * K .. i * K + K - 1 of the pie source.
                 const src = M.deconv_sources[mi], d = src.data, al = d['alpha'];
+                const ps = M.pie_sources[mi], pd = ps.data, K = M.K_PIE;
+                const st = pd['start'], en = pd['end'], pc = pd['color'], pa = pd['alpha'];
                 const n = al.length, TAU = 2 * Math.PI;
-                const nsel = Math.min(selected.length, M.K_PIE), sel = selected.slice(0, nsel);
-                for (let k = 0; k < M.K_PIE; k++) {
-                    const cArr = d['pie_color_' + k], c = (k < nsel) ? (M.colordict[sel[k]] || '#000000') : '#000000';
-                    for (let i = 0; i < n; i++) cArr[i] = c;
-                }
+                const nsel = Math.min(selected.length, K), sel = selected.slice(0, nsel);
+                const colors = [];
+                for (let k = 0; k < K; k++) colors.push(window.dvColorOf(k < nsel ? sel[k] : null));
                 const sums = new Array(n); let hi = 0;
                 for (let i = 0; i < n; i++) {
                     let s = 0; const vals = new Array(nsel);
-                    for (let k = 0; k < nsel; k++) { const arr = d['prop_' + sel[k]]; const v = arr ? arr[i] : 0; vals[k] = v; s += v; }
+                    for (let k = 0; k < nsel; k++) { const arr = d['prop_' + sel[k]]; const v = arr ? arr[i] * M.prop_scale : 0; vals[k] = v; s += v; }
                     sums[i] = s;
                     if (al[i] > 0 && s > hi) hi = s;
                     let ang = 0;
-                    for (let k = 0; k < nsel; k++) {
-                        const st = d['pie_start_' + k], en = d['pie_end_' + k];
-                        if (s > 0) { st[i] = ang * TAU; ang += vals[k] / s; en[i] = ang * TAU; } else { st[i] = 0; en[i] = 0; }
+                    for (let k = 0; k < K; k++) {
+                        const r = i * K + k;
+                        pc[r] = colors[k];
+                        if (k < nsel && s > 0) { st[r] = ang * TAU; ang += vals[k] / s; en[r] = ang * TAU; } else { st[r] = 0; en[r] = 0; }
                     }
-                    for (let k = nsel; k < M.K_PIE; k++) { d['pie_start_' + k][i] = 0; d['pie_end_' + k][i] = 0; }
                 }
                 if (hi <= 0) hi = 1;
-                const pa = d['pie_alpha'], pt = d['pie_tip'];
+                const pt = d['pie_tip'];
                 for (let i = 0; i < n; i++) {
-                    pa[i] = al[i] > 0 ? Math.min(1, sums[i] / hi) : 0;
+                    const a = al[i] > 0 ? Math.min(1, sums[i] / hi) : 0;
+                    for (let k = 0; k < K; k++) pa[i * K + k] = a;
                     if (al[i] > 0 && sums[i] > 0) {
                         let tip = "<b>selected types</b> &mdash; " + (sums[i] * 100).toFixed(1) + "% of this spot<br>";
                         for (let k = 0; k < nsel; k++) {
-                            const arr = d['prop_' + sel[k]], v = arr ? arr[i] : 0, c = M.colordict[sel[k]] || '#000000';
+                            const arr = d['prop_' + sel[k]], v = arr ? arr[i] * M.prop_scale : 0, c = M.colordict[sel[k]] || '#000000';
                             tip += "<div style='display:flex;align-items:center;'><div style='width:9px;height:9px;background:"
                                  + c + ";margin-right:5px;'></div>" + sel[k] + ": " + (v * 100).toFixed(1) + "%</div>";
                         }
@@ -899,9 +1218,10 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
                     } else pt[i] = '';
                 }
                 src.change.emit();
+                ps.change.emit();
                 M.hm_renderers[mi].visible = false;
                 for (const w of M.wedge_renderers[mi]) w.visible = false;
-                for (let k = 0; k < M.K_PIE; k++) M.method_pies[mi][k].visible = (k < nsel);
+                for (const pr of M.method_pies[mi]) pr.visible = true;
             } else if (selected.length > 0) {
                 // Spot map: each spot shown in the dominant selected type's OWN color, with opacity
                 // proportional to that type's proportion (scaled to the strongest visible spot).
@@ -912,15 +1232,15 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
                 let hi = 0;
                 for (let i = 0; i < al.length; i++) {
                     let bj = null, bv = 0;
-                    for (const name of selected) { const arr = d['prop_' + name]; const v = arr ? arr[i] : 0; if (v > bv) { bv = v; bj = name; } }
+                    for (const name of selected) { const arr = d['prop_' + name]; const v = arr ? arr[i] * M.prop_scale : 0; if (v > bv) { bv = v; bj = name; } }
                     best[i] = bj; bestv[i] = bv;
                     if (al[i] > 0 && bv > hi) hi = bv;
                 }
                 if (hi <= 0) hi = 1;
                 for (let i = 0; i < al.length; i++) {
-                    if (best[i] === null) { hc[i] = '#000000'; ha[i] = 0; ht[i] = ''; continue; }
+                    if (best[i] === null) { hc[i] = window.dvColorOf(null); ha[i] = 0; ht[i] = ''; continue; }
                     const name = best[i], col = M.colordict[name] || '#000000';
-                    hc[i] = col;
+                    hc[i] = window.dvColorOf(name);
                     ha[i] = al[i] > 0 ? Math.min(1, bestv[i] / hi) : 0;
                     ht[i] = "<div style='display:flex;align-items:center;'>"
                           + "<div style='width:10px;height:10px;background:" + col + ";margin-right:5px;'></div>"
@@ -939,7 +1259,8 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
                       cluster_ids_list=cluster_ids_list, checkbox=cluster_checkbox,
                       methods=deconv_methods, colordict=colordict, deconv_sources=deconv_sources,
                       hm_renderers=hm_renderers, wedge_renderers=wedge_renderers,
-                      compare_note=_compare_note, method_pies=method_pies, K_PIE=K_PIE,
+                      compare_note=_compare_note, method_pies=method_pies, pie_sources=pie_sources, K_PIE=K_PIE,
+                      prop_scale=PROP_SCALE, ct_palette_index=(ct_palette_index if compact else None),
                       clustering_labels=(clustering_labels if clustering_labels else ['Primary', 'Alternative']))
 
     def make_side_cb(set_view_js=""):
@@ -956,7 +1277,8 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
         Each spot is a pie chart of its cell-type proportions for the selected method.</div>"""
     text3 = """<div class="dv-panel"><h3>Method comparison</h3>
         Spots colored by disagreement between methods &mdash; RMSD for two methods, or the
-        standard deviation of per-cell-type standard deviations for more than two.</div>"""
+        standard deviation of per-cell-type standard deviations for more than two. The
+        Jensen-Shannon divergence and the largest per-type difference can be picked instead.</div>"""
     title_text = """
     <style>
     @import url('https://fonts.googleapis.com/css2?family=Fraunces:opsz,wght@9..144,500;9..144,600&family=IBM+Plex+Sans:wght@400;500;600&family=IBM+Plex+Mono:wght@500&display=swap');
@@ -1045,17 +1367,28 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
     rmsd_button.js_on_click(make_side_cb("window.dvState.data['view'] = ['compare'];"))
 
     download_df = test_df.drop(columns=[col for col in test_df.columns if 'tooltip' in col])
-    csv_source = ColumnDataSource({'data': [download_df.to_csv(index=False)]})
+    csv_text = download_df.to_csv(index=False)
+    if compact:
+        # gzip + base64: decompressed by the browser (DecompressionStream) on click
+        csv_text = base64.b64encode(gzip.compress(csv_text.encode())).decode()
+    csv_source = ColumnDataSource({'data': [csv_text]})
     download_button = Button(label="Download raw data", width=100, button_type='primary')
-    download_button.js_on_click(CustomJS(args=dict(source=csv_source), code="""
+    download_button.js_on_click(CustomJS(args=dict(source=csv_source, gzipped=compact), code="""
         const data = source.data['data'][0];
-        const blob = new Blob([data], { type: 'text/csv;charset=utf-8;' });
-        const url = URL.createObjectURL(blob);
-        const link = document.createElement('a');
-        link.href = url;
-        link.download = "raw_data.csv";
-        link.click();
-        URL.revokeObjectURL(url);
+        let content = Promise.resolve(data);
+        if (gzipped) {
+            const bytes = Uint8Array.from(atob(data), c => c.charCodeAt(0));
+            content = new Response(new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'))).blob();
+        }
+        content.then((csv) => {
+            const blob = new Blob([csv], { type: 'text/csv;charset=utf-8;' });
+            const url = URL.createObjectURL(blob);
+            const link = document.createElement('a');
+            link.href = url;
+            link.download = "raw_data.csv";
+            link.click();
+            URL.revokeObjectURL(url);
+        });
     """))
 
     p.add_tools(TapTool())
@@ -1068,7 +1401,7 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
     # Left column: controls only (view buttons, slider, clustering toggle, cluster filter)
     buttons_col = column(
         show_all_button, *button_methods,
-        rmsd_button, download_button , slider,
+        rmsd_button, error_metric_toggle, download_button , slider,
         cluster_controls,
         Spacer(height=20)
     )
@@ -1111,58 +1444,123 @@ def vis_with_separate_clusters_view(reduced_df, image_path, deconv_methods, nb_s
 # <!                       BOKEH VISUALIZATION                               !>
 # <! ------------------------------------------------------------------------!>
 
-if __name__ == "__main__":
-    import sys
-    argv = sys.argv
-    sp_input = argv[1]
-    norm_weights_filepaths = argv[2].split(',')
-    st_coords_filepath = argv[3]
-    data_clustered = argv[4]
-    image_path = argv[5]
-    n_largest_cell_types = int(argv[6])
-    scale_factor = float(argv[7])
-    output_html = argv[8]
-    deconv_methods = argv[9].split(',')
-    # Optional: a second clustering file (argv[10]) + button labels (argv[11], e.g. "Seurat,BayesSpace")
-    data_clustered2 = argv[10] if len(argv) > 10 and argv[10] not in ('', 'none', 'None') else None
-    clustering_labels = argv[11].split(',') if len(argv) > 11 else ["Primary", "Alternative"]
+def method_cluster_composition(clu, props, celltypes):
+    """Mean proportions and number of spots per cluster, for one method."""
+    _df = props.reindex(columns=celltypes).join(clu.rename('cluster'), how='inner').dropna(subset=['cluster'])
+    _df['cluster'] = _df['cluster'].astype(int)
+    _grp = _df.groupby('cluster')
+    _means = _grp[celltypes].mean()
+    _cnt = _grp.size()
+    return {'means': {str(int(c)): [float(v) for v in _means.loc[c].tolist()] for c in _means.index},
+            'counts': {str(int(c)): int(_cnt.loc[c]) for c in _cnt.index}}
+
+
+def compute_cluster_composition(clustering_file, deconv_methods, norm_weights_filepaths, cache_dir=None):
+    """Average cell-type composition per cluster and per method (for the info panel)."""
+    celltypes = read_proportions_header(norm_weights_filepaths[0])
+    means, counts = {}, {}
+    for _m, _fp in zip(deconv_methods, norm_weights_filepaths):
+        comp = _disk_cached(
+            cache_dir, 'composition', cache_key(file_digest(clustering_file), file_digest(_fp), tuple(celltypes)),
+            lambda _fp=_fp: method_cluster_composition(read_clustering(clustering_file), load_proportions(_fp, cache_dir), celltypes),
+            'json')
+        means[_m], counts[_m] = comp['means'], comp['counts']
+    return {'celltypes': celltypes, 'means': means, 'counts': counts}
+
 
+def generate_visualization(norm_weights_filepaths, st_coords_filepath, data_clustered, image_path, n_largest_cell_types,
+                           scale_factor, output_html, deconv_methods, data_clustered2=None, clustering_labels=None,
+                           encoding='compact', image_mode='embed', tile_format='jpeg', backend='webgl', cache_dir=None):
     print("Processing data ...\n")
+    # Per-run memory caches (a batch worker renders many samples in the same process)
+    _file_cache.clear()
+    _disk_memo.clear()
+    cache_stats.update(reused=0, computed=0)
     processed_data = post_process_data(norm_weights_filepaths=norm_weights_filepaths, st_coords_filepath=st_coords_filepath, data_clustered=data_clustered, \
-                                 deconv_methods=deconv_methods, n_largest_cell_types=n_largest_cell_types, scale_factor=scale_factor, data_clustered2=data_clustered2)
+                                 deconv_methods=deconv_methods, n_largest_cell_types=n_largest_cell_types, scale_factor=scale_factor, data_clustered2=data_clustered2, cache_dir=cache_dir)
 
     print(f"Deconvolution methods {deconv_methods}")
     nb_spots_samples = processed_data.shape[0]
     print(f"Generating vis with {nb_spots_samples} spots and top {n_largest_cell_types} cells...\n")
 
-    # Average cell-type composition per cluster and per method (for the info panel), per clustering.
-    def _composition(clustering_file):
-        clu = pd.read_csv(clustering_file)
-        clu = clu.set_index(clu.columns[0])['BayesSpace']
-        means, counts, celltypes = {}, {}, None
-        for _m, _fp in zip(deconv_methods, norm_weights_filepaths):
-            _props = pd.read_csv(_fp, sep='\t', index_col=0)
-            _props.index.name = None
-            if celltypes is None:
-                celltypes = list(_props.columns)
-            _df = _props.join(clu.rename('cluster'), how='inner').dropna(subset=['cluster'])
-            _df['cluster'] = _df['cluster'].astype(int)
-            _grp = _df.groupby('cluster')
-            _means = _grp[celltypes].mean()
-            _cnt = _grp.size()
-            means[_m] = {str(int(c)): [float(v) for v in _means.loc[c].tolist()] for c in _means.index}
-            counts[_m] = {str(int(c)): int(_cnt.loc[c]) for c in _cnt.index}
-        return {'celltypes': celltypes, 'means': means, 'counts': counts}
-
-    comp_primary = _composition(data_clustered)
-    comp_alt = _composition(data_clustered2) if data_clustered2 is not None else comp_primary
+    # Cluster compositions, per clustering.
+    comp_primary = compute_cluster_composition(data_clustered, deconv_methods, norm_weights_filepaths, cache_dir)
+    comp_alt = (compute_cluster_composition(data_clustered2, deconv_methods, norm_weights_filepaths, cache_dir)
+                if data_clustered2 is not None else comp_primary)
     cluster_composition = [comp_primary, comp_alt]
 
     # Full (all cell types) per-spot proportions per method, for the clickable cell-type heatmap.
-    full_props = {}
-    for _m, _fp in zip(deconv_methods, norm_weights_filepaths):
-        _fpdf = pd.read_csv(_fp, sep='\t', index_col=0)
-        _fpdf.index.name = None
-        full_props[_m] = _fpdf
+    full_props = {_m: load_proportions(_fp, cache_dir) for _m, _fp in zip(deconv_methods, norm_weights_filepaths)}
+    if cache_dir is not None:
+        print(f"Cache {cache_dir}: {cache_stats['reused']} intermediates reused, {cache_stats['computed']} computed\n")
+
+    vis_with_separate_clusters_view(reduced_df=processed_data, image_path=image_path, deconv_methods=deconv_methods, nb_spots_samples=nb_spots_samples, n_largest_cell_types=n_largest_cell_types, output=output_html, cluster_composition=cluster_composition, clustering_labels=clustering_labels, full_props=full_props, encoding=encoding, image_mode=image_mode, tile_format=tile_format, backend=backend)
+    return nb_spots_samples
 
-    vis_with_separate_clusters_view(reduced_df=processed_data, image_path=image_path, deconv_methods=deconv_methods, nb_spots_samples=nb_spots_samples, n_largest_cell_types=n_largest_cell_types, output=output_html, cluster_composition=cluster_composition, clustering_labels=clustering_labels, full_props=full_props)
+
+if __name__ == "__main__":
+    import argparse as arp
+    prs = arp.ArgumentParser()
+    prs.add_argument('sp_input', type=str, help='spatial input (unused, kept for the workflow rules)')
+    prs.add_argument('norm_weights_filepaths', type=str, help='comma separated proportions TSVs, one per method')
+    prs.add_argument('st_coords_filepath', type=str, help='spot coordinates (tissue_positions format)')
+    prs.add_argument('data_clustered', type=str, help='clustering CSV (BayesSpace column)')
+    prs.add_argument('image_path', type=str, help='tissue image')
+    prs.add_argument('n_largest_cell_types', type=int, help='number of top cell types shown per spot')
+    prs.add_argument('scale_factor', type=float, help='scale factor from full-resolution pixels to the image')
+    prs.add_argument('output_html', type=str, help='output HTML file')
+    prs.add_argument('deconv_methods', type=str, help='comma separated method names, in the order of the TSVs')
+    # Optional: a second clustering file + button labels (e.g. "Seurat,BayesSpace")
+    prs.add_argument('data_clustered2', type=str, nargs='?', default=None, help='second clustering CSV for the toggle')
+    prs.add_argument('clustering_labels', type=str, nargs='?', default="Primary,Alternative",
+                     help='comma separated labels of the two clusterings')
+    prs.add_argument('--encoding', default='compact', choices=['compact', 'json'],
+                     help='per-spot columns as typed arrays (compact) or plain JSON lists')
+    prs.add_argument('--image_mode', default='embed', choices=['embed', 'tiles'],
+                     help='tissue image as a tile pyramid next to the HTML (tiles) or inlined in the HTML (embed)')
+    prs.add_argument('--tile_format', default='jpeg', choices=sorted(TILE_EXTENSIONS),
+                     help='image format of the tiles')
+    prs.add_argument('--backend', default='webgl', choices=['webgl', 'canvas'],
+                     help='Bokeh output backend of the plots')
+    prs.add_argument('--cache_dir', type=str, default=None,
+                     help='cache of the per-method intermediates, to rebuild incrementally (default: no cache)')
+    prs.add_argument('--serve', type=int, default=None, metavar='PORT',
+                     help='instead of writing the HTML, serve the section on this port (Bokeh server, '
+                          'only the spots in view are sent to the browser)')
+    prs.add_argument('--max_spots', type=int, default=20000,
+                     help='with --serve, above this number of spots in view they are aggregated into hexagons')
+    args = prs.parse_args()
+    data_clustered2 = args.data_clustered2 if args.data_clustered2 not in (None, '', 'none', 'None') else None
+    cache_dir = args.cache_dir if args.cache_dir not in (None, '', 'none', 'None') else None
+
+    if args.serve is not None:
+        import sp_server
+        store = sp_server.SpotStore(
+            norm_weights_filepaths=args.norm_weights_filepaths.split(','),
+            st_coords_filepath=args.st_coords_filepath,
+            data_clustered=args.data_clustered,
+            deconv_methods=args.deconv_methods.split(','),
+            n_largest_cell_types=args.n_largest_cell_types,
+            scale_factor=args.scale_factor,
+            data_clustered2=data_clustered2,
+            max_spots=args.max_spots)
+        sp_server.serve(store, image_path=args.image_path, output=args.output_html,
+                        clustering_labels=args.clustering_labels.split(','), port=args.serve,
+                        tile_format=args.tile_format)
+    else:
+        generate_visualization(
+            norm_weights_filepaths=args.norm_weights_filepaths.split(','),
+            st_coords_filepath=args.st_coords_filepath,
+            data_clustered=args.data_clustered,
+            image_path=args.image_path,
+            n_largest_cell_types=args.n_largest_cell_types,
+            scale_factor=args.scale_factor,
+            output_html=args.output_html,
+            deconv_methods=args.deconv_methods.split(','),
+            data_clustered2=data_clustered2,
+            clustering_labels=args.clustering_labels.split(','),
+            encoding=args.encoding,
+            image_mode=args.image_mode,
+            tile_format=args.tile_format,
+            backend=args.backend,
+            cache_dir=cache_dir)
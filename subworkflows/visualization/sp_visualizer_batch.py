@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+
+Batch mode of sp_visualizer.py: renders all the samples of a manifest in one job, with a pool
+of worker processes (Bokeh / pandas imported once per worker, not once per sample), the same
+colors for a cell type in every sample, and an index page linking all the HTML files.
+
+    python3 subworkflows/visualization/sp_visualizer_batch.py manifest.tsv vis_output --workers 8
+
+The manifest is a tab-separated file with a header and one row per sample:
+
+    sample  norm_weights_filepaths  deconv_methods  st_coords_filepath  data_clustered  image_path  scale_factor
+
+norm_weights_filepaths and deconv_methods are comma separated, in the same order. Optional
+columns: data_clustered2, clustering_labels, n_largest_cell_types.
+"""
+# <! ------------------------------------------------------------------------!>
+# <!                       IMPORTS                                           !>
+# <! ------------------------------------------------------------------------!>
+import argparse as arp
+import html
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from bokeh.palettes import Turbo256
+
+import sp_visualizer
+
+REQUIRED_COLUMNS = ['sample', 'norm_weights_filepaths', 'deconv_methods', 'st_coords_filepath',
+                    'data_clustered', 'image_path', 'scale_factor']
+OPTIONAL_COLUMNS = {'data_clustered2': '', 'clustering_labels': 'Primary,Alternative', 'n_largest_cell_types': '5'}
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       MANIFEST + SHARED STATE                           !>
+# <! ------------------------------------------------------------------------!>
+
+def read_manifest(filepath):
+    manifest = pd.read_csv(filepath, sep='\t', dtype=str, keep_default_na=False)
+    missing = [c for c in REQUIRED_COLUMNS if c not in manifest.columns]
+    if missing:
+        raise ValueError(f"Missing column(s) {', '.join(missing)} in the manifest {filepath}")
+    if manifest['sample'].duplicated().any():
+        raise ValueError(f"Duplicated sample names in the manifest {filepath}")
+    for column, default in OPTIONAL_COLUMNS.items():
+        if column not in manifest.columns:
+            manifest[column] = default
+        manifest[column] = manifest[column].replace('', default)
+    return manifest
+
+
+def shared_cell_type_colors(manifest):
+    """Colors for the cell types of the study missing from sp_visualizer.colordict, spread over
+    Turbo256 in alphabetical order, so that a cell type has the same color in every sample.
+    Also returns {sample: error} of the samples whose proportions files could not be read."""
+    cell_types, unreadable = set(), {}
+    for sample, filepaths in zip(manifest['sample'], manifest['norm_weights_filepaths']):
+        try:
+            cell_types.update(*(sp_visualizer.read_proportions_header(fp) for fp in filepaths.split(',')))
+        except Exception:
+            unreadable[sample] = traceback.format_exc()
+    missing = sorted(cell_types - set(sp_visualizer.colordict))
+    if not missing:
+        return {}, unreadable
+    picks = np.linspace(0, len(Turbo256) - 1, len(missing)).round().astype(int)
+    return {ct: Turbo256[i] for ct, i in zip(missing, picks)}, unreadable
+
+
+# <! ------------------------------------------------------------------------!>
+# <!                       WORKERS                                           !>
+# <! ------------------------------------------------------------------------!>
+
+def _init_worker(extra_colors):
+    sp_visualizer.colordict.update(extra_colors)
+
+
+def render_sample(sample, output_dir, encoding='compact', image_mode='embed', backend='webgl', cache_dir=None):
+    """Render one manifest row; failures are reported in the index instead of stopping the batch."""
+    output_html = os.path.join(output_dir, f"{sample['sample']}.html")
+    start = time.perf_counter()
+    try:
+        n_spots = sp_visualizer.generate_visualization(
+            norm_weights_filepaths=sample['norm_weights_filepaths'].split(','),
+            st_coords_filepath=sample['st_coords_filepath'],
+            data_clustered=sample['data_clustered'],
+            image_path=sample['image_path'],
+            n_largest_cell_types=int(sample['n_largest_cell_types']),
+            scale_factor=float(sample['scale_factor']),
+            output_html=output_html,
+            deconv_methods=sample['deconv_methods'].split(','),
+            data_clustered2=sample['data_clustered2'] if sample['data_clustered2'] not in ('', 'none', 'None') else None,
+            clustering_labels=sample['clustering_labels'].split(','),
+            encoding=encoding, image_mode=image_mode, backend=backend,
+            cache_dir=cache_dir)
+        error = None
+    except Exception:
+        n_spots, error = None, traceback.format_exc()
+    return {'sample': sample['sample'], 'html': os.path.basename(output_html), 'methods': sample['deconv_methods'],
+            'spots': n_spots, 'seconds': time.perf_counter() - start, 'error': error}
+
+
+def write_index(results, output_dir):
+    rows = []
+    for r in results:
+        if r['error'] is None:
+            link = f"<a href='{html.escape(r['html'])}'>{html.escape(r['sample'])}</a>"
+            status = f"{r['spots']} spots"
+        else:
+            link = html.escape(r['sample'])
+            status = f"<details><summary style='color:#b91c1c'>failed</summary><pre>{html.escape(r['error'])}</pre></details>"
+        rows.append(f"<tr><td>{link}</td><td>{html.escape(r['methods'].replace(',', ', '))}</td>"
+                    f"<td>{status}</td><td>{r['seconds']:.1f} s</td></tr>")
+    page = ("<!DOCTYPE html><html><head><meta charset='utf-8'><title>DeconvoliSTa visualizations</title>"
+            "<style>body{font-family:sans-serif;margin:24px;color:#2f342e}table{border-collapse:collapse}"
+            "td,th{padding:6px 14px;border-bottom:1px solid #e6e1d4;text-align:left}</style></head><body>"
+            f"<h2>DeconvoliSTa visualizations ({len(results)} samples)</h2>"
+            "<table><tr><th>Sample</th><th>Methods</th><th>Status</th><th>Time</th></tr>"
+            + "".join(rows) + "</table></body></html>")
+    index_html = os.path.join(output_dir, "index.html")
+    with open(index_html, 'w') as f:
+        f.write(page)
+    return index_html
+
+
+def generate_batch(manifest_filepath, output_dir, workers=None, encoding='compact', image_mode='embed', backend='webgl',
+                   cache_dir=None):
+    manifest = read_manifest(manifest_filepath)
+    os.makedirs(output_dir, exist_ok=True)
+    extra_colors, unreadable = shared_cell_type_colors(manifest)
+    # A sample whose proportions cannot be read fails alone, like a failed rendering
+    skipped = {r['sample']: {'sample': r['sample'], 'html': f"{r['sample']}.html", 'methods': r['deconv_methods'],
+                             'spots': None, 'seconds': 0.0, 'error': unreadable[r['sample']]}
+               for r in manifest.to_dict('records') if r['sample'] in unreadable}
+    samples = [r for r in manifest.to_dict('records') if r['sample'] not in unreadable]
+    rendered = {}
+    if samples:
+        workers = min(workers or os.cpu_count() or 1, len(samples))
+        print(f"Rendering {len(samples)} samples with {workers} workers ...\n")
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(extra_colors,)) as pool:
+            rendered = {r['sample']: r for r in pool.map(
+                render_sample, samples, [output_dir] * len(samples), [encoding] * len(samples),
+                [image_mode] * len(samples), [backend] * len(samples), [cache_dir] * len(samples))}
+    results = [rendered.get(sample) or skipped[sample] for sample in manifest['sample']]
+    index_html = write_index(results, output_dir)
+    failed = [r['sample'] for r in results if r['error'] is not None]
+    print(f"Index: {index_html}")
+    if failed:
+        raise SystemExit(f"Failed samples: {', '.join(failed)} (see {index_html})")
+
+
+if __name__ == "__main__":
+    prs = arp.ArgumentParser()
+    prs.add_argument('manifest', type=str, help='tab-separated manifest, one row per sample')
+    prs.add_argument('output_dir', type=str, help='directory of the HTML files and of index.html')
+    prs.add_argument('--workers', type=int, default=None, help='worker processes (default: number of CPUs)')
+    prs.add_argument('--encoding', default='compact', choices=['compact', 'json'],
+                     help='per-spot columns as typed arrays (compact) or plain JSON lists')
+    prs.add_argument('--image_mode', default='embed', choices=['embed', 'tiles'],
+                     help='tissue image as a tile pyramid next to the HTML (tiles) or inlined in the HTML (embed)')
+    prs.add_argument('--backend', default='webgl', choices=['webgl', 'canvas'],
+                     help='Bokeh output backend of the plots')
+    prs.add_argument('--cache_dir', type=str, default=None,
+                     help='cache of the per-method intermediates shared by the samples (default: no cache)')
+    args = prs.parse_args()
+
+    generate_batch(args.manifest, args.output_dir, workers=args.workers, encoding=args.encoding,
+                   image_mode=args.image_mode, backend=args.backend, cache_dir=args.cache_dir)
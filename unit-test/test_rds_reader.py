@@ -0,0 +1,72 @@
+import gzip
+import os
+import struct
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'subworkflows', 'deconvolution'))
+import rds_reader  # noqa: E402
+
+# Hand-built XDR streams of R's serialization format (version 3)
+HAS_ATTR, HAS_TAG = 1 << 9, 1 << 10
+
+
+def ints(*values):
+    return b''.join(struct.pack('>i', v) for v in values)
+
+
+def charsxp(text):
+    raw = text.encode()
+    return ints(rds_reader.CHARSXP | (64 << 12), len(raw)) + raw
+
+
+def symbol(name):
+    return ints(rds_reader.SYMSXP) + charsxp(name)
+
+
+def pairlist(*items, tags=None):
+    out = b''
+    for i, item in enumerate(items):
+        tag = tags[i] if tags else None
+        out += ints(rds_reader.LISTSXP | (HAS_TAG if tag else 0)) + (symbol(tag) if tag else b'') + item
+    return out + ints(rds_reader.NILVALUE_SXP)
+
+
+def vector(rtype, values, attributes=None):
+    flags = rtype | (HAS_ATTR if attributes else 0)
+    if rtype == rds_reader.STRSXP:
+        body = b''.join(charsxp(v) for v in values)
+    else:
+        body = np.asarray(values, dtype='>i4' if rtype == rds_reader.INTSXP else '>f8').tobytes()
+    return ints(flags, len(values)) + body + (attributes or b'')
+
+
+def wrapper(cls, wrapped, attributes=None):
+    """ALTREP wrapper as R writes it: class info, CONS(wrapped, metadata), attributes."""
+    info = pairlist(symbol(cls), symbol('base'), vector(rds_reader.INTSXP, [1]))
+    state = pairlist(wrapped, vector(rds_reader.INTSXP, [0, 0]))
+    return ints(rds_reader.ALTREP_SXP) + info + state + (attributes or ints(rds_reader.NILVALUE_SXP))
+
+
+def read(payload, tmp_path):
+    path = tmp_path / 'object.rds'
+    with gzip.open(path, 'wb') as f:
+        f.write(b'X\n' + ints(3, 0x040300, 0x030500, 5) + b'UTF-8' + payload)
+    return rds_reader.read_rds(str(path))
+
+
+def test_wrapped_vectors(tmp_path):
+    obj = read(wrapper('wrap_integer', vector(rds_reader.INTSXP, [3, 1, 2])), tmp_path)
+    assert obj.rtype == rds_reader.INTSXP
+    assert obj.value.tolist() == [3, 1, 2]
+
+    obj = read(wrapper('wrap_real', vector(rds_reader.REALSXP, [0.5, 2.0])), tmp_path)
+    assert obj.rtype == rds_reader.REALSXP
+    assert obj.value.tolist() == [0.5, 2.0]
+
+    names = pairlist(vector(rds_reader.STRSXP, ['a', 'b']), tags=['names'])
+    obj = read(wrapper('wrap_string', vector(rds_reader.STRSXP, ['x', 'y']), names), tmp_path)
+    assert obj.rtype == rds_reader.STRSXP
+    assert obj.value.tolist() == ['x', 'y']
+    assert obj.attr('names').value.tolist() == ['a', 'b']